@@ -6,10 +6,15 @@ from __future__ import print_function
 from tsf_nmt import attention
 from tsf_nmt import build_ops
 from tsf_nmt import cells
+from tsf_nmt import checkpoint_ops
 from tsf_nmt import content_functions
 from tsf_nmt import data_utils
 from tsf_nmt import decoders
 from tsf_nmt import encoders
+from tsf_nmt import graph_ops
+from tsf_nmt import metrics_ops
 from tsf_nmt import nmt_models
+from tsf_nmt import prefetch_ops
+from tsf_nmt import profiling_ops
 from tsf_nmt import train_ops
 from tsf_nmt import translate_ops
\ No newline at end of file
@@ -23,7 +23,7 @@ def get_attention_f(name):
 
 
 def hybrid_attention(decoder_hidden_state, hidden_attn, initializer, window_size=10,
-                     content_function=vinyals_kaiser, dtype=tf.float32):
+                     content_function=vinyals_kaiser, attention_mask=None, dtype=tf.float32):
     """Put hybrid attention (mix of global and local attention) on hidden using decoder hidden states
     and the hidden states of encoder (hidden_attn).
 
@@ -44,6 +44,9 @@ def hybrid_attention(decoder_hidden_state, hidden_attn, initializer, window_size
         content_function : function
             Content function to score the decoder hidden states and encoder hidden states to extract their
             weights. Default to 'vinyals_kaiser'.
+        attention_mask : 2-D Tensor
+            Tensor of shape (?, timesteps) with 1 for the encoder positions to attend to and 0 for padding.
+            Default to None, i.e., all the positions are attended to.
         dtype : tensorflow dtype
             Type of tensors. Default to tf.float32
 
@@ -61,12 +64,14 @@ def hybrid_attention(decoder_hidden_state, hidden_attn, initializer, window_size
     local_attn = local_attention(decoder_hidden_state=decoder_hidden_state,
                                  hidden_attn=hidden_attn,
                                  content_function=content_function,
-                                 window_size=window_size, initializer=initializer, dtype=dtype)
+                                 window_size=window_size, initializer=initializer,
+                                 attention_mask=attention_mask, dtype=dtype)
 
     global_attn = global_attention(decoder_hidden_state=decoder_hidden_state,
                                    hidden_attn=hidden_attn,
                                    content_function=content_function,
-                                   window_size=window_size, initializer=initializer, dtype=dtype)
+                                   window_size=window_size, initializer=initializer,
+                                   attention_mask=attention_mask, dtype=dtype)
 
     with vs.variable_scope("FeedbackGate_%d" % 0, initializer=initializer):
         y = cells.linear(decoder_hidden_state, attention_vec_size, True)
@@ -86,7 +91,7 @@ def hybrid_attention(decoder_hidden_state, hidden_attn, initializer, window_size
 
 
 def global_attention(decoder_hidden_state, hidden_attn, initializer, window_size=10,
-                     content_function=vinyals_kaiser, dtype=tf.float32):
+                     content_function=vinyals_kaiser, attention_mask=None, dtype=tf.float32):
 
     """Put global attention on hidden using decoder hidden states and the hidden states of encoder (hidden_attn).
 
@@ -107,6 +112,9 @@ def global_attention(decoder_hidden_state, hidden_attn, initializer, window_size
     content_function : function
         Content function to score the decoder hidden states and encoder hidden states to extract their
         weights. Default to 'vinyals_kaiser'.
+    attention_mask : 2-D Tensor
+        Tensor of shape (?, timesteps) with 1 for the encoder positions to attend to and 0 for padding.
+        Default to None, i.e., all the positions are attended to.
     dtype : tensorflow dtype
         Type of tensors. Default to tf.float32
 
@@ -120,7 +128,6 @@ def global_attention(decoder_hidden_state, hidden_attn, initializer, window_size
     assert content_function is not None
 
     attention_vec_size = hidden_attn.get_shape()[3].value
-    attn_length = hidden_attn.get_shape()[1].value
 
     with vs.variable_scope("AttentionGlobal", initializer=initializer):
 
@@ -129,10 +136,17 @@ def global_attention(decoder_hidden_state, hidden_attn, initializer, window_size
 
         alpha = nn_ops.softmax(s)
 
+        if attention_mask is not None:
+            # renormalize over the positions to attend to (same as a softmax over them only)
+            alpha = alpha * attention_mask
+            alpha = alpha / math_ops.reduce_sum(alpha, [1], keep_dims=True)
+
         _ = tf.histogram_summary('global_alpha_weights', alpha)
 
         # Now calculate the attention-weighted vector d.
-        d = math_ops.reduce_sum(array_ops.reshape(alpha, [-1, attn_length, 1, 1]) * hidden_attn, [1, 2])
+        # (the number of encoder time steps does not need to be known)
+        alpha = array_ops.expand_dims(array_ops.expand_dims(alpha, 2), 3)
+        d = math_ops.reduce_sum(alpha * hidden_attn, [1, 2])
         ds = array_ops.reshape(d, [-1, attention_vec_size])#
 
     _ = tf.histogram_summary('global_attention_context', ds)
@@ -141,7 +155,7 @@ def global_attention(decoder_hidden_state, hidden_attn, initializer, window_size
 
 
 def local_attention(decoder_hidden_state, hidden_attn, initializer, window_size=10,
-                    content_function=vinyals_kaiser, dtype=tf.float32):
+                    content_function=vinyals_kaiser, attention_mask=None, dtype=tf.float32):
     """Put local attention on hidden using decoder hidden states and the hidden states of encoder (hidden_attn).
 
     Parameters
@@ -161,6 +175,9 @@ def local_attention(decoder_hidden_state, hidden_attn, initializer, window_size=
     content_function : function
         Content function to score the decoder hidden states and encoder hidden states to extract their
         weights. Default to 'vinyals_kaiser'.
+    attention_mask : 2-D Tensor
+        Tensor of shape (?, timesteps) with 1 for the encoder positions to attend to and 0 for padding.
+        Default to None, i.e., all the positions are attended to.
     dtype : tensorflow dtype
         Type of tensors. Default to tf.float32
 
@@ -248,6 +265,10 @@ def local_attention(decoder_hidden_state, hidden_attn, initializer, window_size=
 
         at = masked_soft * e
 
+        # padding positions do not contribute to the context
+        if attention_mask is not None:
+            at = at * attention_mask
+
         # Now calculate the attention-weighted vector d.
         d = math_ops.reduce_sum(
                 array_ops.reshape(at, [-1, attn_length, 1, 1]) * hidden_attn,
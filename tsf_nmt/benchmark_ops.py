@@ -0,0 +1,634 @@
+# -*- coding: utf-8 -*-
+"""
+    Micro-benchmarks for the host-side (Python) parts of the training and decoding pipelines.
+
+    Usage:
+
+        python benchmark_ops.py <benchmark name>
+
+"""
+from __future__ import print_function
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import numpy
+
+import data_utils
+import prefetch_ops
+from nmt_models import TranslationModel
+
+# same buckets used by the translate_*.py entry points
+_buckets = [(5, 10), (10, 15), (15, 20), (20, 25), (25, 30), (30, 35), (35, 40), (40, 45), (45, 50), (50, 50)]
+
+
+def _synthetic_bucket_data(buckets, bucket_size, vocab_size=30000, seed=1234):
+    """Create random [source_ids, target_ids] pairs that fit into each bucket, as read_nmt_data does."""
+    rng = random.Random(seed)
+    data_set = []
+    previous = (1, 2)
+    for source_size, target_size in buckets:
+        bucket = []
+        for _ in xrange(bucket_size):
+            source_len = rng.randint(min(previous[0], source_size - 1), source_size - 1)
+            target_len = rng.randint(min(previous[1], target_size - 1), target_size - 1)
+            source_ids = [rng.randint(4, vocab_size - 1) for _ in xrange(source_len)]
+            target_ids = [rng.randint(4, vocab_size - 1) for _ in xrange(target_len - 1)]
+            target_ids.append(data_utils.EOS_ID)
+            bucket.append([source_ids, target_ids])
+        data_set.append(bucket)
+        previous = (source_size, target_size)
+    return data_set
+
+
+def _loop_train_batch(data, buckets, bucket_id, batch_size):
+    """Reference (pure Python loops) implementation of TranslationModel.get_train_batch."""
+    encoder_size, decoder_size = buckets[bucket_id]
+    encoder_inputs, decoder_inputs = [], []
+
+    n_target_words = 0
+
+    for _ in xrange(batch_size):
+        encoder_input, decoder_input = random.choice(data[bucket_id])
+
+        encoder_pad = [data_utils.PAD_ID] * (encoder_size - len(encoder_input))
+        encoder_inputs.append(list(reversed(encoder_input + encoder_pad)))
+
+        n_target_words += len(decoder_input)
+
+        decoder_pad_size = decoder_size - len(decoder_input) - 1
+        decoder_inputs.append([data_utils.GO_ID] + decoder_input +
+                              [data_utils.PAD_ID] * decoder_pad_size)
+
+    batch_encoder_inputs, batch_decoder_inputs, batch_weights = [], [], []
+
+    for length_idx in xrange(encoder_size):
+        batch_encoder_inputs.append(
+            numpy.array([encoder_inputs[batch_idx][length_idx]
+                         for batch_idx in xrange(batch_size)], dtype=numpy.int32))
+
+    for length_idx in xrange(decoder_size):
+        batch_decoder_inputs.append(
+            numpy.array([decoder_inputs[batch_idx][length_idx]
+                         for batch_idx in xrange(batch_size)], dtype=numpy.int32))
+
+        batch_weight = numpy.ones(batch_size, dtype=numpy.float32)
+        for batch_idx in xrange(batch_size):
+            if length_idx < decoder_size - 1:
+                target = decoder_inputs[batch_idx][length_idx + 1]
+            if length_idx == decoder_size - 1 or target == data_utils.PAD_ID:
+                batch_weight[batch_idx] = 0.0
+        batch_weights.append(batch_weight)
+
+    return batch_encoder_inputs, batch_decoder_inputs, batch_weights, n_target_words
+
+
+def benchmark_train_batch(buckets=_buckets, batch_size=32, n_iter=200, bucket_size=2000):
+    """Compare the vectorized get_train_batch against the reference loops, bucket by bucket."""
+    data_set = _synthetic_bucket_data(buckets, bucket_size)
+
+    model = TranslationModel()
+    model.buckets = buckets
+
+    print('bucket     loops (ms)  vectorized (ms)  speedup')
+    for bucket_id, bucket in enumerate(buckets):
+
+        # both implementations must produce the same batch for the same random state
+        random.seed(bucket_id)
+        expected = _loop_train_batch(data_set, buckets, bucket_id, batch_size)
+        random.seed(bucket_id)
+        got = model.get_train_batch(data_set, bucket_id, batch_size=batch_size)
+        for e, g in zip(expected[:3], got[:3]):
+            assert numpy.array_equal(numpy.array(e), g), 'Batches differ in bucket %d' % bucket_id
+        assert expected[3] == got[3]
+
+        start_time = time.time()
+        for _ in xrange(n_iter):
+            _loop_train_batch(data_set, buckets, bucket_id, batch_size)
+        loop_time = (time.time() - start_time) / n_iter
+
+        start_time = time.time()
+        for _ in xrange(n_iter):
+            model.get_train_batch(data_set, bucket_id, batch_size=batch_size)
+        vec_time = (time.time() - start_time) / n_iter
+
+        print('%-10s %10.3f  %15.3f  %6.1fx' % (str(bucket), loop_time * 1000.0, vec_time * 1000.0,
+                                               loop_time / vec_time))
+
+
+def _write_synthetic_ids(source_path, target_path, n_pairs, max_len=50, vocab_size=30000, seed=1234):
+    """Write aligned token-id files (one sentence per line) with random lengths and ids."""
+    rng = numpy.random.RandomState(seed)
+    with open(source_path, 'w') as source_file:
+        with open(target_path, 'w') as target_file:
+            for _ in xrange(n_pairs):
+                for f in (source_file, target_file):
+                    ids = rng.randint(4, vocab_size, rng.randint(1, max_len))
+                    f.write(' '.join([str(i) for i in ids]) + '\n')
+
+
+def _list_data_nbytes(data_set):
+    """Approximate the memory held by the lists of lists of ints built by read_nmt_data."""
+    total = sys.getsizeof(data_set)
+    for bucket in data_set:
+        total += sys.getsizeof(bucket)
+        for pair in bucket:
+            total += sys.getsizeof(pair)
+            for ids in pair:
+                # small ints are cached by the interpreter, every other id is a new object
+                total += sys.getsizeof(ids) + sum([sys.getsizeof(i) for i in ids if i > 256])
+    return total
+
+
+def _token_buckets_nbytes(data_set):
+    """Memory held by a list of TokenBucket: the shared token arrays plus each bucket index."""
+    total = 0
+    if data_set:
+        total += data_set[0].source.nbytes + data_set[0].target.nbytes
+    return total + sum([bucket.nbytes for bucket in data_set])
+
+
+def benchmark_bucket_store(buckets=_buckets, n_pairs=200000, batch_size=32, n_iter=500):
+    """Memory per million sentence pairs and sampling time of the list and compact bucket stores."""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        source_path = os.path.join(tmp_dir, 'train.ids.src')
+        target_path = os.path.join(tmp_dir, 'train.ids.tgt')
+        _write_synthetic_ids(source_path, target_path, n_pairs)
+
+        model = TranslationModel()
+        model.buckets = buckets
+
+        print('store      read (s)  MB per 1M pairs  batch (ms)')
+        for name, reader, nbytes in [('lists', data_utils.read_nmt_data, _list_data_nbytes),
+                                     ('compact', data_utils.read_nmt_data_compact, _token_buckets_nbytes)]:
+            start_time = time.time()
+            data_set = reader(source_path, target_path, FLAGS=object(), buckets=buckets)
+            read_time = time.time() - start_time
+
+            n_read = sum([len(b) for b in data_set])
+            mb_per_million = nbytes(data_set) / float(n_read) * 1e6 / 2 ** 20
+
+            bucket_ids = [b for b in xrange(len(buckets)) if len(data_set[b]) > 0]
+            start_time = time.time()
+            for i in xrange(n_iter):
+                model.get_train_batch(data_set, bucket_ids[i % len(bucket_ids)], batch_size=batch_size)
+            batch_time = (time.time() - start_time) / n_iter
+
+            print('%-10s %8.2f  %15.1f  %10.3f' % (name, read_time, mb_per_million, batch_time * 1000.0))
+            del data_set
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def _measure_startup(reader, source_path, target_path, buckets, queue):
+    """Load a data set in a fresh process and report the elapsed time and resident memory growth."""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start_time = time.time()
+    data_set = reader(source_path, target_path, FLAGS=object(), buckets=buckets)
+    elapsed = time.time() - start_time
+    queue.put((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - max_rss, len(data_set)))
+
+
+def benchmark_binary_corpus(buckets=_buckets, n_pairs=5000000):
+    """Startup time and resident memory of the text .ids readers against the memory-mapped corpus."""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        source_path = os.path.join(tmp_dir, 'train.ids.src')
+        target_path = os.path.join(tmp_dir, 'train.ids.tgt')
+        vocab_path = os.path.join(tmp_dir, 'vocab')
+
+        print('Writing %d synthetic sentence pairs...' % n_pairs)
+        _write_synthetic_ids(source_path, target_path, n_pairs)
+        with open(vocab_path, 'w') as vocab_file:
+            vocab_file.write('\n'.join(data_utils._START_VOCAB) + '\n')
+        for path in (source_path, target_path):
+            with open(path, 'r') as ids_file:
+                data_utils.write_binary_corpus(path, ([int(x) for x in line.split()] for line in ids_file),
+                                               vocab_path)
+
+        results = []
+        for name, reader in [('text lists', data_utils.read_nmt_data),
+                             ('text compact', data_utils.read_nmt_data_compact),
+                             ('binary mmap', data_utils.read_nmt_data_binary)]:
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=_measure_startup,
+                                              args=(reader, source_path, target_path, buckets, queue))
+            process.start()
+            elapsed, rss_kb, _ = queue.get()
+            process.join()
+            results.append((name, elapsed, rss_kb / 1024.0))
+
+        print('\nreader         startup (s)  resident (MB)')
+        for name, elapsed, rss_mb in results:
+            print('%-14s %11.2f  %13.1f' % (name, elapsed, rss_mb))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def _write_synthetic_text(data_path, n_lines, vocab_size=100000, max_len=50, seed=1234):
+    """Write a text corpus whose words follow a Zipf distribution, with some numbers mixed in."""
+    rng = numpy.random.RandomState(seed)
+    words = numpy.array(['w%d' % i for i in xrange(vocab_size)] + ['%d.%d' % (i, i % 7) for i in xrange(500)])
+    with open(data_path, 'w') as data_file:
+        for _ in xrange(n_lines // 1000):
+            ranks = numpy.minimum(rng.zipf(1.2, 1000 * max_len // 2), len(words)) - 1
+            lengths = rng.randint(1, max_len, 1000)
+            offsets = numpy.cumsum(lengths) % len(ranks)
+            for start, length in zip(offsets, lengths):
+                data_file.write(' '.join(words[ranks[start:start + length]]) + '\n')
+
+
+def _sorted_vocabulary(vocabulary_path, data_path, max_vocabulary_size):
+    """Reference vocabulary: count the tokens in one pass and sort the whole dict."""
+    vocab = {}
+    with open(data_path, 'r') as f:
+        for line in f:
+            for w in data_utils.basic_tokenizer(line):
+                word = data_utils.re.sub(data_utils._DIGIT_RE, '0', w)
+                if word in vocab:
+                    vocab[word] += 1
+                else:
+                    vocab[word] = 1
+    vocab_list = data_utils._START_VOCAB + sorted(vocab, key=vocab.get, reverse=True)
+    with open(vocabulary_path, 'w') as vocab_file:
+        for w in vocab_list[:max_vocabulary_size]:
+            vocab_file.write(w + '\n')
+
+
+def benchmark_vocabulary(n_lines=1000000, max_vocabulary_size=30000, workers=(1, 2, 4, 8)):
+    """Time create_vocabulary against the number of worker processes and check the files are identical."""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        data_path = os.path.join(tmp_dir, 'train.txt')
+        print('Writing %d synthetic sentences...' % n_lines)
+        _write_synthetic_text(data_path, n_lines)
+
+        reference_path = os.path.join(tmp_dir, 'vocab.reference')
+        _sorted_vocabulary(reference_path, data_path, max_vocabulary_size)
+        with open(reference_path, 'rb') as f:
+            reference = f.read()
+
+        results = []
+        for num_workers in workers:
+            vocabulary_path = os.path.join(tmp_dir, 'vocab.%d' % num_workers)
+            start_time = time.time()
+            data_utils.create_vocabulary(vocabulary_path, data_path, max_vocabulary_size,
+                                         num_workers=num_workers)
+            elapsed = time.time() - start_time
+            with open(vocabulary_path, 'rb') as f:
+                assert f.read() == reference, 'Vocabulary differs with %d workers' % num_workers
+            results.append((num_workers, elapsed))
+
+        print('\nworkers  time (s)  speedup')
+        for num_workers, elapsed in results:
+            print('%7d  %8.2f  %6.1fx' % (num_workers, elapsed, results[0][1] / elapsed))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def _read_binary_files(corpus_path):
+    """Contents of the token and index files of a binary corpus."""
+    contents = []
+    for suffix in (data_utils.BINARY_TOKENS, data_utils.BINARY_INDEX):
+        with open(corpus_path + suffix, 'rb') as f:
+            contents.append(f.read())
+    return contents
+
+
+def benchmark_tokenization(n_lines=1000000, max_vocabulary_size=30000, workers=(1, 2, 4, 8)):
+    """Time data_to_token_ids against the number of worker processes and check the outputs are identical."""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        data_path = os.path.join(tmp_dir, 'train.txt')
+        vocabulary_path = os.path.join(tmp_dir, 'vocab')
+        print('Writing %d synthetic sentences...' % n_lines)
+        _write_synthetic_text(data_path, n_lines)
+        data_utils.create_vocabulary(vocabulary_path, data_path, max_vocabulary_size,
+                                     num_workers=max(workers))
+
+        print('\nformat  workers  time (s)  speedup')
+        for binary, read in [(False, lambda path: open(path, 'rb').read()), (True, _read_binary_files)]:
+            reference = None
+            first_time = None
+            for num_workers in workers:
+                ids_path = os.path.join(tmp_dir, 'train.ids.%d.%d' % (binary, num_workers))
+                start_time = time.time()
+                data_utils.data_to_token_ids(data_path, ids_path, vocabulary_path,
+                                             binary=binary, num_workers=num_workers)
+                elapsed = time.time() - start_time
+                if reference is None:
+                    reference, first_time = read(ids_path), elapsed
+                assert read(ids_path) == reference, 'Token-ids differ with %d workers' % num_workers
+                print('%-6s  %7d  %8.2f  %6.1fx' % ('binary' if binary else 'text', num_workers, elapsed,
+                                                    first_time / elapsed))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def benchmark_vocabulary_load(vocabulary_size=50000, n_iter=20):
+    """Time initialize_vocabulary from the text file and from its marshalled sidecar."""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        vocabulary_path = os.path.join(tmp_dir, 'vocab')
+        with open(vocabulary_path, 'w') as vocab_file:
+            for w in data_utils._START_VOCAB + ['w%d' % i for i in xrange(vocabulary_size)]:
+                vocab_file.write(w + '\n')
+        sidecar_path = vocabulary_path + data_utils.VOCABULARY_SIDECAR
+
+        # the text file is read when there is no sidecar, which is then written
+        text_time = 0.0
+        for _ in xrange(n_iter):
+            if os.path.exists(sidecar_path):
+                os.remove(sidecar_path)
+            start_time = time.time()
+            expected = data_utils.initialize_vocabulary(vocabulary_path)
+            text_time += (time.time() - start_time) / n_iter
+
+        start_time = time.time()
+        for _ in xrange(n_iter):
+            got = data_utils.initialize_vocabulary(vocabulary_path)
+        sidecar_time = (time.time() - start_time) / n_iter
+        assert got == expected, 'Sidecar vocabulary differs from the text file'
+
+        print('source    load (ms)')
+        print('text      %9.2f  (including writing the sidecar)' % (text_time * 1000.0))
+        print('sidecar   %9.2f' % (sidecar_time * 1000.0))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def benchmark_sentence_ids(n_lines=200000, max_vocabulary_size=30000):
+    """Compare sentences_to_token_ids with one sentence_to_token_ids call per line."""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        data_path = os.path.join(tmp_dir, 'train.txt')
+        vocabulary_path = os.path.join(tmp_dir, 'vocab')
+        _write_synthetic_text(data_path, n_lines)
+        data_utils.create_vocabulary(vocabulary_path, data_path, max_vocabulary_size)
+        vocab, _ = data_utils.initialize_vocabulary(vocabulary_path)
+        with open(data_path, 'r') as data_file:
+            sentences = data_file.readlines()
+
+        print('\nnormalize  per sentence (s)  batch (s)  speedup')
+        for normalize_digits in (True, False):
+            start_time = time.time()
+            expected = [data_utils.sentence_to_token_ids(sentence, vocab, normalize_digits) for sentence in sentences]
+            loop_time = time.time() - start_time
+
+            start_time = time.time()
+            got = data_utils.sentences_to_token_ids(sentences, vocab, normalize_digits)
+            batch_time = time.time() - start_time
+
+            assert got == expected, 'Token-ids differ (normalize_digits=%s)' % normalize_digits
+            print('%-9s  %16.2f  %9.2f  %6.1fx' % (normalize_digits, loop_time, batch_time, loop_time / batch_time))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def _synthetic_lengths(n_pairs, seed=1234):
+    """Source and target sentence lengths with a long tail, roughly like a tokenized news corpus."""
+    rng = numpy.random.RandomState(seed)
+    source_lengths = numpy.maximum(rng.lognormal(3.0, 0.5, n_pairs).astype(numpy.int32), 1)
+    target_lengths = numpy.maximum((source_lengths * rng.normal(1.1, 0.15, n_pairs)).astype(numpy.int32), 1)
+    return source_lengths, target_lengths
+
+
+def benchmark_bucket_planner(buckets=_buckets, n_pairs=1000000, coverage=0.99):
+    """Padding waste and dropped pairs of the hand-set buckets and of planned buckets."""
+    source_lengths, target_lengths = _synthetic_lengths(n_pairs)
+
+    named_buckets = [('current', buckets)]
+    for n_buckets in (5, len(buckets), 20):
+        start_time = time.time()
+        planned = data_utils.plan_buckets(source_lengths, target_lengths, n_buckets, coverage=coverage)
+        print('planned %d buckets in %.2f s' % (n_buckets, time.time() - start_time))
+        named_buckets.append(('K=%d' % n_buckets, planned))
+
+    # same number of buckets and the same dropped pairs as the current buckets
+    current_coverage = 1.0 - data_utils.bucket_padding_stats(source_lengths, target_lengths, buckets)[1]
+    named_buckets.append(('K=%d, same coverage' % len(buckets),
+                          data_utils.plan_buckets(source_lengths, target_lengths, len(buckets),
+                                                  coverage=current_coverage)))
+
+    data_utils.print_bucket_report(source_lengths, target_lengths, named_buckets)
+
+
+class _Placeholder(object):
+    """Stands for a TensorFlow placeholder in the feed dictionaries built without a graph."""
+
+    def __init__(self, name):
+        self.name = name
+
+
+def _feedable_model(buckets, batch_size, time_major_inputs=False):
+    """A TranslationModel with placeholder names, so get_train_feed works without a graph."""
+    model = TranslationModel()
+    model.buckets = buckets
+    model.batch_size = batch_size
+    model.time_major_inputs = time_major_inputs
+    if time_major_inputs:
+        model.encoder_batches = [_Placeholder('encoder_batch%d:0' % b) for b in xrange(len(buckets))]
+        model.decoder_batches = [_Placeholder('decoder_batch%d:0' % b) for b in xrange(len(buckets))]
+        model.weight_batches = [_Placeholder('weight_batch%d:0' % b) for b in xrange(len(buckets))]
+    else:
+        model.encoder_inputs = [_Placeholder('encoder%d:0' % i) for i in xrange(buckets[-1][0])]
+        model.decoder_inputs = [_Placeholder('decoder%d:0' % i) for i in xrange(buckets[-1][1] + 1)]
+        model.target_weights = [_Placeholder('weight%d:0' % i) for i in xrange(buckets[-1][1] + 1)]
+    return model
+
+
+def benchmark_prefetch(buckets=_buckets, batch_size=64, step_ms=(2.0, 5.0, 20.0), n_steps=500, capacity=4):
+    """Steps per second of the train_nmt input loop with and without the background batch producer.
+
+    The session.run call is simulated with a sleep of step_ms, which, like a real
+    step, releases the interpreter lock.
+    """
+    data_set = _synthetic_bucket_data(buckets, 2000)
+    sizes = [float(len(b)) for b in data_set]
+    scale = [sum(sizes[:i + 1]) / sum(sizes) for i in xrange(len(sizes))]
+    batch_sizes = [batch_size] * len(buckets)
+    model = _feedable_model(buckets, batch_size)
+
+    print('step (ms)  serial (steps/s)  prefetch (steps/s)  blocked')
+    for step in step_ms:
+        start_time = time.time()
+        for _ in xrange(n_steps):
+            bucket_id = prefetch_ops.choose_bucket(scale)
+            batch = model.get_train_batch(data_set, bucket_id, batch_size=batch_size)
+            model.get_train_feed(batch[0], batch[1], batch[2], bucket_id)
+            time.sleep(step / 1000.0)
+        serial_time = time.time() - start_time
+
+        sampler = prefetch_ops.RandomSampler(scale, batch_sizes)
+        prefetcher = prefetch_ops.BatchPrefetcher(model, data_set, sampler, capacity=capacity).start()
+        start_time = time.time()
+        for _ in xrange(n_steps):
+            prefetcher.get()
+            time.sleep(step / 1000.0)
+        prefetch_time = time.time() - start_time
+        prefetcher.stop()
+
+        print('%9.1f  %16.1f  %18.1f  %6.1f%%' % (step, n_steps / serial_time, n_steps / prefetch_time,
+                                                  100.0 * prefetcher.wait_time / prefetch_time))
+
+
+def benchmark_train_feed(buckets=_buckets, batch_size=32, n_iter=20000):
+    """Feed dictionary size and construction time: one placeholder per time step vs time-major inputs."""
+    data_set = _synthetic_bucket_data(buckets, 200)
+
+    print('bucket    per step (entries, us)  time-major (entries, us)')
+    for bucket_id, bucket in enumerate(buckets):
+        results = []
+        for time_major_inputs in (False, True):
+            model = _feedable_model(buckets, batch_size, time_major_inputs=time_major_inputs)
+            encoder_inputs, decoder_inputs, target_weights, _ = model.get_train_batch(data_set, bucket_id)
+            start_time = time.time()
+            for _ in xrange(n_iter):
+                feed = model.get_train_feed(encoder_inputs, decoder_inputs, target_weights, bucket_id)
+            results.append((len(feed), 1e6 * (time.time() - start_time) / n_iter))
+        print('%-8s  %10d  %10.2f  %12d  %10.2f' % ('%d-%d' % bucket, results[0][0], results[0][1],
+                                                    results[1][0], results[1][1]))
+
+
+def benchmark_dynamic_graph(buckets=_buckets, batch_size=32, size=128, vocab_size=5000, n_steps=200):
+    """Startup time, graph size and training speed of the bucketed and the dynamic (while loop) graphs.
+
+    Both are NMTModel training graphs on the CPU, trained on the same synthetic batches.
+    """
+    import tensorflow as tf
+    import attention
+    import content_functions
+    from nmt_models import NMTModel
+
+    data_set = _synthetic_bucket_data(buckets, 500, vocab_size=vocab_size)
+    sizes = [float(len(b)) for b in data_set]
+    scale = [sum(sizes[:i + 1]) / sum(sizes) for i in xrange(len(sizes))]
+
+    print('graph      build (s)  graph ops  graph (MB)  steps/s')
+    for dynamic_graph in (False, True):
+        with tf.Graph().as_default() as graph, tf.Session() as sess:
+            start_time = time.time()
+            model = NMTModel(source_vocab_size=vocab_size, target_vocab_size=vocab_size, buckets=buckets,
+                             source_proj_size=size, target_proj_size=size, encoder_size=size, decoder_size=size,
+                             max_gradient_norm=5.0, batch_size=batch_size, learning_rate=1.0,
+                             learning_rate_decay_factor=0.5, attention_f=attention.global_attention,
+                             content_function=content_functions.vinyals_kaiser, num_samples=0, cpu_only=True,
+                             dynamic_graph=dynamic_graph)
+            sess.run(tf.initialize_all_variables())
+            build_time = time.time() - start_time
+            graph_def = graph.as_graph_def()
+
+            random.seed(1234)
+            numpy.random.seed(1234)
+            start_time = time.time()
+            for _ in xrange(n_steps):
+                bucket_id = prefetch_ops.choose_bucket(scale)
+                encoder_inputs, decoder_inputs, target_weights, _ = model.get_train_batch(
+                    data_set, bucket_id, batch_size=batch_size)
+                model.train_step(sess, encoder_inputs, decoder_inputs, target_weights, bucket_id)
+            train_time = time.time() - start_time
+
+        print('%-9s  %9.1f  %9d  %10.1f  %7.2f' % ('dynamic' if dynamic_graph else 'bucketed', build_time,
+                                                   len(graph_def.node), graph_def.ByteSize() / 2.0 ** 20,
+                                                   n_steps / train_time))
+
+
+def _counters_model(batch_size, size=256):
+    """A TranslationModel with the training counters and a tiny update op standing for the training step."""
+    import tensorflow as tf
+
+    model = TranslationModel()
+    model.epoch = tf.Variable(0, trainable=False)
+    model.samples_seen = tf.Variable(0, trainable=False)
+    model.global_step = tf.Variable(0.0, trainable=False)
+    model.current_loss = tf.Variable(0.0, trainable=False)
+    model.avg_loss = tf.Variable(0.0, trainable=False)
+    model.build_counters_sync_op()
+
+    inputs = tf.placeholder(tf.float32, shape=[batch_size, size], name='inputs')
+    weights = tf.Variable(tf.random_normal([size, size], stddev=0.01))
+    model.step_loss = tf.reduce_mean(tf.matmul(inputs, weights))
+    model.update = tf.group(weights.assign_sub(0.001 * weights), model.global_step.assign_add(1.0))
+    model.inputs = inputs
+    return model
+
+
+def benchmark_step_bookkeeping(batch_sizes=(1, 8, 32, 128), n_steps=2000, verbosity=50):
+    """Time per step of the train_nmt counter bookkeeping: per-step session round trips vs host counters.
+
+    The update op is a single small matmul, so the difference is the overhead
+    each training step pays on top of its compute.
+    """
+    import tensorflow as tf
+    from train_ops import TrainingCounters
+
+    print('batch  round trips (ms/step)  host counters (ms/step)  saved')
+    for batch_size in batch_sizes:
+        with tf.Graph().as_default(), tf.Session() as sess:
+            model = _counters_model(batch_size)
+            loss_value = tf.placeholder(tf.float32, shape=[])
+            loss_assign = model.current_loss.assign(loss_value)
+            samples_add = model.samples_seen.assign_add(batch_size)
+            avg_assign = model.avg_loss.assign(tf.div(model.current_loss, model.global_step))
+            sess.run(tf.initialize_all_variables())
+            feed = {model.inputs: numpy.ones((batch_size, model.inputs.get_shape()[1].value), dtype=numpy.float32)}
+
+            # as train_nmt did: the counters are read and assigned around each step
+            start_time = time.time()
+            for _ in xrange(n_steps):
+                model.epoch.eval()
+                step_loss, _ = sess.run([model.step_loss, model.update], feed_dict=feed)
+                current_step = model.global_step.eval()
+                sess.run(loss_assign, feed_dict={loss_value: model.current_loss.eval() + step_loss})
+                sess.run(samples_add)
+                if current_step % verbosity == 0:
+                    sess.run(avg_assign)
+                model.samples_seen.eval()
+            round_trips_time = time.time() - start_time
+
+            # host counters, written back once at the end as before a checkpoint
+            counters = TrainingCounters(sess, model)
+            start_time = time.time()
+            for _ in xrange(n_steps):
+                step_loss, _ = sess.run([model.step_loss, model.update], feed_dict=feed)
+                counters.add_step(step_loss, batch_size)
+            counters.sync(sess)
+            host_time = time.time() - start_time
+
+        round_trips_ms = 1000.0 * round_trips_time / n_steps
+        host_ms = 1000.0 * host_time / n_steps
+        print('%5d  %21.3f  %23.3f  %4.1f%%' % (batch_size, round_trips_ms, host_ms,
+                                               100.0 * (round_trips_ms - host_ms) / round_trips_ms))
+
+
+_BENCHMARKS = {
+    'train_batch': benchmark_train_batch,
+    'bucket_store': benchmark_bucket_store,
+    'binary_corpus': benchmark_binary_corpus,
+    'vocabulary': benchmark_vocabulary,
+    'tokenization': benchmark_tokenization,
+    'vocabulary_load': benchmark_vocabulary_load,
+    'sentence_ids': benchmark_sentence_ids,
+    'bucket_planner': benchmark_bucket_planner,
+    'prefetch': benchmark_prefetch,
+    'train_feed': benchmark_train_feed,
+    'dynamic_graph': benchmark_dynamic_graph,
+    'step_bookkeeping': benchmark_step_bookkeeping,
+}
+
+
+def main(argv):
+    if len(argv) < 2 or argv[1] not in _BENCHMARKS:
+        print('Usage: %s <%s>' % (argv[0], '|'.join(sorted(_BENCHMARKS))))
+        return 1
+    _BENCHMARKS[argv[1]]()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
+import os
 import tensorflow as tf
 from tensorflow.python.platform import gfile
 
 import attention
 import content_functions
 import decoders
+import graph_ops
 import nmt_models
 
 
@@ -48,35 +50,44 @@ def create_seq2seq_model(session, forward_only, model_path=None, use_best=False,
     content_function = content_functions.get_content_f(FLAGS.content_function)
     decoder_attention_f = content_functions.get_decoder_content_f(FLAGS.output_attention)
 
-    model = nmt_models.Seq2SeqModel(source_vocab_size=FLAGS.src_vocab_size,
-                                    target_vocab_size=FLAGS.tgt_vocab_size,
-                                    buckets=buckets,
-                                    source_proj_size=FLAGS.proj_size,
-                                    target_proj_size=FLAGS.proj_size,
-                                    encoder_size=FLAGS.hidden_size,
-                                    decoder_size=FLAGS.hidden_size,
-                                    num_layers_encoder=FLAGS.num_layers,
-                                    num_layers_decoder=FLAGS.num_layers,
-                                    max_gradient_norm=FLAGS.max_gradient_norm,
-                                    batch_size=batch,
-                                    learning_rate=FLAGS.learning_rate,
-                                    learning_rate_decay_factor=FLAGS.learning_rate_decay_factor,
-                                    decoder=decoder,
-                                    optimizer=FLAGS.optimizer,
-                                    use_lstm=FLAGS.use_lstm,
-                                    input_feeding=FLAGS.input_feeding,
-                                    dropout=dropout_rate,
-                                    attention_f=attention_f,
-                                    window_size=FLAGS.window_size,
-                                    content_function=content_function,
-                                    decoder_attention_f=decoder_attention_f,
-                                    num_samples=FLAGS.num_samples_loss,
-                                    forward_only=forward_only,
-                                    max_len=FLAGS.max_len,
-                                    cpu_only=FLAGS.cpu_only,
-                                    early_stop_patience=FLAGS.early_stop_patience,
-                                    save_best_model=FLAGS.save_best_model,
-                                    log_tensorboard=FLAGS.log_tensorboard)
+    model_args = dict(source_vocab_size=FLAGS.src_vocab_size,
+                      target_vocab_size=FLAGS.tgt_vocab_size,
+                      buckets=buckets,
+                      source_proj_size=FLAGS.proj_size,
+                      target_proj_size=FLAGS.proj_size,
+                      encoder_size=FLAGS.hidden_size,
+                      decoder_size=FLAGS.hidden_size,
+                      num_layers_encoder=FLAGS.num_layers,
+                      num_layers_decoder=FLAGS.num_layers,
+                      max_gradient_norm=FLAGS.max_gradient_norm,
+                      batch_size=batch,
+                      learning_rate=FLAGS.learning_rate,
+                      learning_rate_decay_factor=FLAGS.learning_rate_decay_factor,
+                      decoder=decoder,
+                      optimizer=FLAGS.optimizer,
+                      use_lstm=FLAGS.use_lstm,
+                      input_feeding=FLAGS.input_feeding,
+                      dropout=dropout_rate,
+                      attention_f=attention_f,
+                      window_size=FLAGS.window_size,
+                      content_function=content_function,
+                      decoder_attention_f=decoder_attention_f,
+                      num_samples=FLAGS.num_samples_loss,
+                      forward_only=forward_only,
+                      max_len=FLAGS.max_len,
+                      cpu_only=FLAGS.cpu_only,
+                      early_stop_patience=FLAGS.early_stop_patience,
+                      save_best_model=FLAGS.save_best_model,
+                      log_tensorboard=FLAGS.log_tensorboard,
+                      time_major_inputs=FLAGS.time_major_inputs,
+                      dynamic_graph=FLAGS.dynamic_graph,
+                      graph_beam_size=FLAGS.beam_size if forward_only and FLAGS.graph_beam_search else 0)
+
+    if FLAGS.graph_cache:
+        model = graph_ops.cached_model(nmt_models.Seq2SeqModel, model_args,
+                                       os.path.join(FLAGS.train_dir, graph_ops.GRAPH_CACHE_DIR))
+    else:
+        model = nmt_models.Seq2SeqModel(**model_args)
 
     if model_path is None:
 
@@ -129,30 +140,39 @@ def create_nmt_model(session, forward_only, model_path=None, use_best=False, FLA
     content_function = content_functions.get_content_f(FLAGS.content_function)
     decoder_attention_f = content_functions.get_decoder_content_f(FLAGS.output_attention)
 
-    model = nmt_models.NMTModel(source_vocab_size=FLAGS.src_vocab_size,
-                                target_vocab_size=FLAGS.tgt_vocab_size,
-                                buckets=buckets,
-                                source_proj_size=FLAGS.proj_size,
-                                target_proj_size=FLAGS.proj_size,
-                                encoder_size=FLAGS.hidden_size,
-                                decoder_size=FLAGS.hidden_size,
-                                max_gradient_norm=FLAGS.max_gradient_norm,
-                                batch_size=batch,
-                                learning_rate=FLAGS.learning_rate,
-                                learning_rate_decay_factor=FLAGS.learning_rate_decay_factor,
-                                optimizer=FLAGS.optimizer,
-                                input_feeding=FLAGS.input_feeding,
-                                dropout=dropout_rate,
-                                attention_f=attention_f,
-                                window_size=FLAGS.window_size,
-                                content_function=content_function,
-                                decoder_attention_f=decoder_attention_f,
-                                num_samples=FLAGS.num_samples_loss,
-                                forward_only=forward_only,
-                                max_len=FLAGS.max_len,
-                                cpu_only=FLAGS.cpu_only,
-                                early_stop_patience=FLAGS.early_stop_patience,
-                                save_best_model=FLAGS.save_best_model)
+    model_args = dict(source_vocab_size=FLAGS.src_vocab_size,
+                      target_vocab_size=FLAGS.tgt_vocab_size,
+                      buckets=buckets,
+                      source_proj_size=FLAGS.proj_size,
+                      target_proj_size=FLAGS.proj_size,
+                      encoder_size=FLAGS.hidden_size,
+                      decoder_size=FLAGS.hidden_size,
+                      max_gradient_norm=FLAGS.max_gradient_norm,
+                      batch_size=batch,
+                      learning_rate=FLAGS.learning_rate,
+                      learning_rate_decay_factor=FLAGS.learning_rate_decay_factor,
+                      optimizer=FLAGS.optimizer,
+                      input_feeding=FLAGS.input_feeding,
+                      dropout=dropout_rate,
+                      attention_f=attention_f,
+                      window_size=FLAGS.window_size,
+                      content_function=content_function,
+                      decoder_attention_f=decoder_attention_f,
+                      num_samples=FLAGS.num_samples_loss,
+                      forward_only=forward_only,
+                      max_len=FLAGS.max_len,
+                      cpu_only=FLAGS.cpu_only,
+                      early_stop_patience=FLAGS.early_stop_patience,
+                      save_best_model=FLAGS.save_best_model,
+                      time_major_inputs=FLAGS.time_major_inputs,
+                      dynamic_graph=FLAGS.dynamic_graph,
+                      graph_beam_size=FLAGS.beam_size if forward_only and FLAGS.graph_beam_search else 0)
+
+    if FLAGS.graph_cache:
+        model = graph_ops.cached_model(nmt_models.NMTModel, model_args,
+                                       os.path.join(FLAGS.train_dir, graph_ops.GRAPH_CACHE_DIR))
+    else:
+        model = nmt_models.NMTModel(**model_args)
 
     if model_path is None:
 
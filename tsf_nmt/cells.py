@@ -4,6 +4,8 @@ from tensorflow.models.rnn import rnn_cell
 from tensorflow.models.rnn import rnn
 from tensorflow.models.rnn.rnn_cell import RNNCell
 from tensorflow.python.ops import array_ops
+from tensorflow.python.ops import control_flow_ops
+from tensorflow.python.ops import embedding_ops
 from tensorflow.python.ops import init_ops
 from tensorflow.python.ops import math_ops
 from tensorflow.python.ops import nn_ops
@@ -215,6 +217,75 @@ def linear(args, output_size, bias, bias_start=0.0, initializer=None, scope=None
     return res + bias_term
 
 
+def embed_inputs(embedding, inputs):
+    """Embed a sequence of token ids, one Tensor per time step.
+
+    Args:
+      embedding: a [vocabulary x size] embedding matrix.
+      inputs: a list of 1D, batch-sized, int Tensors, or a single [time x batch]
+        int Tensor with a known number of time steps; the latter is embedded with
+        one gather and then split into time steps in-graph.
+
+    Returns:
+      A list of 2D, [batch x size], Tensors, one per time step.
+    """
+    if isinstance(inputs, (list, tuple)):
+        return [embedding_ops.embedding_lookup(embedding, i) for i in inputs]
+
+    n_steps = inputs.get_shape()[0].value
+    return array_ops.unpack(embed_sequence(embedding, inputs), num=n_steps)
+
+
+def embed_sequence(embedding, inputs):
+    """Embed a [time x batch] int Tensor with one gather, into a [time x batch x size] Tensor."""
+    return embedding_ops.embedding_lookup(embedding, inputs)
+
+
+def dynamic_rnn(cell, inputs, initial_state, scope=None):
+    """Run a RNN over a sequence of unknown length with a while loop.
+
+    Unlike rnn.rnn, the graph holds a single copy of the cell, whatever the
+    number of time steps fed; the variables are the ones rnn.rnn creates with
+    the same cell and scope.
+
+    Args:
+      cell: An instance of RNNCell.
+      inputs: a [time x batch x cell.input_size] Tensor; time may be unknown.
+      initial_state: a [batch x cell.state_size] Tensor.
+      scope: VariableScope for the created subgraph; defaults to "RNN".
+
+    Returns:
+      A pair (outputs, state): outputs is a [time x batch x cell.output_size]
+      Tensor, state is the final state.
+    """
+    # imported here, so that the module works with older TensorFlow versions, without TensorArray
+    from tensorflow.python.ops import tensor_array_ops
+
+    n_steps = array_ops.shape(inputs)[0]
+    input_size = inputs.get_shape()[2].value
+
+    inputs_ta = tensor_array_ops.TensorArray(dtype=inputs.dtype, size=n_steps).unpack(inputs)
+    outputs_ta = tensor_array_ops.TensorArray(dtype=inputs.dtype, size=n_steps)
+
+    with vs.variable_scope(scope or "RNN"):
+
+        def step(time, state, outputs_ta):
+            input_ = inputs_ta.read(time)
+            input_.set_shape([None, input_size])
+            output, new_state = cell(input_, state)
+            return time + 1, new_state, outputs_ta.write(time, output)
+
+        _, state, outputs_ta = control_flow_ops.while_loop(
+            lambda time, state, outputs_ta: time < n_steps, step,
+            [array_ops.constant(0), initial_state, outputs_ta])
+
+    # the packed outputs have no static shape
+    outputs = outputs_ta.pack()
+    outputs.set_shape([None, None, cell.output_size])
+
+    return outputs, state
+
+
 def bidirectional_rnn(cell_fw, cell_bw, inputs,
                       initial_state_fw=None, initial_state_bw=None,
                       dtype=None, sequence_length=None, scope=None):
@@ -279,6 +350,40 @@ def bidirectional_rnn(cell_fw, cell_bw, inputs,
     return (outputs, output_state_fw, output_state_bw)
 
 
+def dynamic_bidirectional_rnn(cell_fw, cell_bw, inputs, dtype, scope=None):
+    """Same as bidirectional_rnn, over a sequence of unknown length (see dynamic_rnn).
+
+    Args:
+      cell_fw: An instance of RNNCell, to be used for forward direction.
+      cell_bw: An instance of RNNCell, to be used for backward direction.
+      inputs: a [time x batch x cell.input_size] Tensor; time may be unknown.
+      dtype: The data type for the initial states.
+      scope: VariableScope for the created subgraph; defaults to "BiRNN"
+
+    Returns:
+      A tuple (outputs, output_state_fw, output_state_bw) where outputs is a
+      [time x batch x (cell_fw.output_size + cell_bw.output_size)] Tensor.
+    """
+    batch_size = array_ops.shape(inputs)[1]
+
+    name = scope or "BiRNN"
+    # Forward direction
+    with vs.variable_scope(name + "_FW") as fw_scope:
+        output_fw, output_state_fw = dynamic_rnn(cell_fw, inputs, cell_fw.zero_state(batch_size, dtype),
+                                                 scope=fw_scope)
+
+    # Backward direction
+    with vs.variable_scope(name + "_BW") as bw_scope:
+        tmp, output_state_bw = dynamic_rnn(cell_bw, array_ops.reverse(inputs, [True, False, False]),
+                                           cell_bw.zero_state(batch_size, dtype), scope=bw_scope)
+    output_bw = array_ops.reverse(tmp, [True, False, False])
+
+    # Concat the forward/backward outputs of each time step
+    outputs = array_ops.concat(2, [output_fw, output_bw])
+
+    return outputs, output_state_fw, output_state_bw
+
+
 def build_nmt_multicell_rnn(num_layers_encoder, num_layers_decoder, encoder_size, decoder_size,
                             source_proj_size, use_lstm=True, input_feeding=True,
                             dropout=0.0):
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+    Checkpoints written in a background thread, so training does not stall
+    while the variables are written to disk.
+"""
+from __future__ import print_function
+import os
+import sys
+import threading
+import traceback
+import tensorflow as tf
+from tensorflow.python.platform import gfile
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# name of the state file read by tf.train.get_checkpoint_state
+CHECKPOINT_STATE = 'checkpoint'
+
+
+def _remove_checkpoint(checkpoint_path):
+    """Remove the files of a checkpoint (e.g. model-100, model-100.meta, but not model-1000)."""
+    for path in gfile.Glob(checkpoint_path) + gfile.Glob(checkpoint_path + '.*'):
+        gfile.Remove(path)
+
+
+def _write_checkpoint_state(save_dir, checkpoint_paths):
+    """Write the checkpoint state file of save_dir atomically; the last path is the latest checkpoint."""
+    state = tf.train.generate_checkpoint_state_proto(save_dir, checkpoint_paths[-1],
+                                                     all_model_checkpoint_paths=checkpoint_paths)
+    state_path = os.path.join(save_dir, CHECKPOINT_STATE)
+    tmp_path = '%s.%d.tmp' % (state_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(str(state))
+    os.rename(tmp_path, state_path)
+
+
+class AsyncCheckpointWriter(object):
+    """
+    Save the variables of a model without stopping training for the write.
+
+    save() copies the values of all the variables to the host with a single
+    session.run, and returns; a background thread then loads the copy into a
+    private graph holding the same variables (same names, hence compatible
+    with the Saver of the model) and writes it with tf.train.Saver.
+
+    In each directory, only the max_checkpoints latest checkpoints written by
+    the writer are kept, and the checkpoint state file is replaced atomically
+    after each write, so get_checkpoint_state never sees a partial state.
+
+    At most one snapshot waits for the writer thread: save() blocks when
+    another one is already waiting, which bounds the host memory to two
+    copies of the variables.
+    """
+
+    def __init__(self, var_list=None, max_checkpoints=5):
+        """
+        Args:
+          var_list: the variables to save (all the variables of the default graph by default).
+          max_checkpoints: number of checkpoints kept in each directory.
+        """
+        if var_list is None:
+            var_list = tf.all_variables()
+        self.var_list = var_list
+        self.max_checkpoints = max_checkpoints
+
+        # private graph: one variable per variable to save, initialized with the snapshot
+        self._graph = tf.Graph()
+        with self._graph.as_default(), tf.device('/cpu:0'):
+            self._placeholders = []
+            save_vars = {}
+            for var in var_list:
+                placeholder = tf.placeholder(var.dtype.base_dtype, shape=var.get_shape())
+                self._placeholders.append(placeholder)
+                save_vars[var.op.name] = tf.Variable(placeholder, trainable=False, collections=[])
+            self._load_op = tf.group(*[v.initializer for v in save_vars.values()])
+            # the old checkpoints are removed by the writer (max_to_keep=0 disables it in Saver)
+            self._saver = tf.train.Saver(save_vars, max_to_keep=0)
+        self._session = tf.Session(graph=self._graph, config=tf.ConfigProto(device_count={'GPU': 0}))
+
+        self._checkpoints = {}
+        self._queue = queue.Queue(maxsize=1)
+        self._error = None
+        self._thread = threading.Thread(target=self._write, name='AsyncCheckpointWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _retained_checkpoints(self, save_dir):
+        """The checkpoints of save_dir, oldest first, read from its state file the first time."""
+        if save_dir not in self._checkpoints:
+            state = tf.train.get_checkpoint_state(save_dir)
+            self._checkpoints[save_dir] = list(state.all_model_checkpoint_paths) if state else []
+        return self._checkpoints[save_dir]
+
+    def _write(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                if self._error is not None:
+                    continue
+                save_path, step, values = job
+
+                self._session.run(self._load_op, feed_dict=dict(zip(self._placeholders, values)))
+                checkpoint_path = self._saver.save(self._session, save_path, global_step=step,
+                                                   latest_filename='.%s.writer' % CHECKPOINT_STATE,
+                                                   write_meta_graph=False)
+
+                save_dir = os.path.dirname(checkpoint_path)
+                checkpoints = self._retained_checkpoints(save_dir)
+                if checkpoint_path in checkpoints:
+                    checkpoints.remove(checkpoint_path)
+                checkpoints.append(checkpoint_path)
+                while len(checkpoints) > self.max_checkpoints:
+                    _remove_checkpoint(checkpoints.pop(0))
+                _write_checkpoint_state(save_dir, checkpoints)
+            except Exception:
+                self._error = sys.exc_info()
+            finally:
+                self._queue.task_done()
+
+    def _check_error(self):
+        if self._error is not None:
+            traceback.print_exception(*self._error)
+            raise RuntimeError('The checkpoint writer failed.')
+
+    def save(self, session, save_path, global_step=None):
+        """Snapshot the variables and write them to save_path-<global_step> in background.
+
+        Args:
+          session: the session holding the variables.
+          save_path: path prefix of the checkpoint, as for tf.train.Saver.save.
+          global_step: number (or variable, fetched in the same session.run as the
+            snapshot) appended to save_path.
+
+        Raises:
+          RuntimeError: if a previous write failed; the original error is printed.
+        """
+        self._check_error()
+        if isinstance(global_step, (tf.Variable, tf.Tensor)):
+            values = session.run(self.var_list + [global_step])
+            global_step = int(values.pop())
+        else:
+            values = session.run(self.var_list)
+        self._queue.put((save_path, global_step, values))
+
+    def wait(self):
+        """Wait until all the checkpoints requested are written."""
+        self._queue.join()
+        self._check_error()
+
+    def close(self):
+        """Write the pending checkpoints and stop the writer thread."""
+        self._queue.join()
+        self._queue.put(None)
+        self._thread.join()
+        self._session.close()
+        self._check_error()
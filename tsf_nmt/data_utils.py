@@ -1,10 +1,19 @@
 # -*- coding: utf-8 -*-
 """Utilities for downloading data from WMT, tokenizing, vocabularies."""
 from __future__ import print_function
+import array
 import collections
+import hashlib
+import heapq
+import inspect
+import itertools
+import json
+import marshal
+import multiprocessing
 import os
 import re
 import sys
+import numpy
 from tensorflow.python.platform import gfile
 
 # Special vocabulary symbols - we always put them at the start.
@@ -21,6 +30,89 @@ UNK_ID = 3
 
 _DIGIT_RE = re.compile(r'\d')
 
+# translation table replacing every ASCII digit by 0, which is what _DIGIT_RE
+# matches in byte strings
+_DIGIT_TABLE = bytes(bytearray([ord('0') if ord('0') <= c <= ord('9') else c for c in range(256)]))
+
+# suffix of the marshalled copy of a vocabulary, see initialize_vocabulary
+VOCABULARY_SIDECAR = '.marshal'
+
+# Suffixes of the files of a binary token-id corpus (see write_binary_corpus).
+BINARY_TOKENS = '.tokens'
+BINARY_INDEX = '.index'
+BINARY_HEADER = '.header'
+_BINARY_FORMAT = 'tsf_nmt-token-ids'
+_BINARY_VERSION = 1
+
+
+def token_positions(lengths):
+    """Map every token of flat, concatenated sequences to its (sequence index, position) pair.
+
+    Args:
+      lengths: 1D int array with the length of each sequence.
+
+    Returns:
+      A pair of 1D int arrays of size sum(lengths): the index of the sequence each
+      token belongs to and the position of the token inside that sequence.
+    """
+    seq_idx = numpy.repeat(numpy.arange(len(lengths)), lengths)
+    starts = numpy.cumsum(lengths) - lengths
+    positions = numpy.arange(len(seq_idx)) - numpy.repeat(starts, lengths)
+    return seq_idx, positions
+
+
+class TokenBucket(object):
+    """A bucket of (source, target) token-id pairs kept in contiguous int32 arrays.
+
+    The tokens of every sentence of a data set are concatenated in two flat arrays
+    (one per language) shared by all buckets; each bucket only keeps the offsets and
+    lengths of its own sentences. Targets are stored without the EOS symbol, which is
+    appended when a batch is gathered.
+    """
+
+    def __init__(self, source, source_offsets, source_lengths, target, target_offsets, target_lengths):
+        self.source = source
+        self.source_offsets = source_offsets
+        self.source_lengths = source_lengths
+        self.target = target
+        self.target_offsets = target_offsets
+        self.target_lengths = target_lengths
+
+    def __len__(self):
+        return len(self.source_lengths)
+
+    @property
+    def nbytes(self):
+        """Bytes used by the index of this bucket (the shared token arrays are not included)."""
+        return (self.source_offsets.nbytes + self.source_lengths.nbytes +
+                self.target_offsets.nbytes + self.target_lengths.nbytes)
+
+    def gather(self, indices):
+        """Gather the pairs at the given positions of the bucket with fancy indexing.
+
+        Args:
+          indices: 1D int array with positions in [0, len(self)).
+
+        Returns:
+          A tuple (source, source_lengths, target, target_lengths) where source and
+          target are flat int32 arrays with the concatenated sequences; each target
+          sequence ends with EOS_ID, which is included in target_lengths.
+        """
+        source_lengths = self.source_lengths[indices]
+        _, positions = token_positions(source_lengths)
+        source = self.source[numpy.repeat(self.source_offsets[indices], source_lengths) + positions]
+
+        lengths = self.target_lengths[indices]
+        target_lengths = lengths + 1
+        seq_idx, positions = token_positions(target_lengths)
+        target = numpy.empty(len(positions), dtype=numpy.int32)
+        is_token = positions < lengths[seq_idx]
+        target[~is_token] = EOS_ID
+        target[is_token] = self.target[numpy.repeat(self.target_offsets[indices], lengths) +
+                                       positions[is_token]]
+
+        return source, source_lengths, target, target_lengths
+
 
 def basic_tokenizer(sentence):
     """Very basic tokenizer: split the sentence into a list of tokens."""
@@ -31,7 +123,7 @@ def basic_tokenizer(sentence):
 
 
 def create_vocabulary(vocabulary_path, data_path, max_vocabulary_size,
-                      normalize_digits=True):
+                      normalize_digits=True, num_workers=1):
     """
     Create vocabulary file (if it does not exist yet) from data file.
 
@@ -41,34 +133,131 @@ def create_vocabulary(vocabulary_path, data_path, max_vocabulary_size,
     We write it to vocabulary_path in a one-token-per-line format, so that later
     token in the first line gets id=0, second line gets id=1, and so on.
 
+    With num_workers > 1 the data file is split into line-aligned byte ranges
+    that are counted by a pool of processes; the counts are merged in file
+    order, so the vocabulary (including the order of tokens with the same
+    count) is identical to the one created by a single process.
+
     Args:
       vocabulary_path: path where the vocabulary will be created.
       data_path: data file that will be used to create vocabulary.
       max_vocabulary_size: limit on the size of the created vocabulary.
       normalize_digits: Boolean; if true, all digits are replaced by 0s.
+      num_workers: number of processes used to count the tokens.
     """
     if not gfile.Exists(vocabulary_path):
         print('Creating vocabulary %s from data %s' % (vocabulary_path, data_path))
-        vocab = {}
-        with gfile.GFile(data_path, mode='r') as f:
-            counter = 0
-            for line in f:
-                counter += 1
-                if counter % 10000 == 0:
-                    print("  processing line %d" % counter)
-                tokens = basic_tokenizer(line)
-                for w in tokens:
-                    word = re.sub(_DIGIT_RE, '0', w) if normalize_digits else w
-                    if word in vocab:
-                        vocab[word] += 1
-                    else:
-                        vocab[word] = 1
-            vocab_list = _START_VOCAB + sorted(vocab, key=vocab.get, reverse=True)
-            if len(vocab_list) > max_vocabulary_size:
-                vocab_list = vocab_list[:max_vocabulary_size]
-            with gfile.GFile(vocabulary_path, mode='w') as vocab_file:
-                for w in vocab_list:
-                    vocab_file.write(w + '\n')
+        if num_workers > 1:
+            vocab = _count_tokens_parallel(data_path, normalize_digits, num_workers)
+        else:
+            vocab = {}
+            with gfile.GFile(data_path, mode='r') as f:
+                counter = 0
+                for line in f:
+                    counter += 1
+                    if counter % 10000 == 0:
+                        print("  processing line %d" % counter)
+                    tokens = basic_tokenizer(line)
+                    for w in tokens:
+                        word = re.sub(_DIGIT_RE, '0', w) if normalize_digits else w
+                        if word in vocab:
+                            vocab[word] += 1
+                        else:
+                            vocab[word] = 1
+        # nlargest is stable, like sorting by decreasing count: ties keep the dict order
+        n_words = max(max_vocabulary_size - len(_START_VOCAB), 0)
+        vocab_list = _START_VOCAB + heapq.nlargest(n_words, vocab, key=vocab.get)
+        if len(vocab_list) > max_vocabulary_size:
+            vocab_list = vocab_list[:max_vocabulary_size]
+        with gfile.GFile(vocabulary_path, mode='w') as vocab_file:
+            for w in vocab_list:
+                vocab_file.write(w + '\n')
+        rev_vocab = [w.strip() for w in vocab_list]
+        _write_vocabulary_sidecar(vocabulary_path, dict([(x, y) for (y, x) in enumerate(rev_vocab)]), rev_vocab)
+
+
+def line_aligned_chunks(path, n_chunks):
+    """
+    Split a file into at most n_chunks byte ranges that start and end on line boundaries.
+
+    Returns:
+      a list of (start, end) byte offsets covering the whole file.
+    """
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as f:
+        for i in xrange(1, n_chunks):
+            # the first line starting at or after the split point
+            f.seek(max(size * i // n_chunks - 1, bounds[-1]))
+            f.readline()
+            position = f.tell()
+            if position >= size:
+                break
+            if position > bounds[-1]:
+                bounds.append(position)
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+
+def _read_chunk_lines(path, start, end):
+    """Yield the lines of a file between two line-aligned byte offsets."""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        position = start
+        while position < end:
+            line = f.readline()
+            if not line:
+                break
+            position += len(line)
+            if not isinstance(line, str):
+                line = line.decode('utf-8')
+            yield line
+
+
+def _count_chunk_tokens(args):
+    """
+    Count the tokens of a byte range of a data file (run in a worker process).
+
+    Returns:
+      a list of (token, count) pairs, in order of first occurrence in the range.
+    """
+    data_path, start, end, normalize_digits = args
+    counts = {}
+    order = []
+    for line in _read_chunk_lines(data_path, start, end):
+        if normalize_digits:
+            # digits are never whitespace, so the whole line can be normalized at once
+            line = normalize_digits_line(line)
+        for word in basic_tokenizer(line):
+            if word in counts:
+                counts[word] += 1
+            else:
+                counts[word] = 1
+                order.append(word)
+    return [(word, counts[word]) for word in order]
+
+
+def _count_tokens_parallel(data_path, normalize_digits, num_workers):
+    """
+    Count the tokens of a data file with a pool of processes.
+
+    Chunks are merged in file order, so tokens are inserted in the resulting
+    Counter in the same order a single pass over the file would insert them.
+    """
+    chunks = line_aligned_chunks(data_path, num_workers * 4)
+    tasks = [(data_path, start, end, normalize_digits) for start, end in chunks]
+
+    vocab = collections.Counter()
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        for i, chunk_counts in enumerate(pool.imap(_count_chunk_tokens, tasks)):
+            for word, count in chunk_counts:
+                vocab[word] += count
+            print("  counted chunk %d of %d" % (i + 1, len(tasks)))
+    finally:
+        pool.close()
+        pool.join()
+    return vocab
 
 
 def initialize_vocabulary(vocabulary_path):
@@ -81,6 +270,11 @@ def initialize_vocabulary(vocabulary_path):
     will result in a vocabulary {'dog': 0, 'cat': 1}, and this function will
     also return the reversed-vocabulary ['dog', 'cat'].
 
+    Both are loaded from the marshalled sidecar (vocabulary_path + '.marshal')
+    when it matches the size and modification time of the vocabulary file and
+    the running Python version; if the sidecar is missing or stale, the text
+    file is read and the sidecar is written again.
+
     Args:
       vocabulary_path: path to the file containing the vocabulary.
 
@@ -92,16 +286,65 @@ def initialize_vocabulary(vocabulary_path):
       ValueError: if the provided vocabulary_path does not exist.
     """
     if gfile.Exists(vocabulary_path):
+        cached = _read_vocabulary_sidecar(vocabulary_path)
+        if cached is not None:
+            return cached
         rev_vocab = []
         with gfile.GFile(vocabulary_path, mode='r') as f:
             rev_vocab.extend(f.readlines())
         rev_vocab = [line.strip() for line in rev_vocab]
         vocab = dict([(x, y) for (y, x) in enumerate(rev_vocab)])
+        _write_vocabulary_sidecar(vocabulary_path, vocab, rev_vocab)
         return vocab, rev_vocab
     else:
         raise ValueError('Vocabulary file %s not found.', vocabulary_path)
 
 
+def _file_version(path):
+    """
+    Size and modification time of a local file, or None if it is not a local file.
+
+    The Python version is included too, since the marshal format depends on it.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return sys.version_info[0], sys.version_info[1], stat.st_size, stat.st_mtime
+
+
+def _read_vocabulary_sidecar(vocabulary_path):
+    """Load (vocab, rev_vocab) from the sidecar of a vocabulary, or None if it is missing or stale."""
+    version = _file_version(vocabulary_path)
+    if version is None or not os.path.exists(vocabulary_path + VOCABULARY_SIDECAR):
+        return None
+    try:
+        with open(vocabulary_path + VOCABULARY_SIDECAR, 'rb') as f:
+            sidecar_version, vocab, rev_vocab = marshal.load(f)
+    except Exception:
+        # a truncated or incompatible sidecar is simply ignored
+        return None
+    if sidecar_version != version:
+        return None
+    return vocab, rev_vocab
+
+
+def _write_vocabulary_sidecar(vocabulary_path, vocab, rev_vocab):
+    """Marshal (vocab, rev_vocab) next to a local vocabulary file, atomically."""
+    version = _file_version(vocabulary_path)
+    if version is None:
+        return
+    tmp_path = '%s%s.%d.tmp' % (vocabulary_path, VOCABULARY_SIDECAR, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            marshal.dump((version, vocab, rev_vocab), f)
+        os.rename(tmp_path, vocabulary_path + VOCABULARY_SIDECAR)
+    except (IOError, OSError):
+        # e.g. a read-only data directory: keep reading the text file
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
 def sentence_to_token_ids(sentence, vocabulary,
                           normalize_digits=True):
     """
@@ -126,14 +369,46 @@ def sentence_to_token_ids(sentence, vocabulary,
     return [vocabulary.get(re.sub(_DIGIT_RE, '0', w), UNK_ID) for w in words]
 
 
+def normalize_digits_line(line):
+    """Replace every digit of a line by 0, as re.sub(_DIGIT_RE, '0', w) does word by word."""
+    if isinstance(line, bytes):
+        return line.translate(_DIGIT_TABLE)
+    # unicode lines: \d also matches non-ASCII digits
+    return _DIGIT_RE.sub('0', line)
+
+
+def sentences_to_token_ids(sentences, vocabulary, normalize_digits=True):
+    """
+    Convert a batch of strings to lists of token-ids.
+
+    Returns exactly what sentence_to_token_ids returns for each sentence, but
+    digits are normalized once per sentence instead of once per word (digits
+    are never whitespace, so this does not change the tokens).
+
+    Args:
+      sentences: a list of strings, the sentences to convert to token-ids.
+      vocabulary: a dictionary mapping tokens to integers.
+      normalize_digits: Boolean; if true, all digits are replaced by 0s.
+
+    Returns:
+      a list with the list of token-ids of each sentence.
+    """
+    get = vocabulary.get
+    if normalize_digits:
+        sentences = [normalize_digits_line(sentence) for sentence in sentences]
+    # str.split() with no arguments already drops the empty tokens, like basic_tokenizer
+    return [[get(w, UNK_ID) for w in sentence.split()] for sentence in sentences]
+
+
 def data_to_token_ids(data_path, target_path, vocabulary_path,
-                      tokenizer=None, normalize_digits=True):
+                      tokenizer=None, normalize_digits=True, binary=False, num_workers=1):
     """
     Tokenize data file and turn into token-ids using given vocabulary file.
 
     This function loads data line-by-line from data_path, calls the above
-    sentence_to_token_ids, and saves the result to target_path. See comment
-    for sentence_to_token_ids on the details of token-ids format.
+    sentences_to_token_ids on batches of lines, and saves the result to
+    target_path. See comment for sentence_to_token_ids on the details of
+    token-ids format.
 
     Args:
       data_path: path to the data file in one-sentence-per-line format.
@@ -142,19 +417,340 @@ def data_to_token_ids(data_path, target_path, vocabulary_path,
       tokenizer: a function to use to tokenize each sentence;
         if None, basic_tokenizer will be used.
       normalize_digits: Boolean; if true, all digits are replaced by 0s.
+      binary: Boolean; if true, the token-ids are saved as a binary corpus
+        (see write_binary_corpus) instead of a text file.
+      num_workers: number of processes used to tokenize the data file
+        (see tokenize_files_parallel).
     """
-    if not gfile.Exists(target_path):
+    if num_workers > 1:
+        tokenize_files_parallel([(data_path, target_path, vocabulary_path)],
+                                normalize_digits=normalize_digits, binary=binary,
+                                num_workers=num_workers)
+    elif not token_ids_exist(target_path, vocabulary_path, binary):
         print('Tokenizing data in %s' % data_path)
         vocab, _ = initialize_vocabulary(vocabulary_path)
         with gfile.GFile(data_path, mode='r') as data_file:
-            with gfile.GFile(target_path, mode='w') as tokens_file:
-                counter = 0
-                for line in data_file:
-                    counter += 1
-                    if counter % 10000 == 0:
-                        print("  tokenizing line %d" % counter)
-                    token_ids = sentence_to_token_ids(line, vocab, normalize_digits)
-                    tokens_file.write(' '.join([str(tok) for tok in token_ids]) + '\n')
+            token_ids = _tokenize_lines(data_file, vocab, normalize_digits)
+            if binary:
+                write_binary_corpus(target_path, token_ids, vocabulary_path)
+            else:
+                with gfile.GFile(target_path, mode='w') as tokens_file:
+                    for ids in token_ids:
+                        tokens_file.write(' '.join([str(tok) for tok in ids]) + '\n')
+
+
+def token_ids_exist(target_path, vocabulary_path, binary=False):
+    """Whether the token-ids of a data file have already been created."""
+    if binary:
+        # a binary corpus also records the vocabulary it was created with
+        try:
+            open_binary_corpus(target_path, vocabulary_path)
+        except ValueError:
+            return False
+        return True
+    return gfile.Exists(target_path)
+
+
+def _tokenize_lines(data_file, vocab, normalize_digits, batch_lines=10000):
+    """Yield the token-ids of each line of data_file, printing the progress."""
+    counter = 0
+    batch = []
+    for line in data_file:
+        batch.append(line)
+        if len(batch) == batch_lines:
+            counter += len(batch)
+            print("  tokenizing line %d" % counter)
+            for ids in sentences_to_token_ids(batch, vocab, normalize_digits):
+                yield ids
+            batch = []
+    for ids in sentences_to_token_ids(batch, vocab, normalize_digits):
+        yield ids
+
+
+# vocabularies loaded by each tokenization worker process, by path
+_worker_vocabularies = {}
+
+
+def _tokenize_chunk(args):
+    """
+    Turn a byte range of a data file into token-ids (run in a worker process).
+
+    The vocabulary is read once per worker and kept for the following chunks.
+
+    Returns:
+      the token-ids formatted as text lines if text is True, otherwise a pair
+      of int32 arrays (concatenated token-ids, sentence lengths).
+    """
+    data_path, start, end, vocabulary_path, normalize_digits, text = args
+    if vocabulary_path not in _worker_vocabularies:
+        _worker_vocabularies[vocabulary_path], _ = initialize_vocabulary(vocabulary_path)
+    vocab = _worker_vocabularies[vocabulary_path]
+
+    token_ids = sentences_to_token_ids(list(_read_chunk_lines(data_path, start, end)), vocab, normalize_digits)
+
+    if text:
+        return ''.join([' '.join([str(tok) for tok in ids]) + '\n' for ids in token_ids])
+
+    tokens = array.array('i')
+    lengths = array.array('i')
+    for ids in token_ids:
+        tokens.extend(ids)
+        lengths.append(len(ids))
+    return tokens, lengths
+
+
+def tokenize_files_parallel(jobs, normalize_digits=True, binary=False, num_workers=2, chunks_per_worker=4):
+    """
+    Run data_to_token_ids on several data files with one pool of processes.
+
+    Every data file is split into line-aligned chunks, which are tokenized in
+    the order they are written, file after file. At most two chunks per process
+    are queued or waiting to be written at any time, so the chunks of the next
+    file start while the end of a file is tokenized, but the tokenized files are
+    never held in memory. Files whose token-ids already exist are skipped.
+
+    Args:
+      jobs: a list of (data_path, target_path, vocabulary_path) tuples.
+      normalize_digits: Boolean; if true, all digits are replaced by 0s.
+      binary: Boolean; if true, the token-ids are saved as binary corpora.
+      num_workers: number of processes.
+      chunks_per_worker: number of chunks each data file is split into, per process.
+    """
+    jobs = [job for job in jobs if not token_ids_exist(job[1], job[2], binary)]
+    if not jobs:
+        return
+
+    # the chunks of each file, in the order they are written
+    file_chunks = [[(data_path, start, end, vocabulary_path, normalize_digits, not binary)
+                    for start, end in line_aligned_chunks(data_path, num_workers * chunks_per_worker)]
+                   for data_path, _, vocabulary_path in jobs]
+    queued_chunks = itertools.chain.from_iterable(file_chunks)
+    max_in_flight = 2 * num_workers
+
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        in_flight = collections.deque()
+
+        def next_chunk():
+            # keep the pool busy, then return the oldest chunk
+            while len(in_flight) < max_in_flight:
+                args = next(queued_chunks, None)
+                if args is None:
+                    break
+                in_flight.append(pool.apply_async(_tokenize_chunk, (args,)))
+            return in_flight.popleft().get()
+
+        for (data_path, target_path, vocabulary_path), chunk_args in zip(jobs, file_chunks):
+            print('Tokenizing data in %s' % data_path)
+            chunks = (next_chunk() for _ in chunk_args)
+            if binary:
+                write_binary_corpus_chunks(target_path, chunks, vocabulary_path)
+            else:
+                with gfile.GFile(target_path, mode='w') as tokens_file:
+                    for i, lines in enumerate(chunks):
+                        tokens_file.write(lines)
+                        print("  tokenized chunk %d of %d" % (i + 1, len(chunk_args)))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def file_fingerprint(path):
+    """Return the md5 hex digest of the contents of a file."""
+    md5 = hashlib.md5()
+    with gfile.GFile(path, mode='rb') as f:
+        chunk = f.read(1 << 20)
+        while chunk:
+            md5.update(chunk)
+            chunk = f.read(1 << 20)
+    return md5.hexdigest()
+
+
+def write_binary_corpus(corpus_path, token_ids, vocabulary_path):
+    """
+    Write sequences of token-ids as a binary corpus that can be memory-mapped.
+
+    The corpus is made of three files:
+      corpus_path + '.tokens': all token-ids concatenated, as raw int32;
+      corpus_path + '.index': sentence offsets into the tokens file, as raw
+        int64, with one extra entry at the end (sentence i spans
+        [index[i], index[i + 1]));
+      corpus_path + '.header': a small JSON header with the number of sentences
+        and tokens and the fingerprint of the vocabulary used to create the ids.
+    The header is written last, so its presence marks a complete corpus.
+
+    Args:
+      corpus_path: path prefix of the corpus files.
+      token_ids: an iterable of lists of token-ids, one per sentence.
+      vocabulary_path: path to the vocabulary file used to create the token-ids.
+    """
+    write_binary_corpus_chunks(corpus_path, _token_id_chunks(token_ids), vocabulary_path)
+
+
+def _token_id_chunks(token_ids, chunk_tokens=1 << 20):
+    """Group sequences of token-ids into (tokens, lengths) int32 arrays of about chunk_tokens tokens."""
+    tokens = array.array('i')
+    lengths = array.array('i')
+    for ids in token_ids:
+        tokens.extend(ids)
+        lengths.append(len(ids))
+        if len(tokens) >= chunk_tokens:
+            yield tokens, lengths
+            tokens = array.array('i')
+            lengths = array.array('i')
+    yield tokens, lengths
+
+
+def write_binary_corpus_chunks(corpus_path, chunks, vocabulary_path):
+    """
+    Write a binary corpus (see write_binary_corpus) from chunks of token-ids.
+
+    Args:
+      corpus_path: path prefix of the corpus files.
+      chunks: an iterable of (tokens, lengths) pairs of int32 arrays, the
+        concatenated token-ids of some sentences and their lengths.
+      vocabulary_path: path to the vocabulary file used to create the token-ids.
+    """
+    lengths = array.array('i')
+    n_tokens = 0
+
+    with open(corpus_path + BINARY_TOKENS, 'wb') as tokens_file:
+        for chunk_tokens, chunk_lengths in chunks:
+            n_tokens += len(chunk_tokens)
+            chunk_tokens.tofile(tokens_file)
+            lengths.extend(chunk_lengths)
+
+    offsets = numpy.zeros(len(lengths) + 1, dtype=numpy.int64)
+    numpy.cumsum(_int32_array(lengths), out=offsets[1:])
+    offsets.tofile(corpus_path + BINARY_INDEX)
+
+    header = {'format': _BINARY_FORMAT,
+              'version': _BINARY_VERSION,
+              'sentences': len(lengths),
+              'tokens': n_tokens,
+              'vocabulary': file_fingerprint(vocabulary_path)}
+    with open(corpus_path + BINARY_HEADER, 'w') as header_file:
+        json.dump(header, header_file)
+
+
+def open_binary_corpus(corpus_path, vocabulary_path=None):
+    """
+    Memory-map a binary corpus created by write_binary_corpus.
+
+    The token and index files are opened read-only with numpy.memmap, so several
+    processes reading the same corpus share its pages through the OS page cache.
+
+    Args:
+      corpus_path: path prefix of the corpus files.
+      vocabulary_path: if given, the vocabulary the corpus must have been created
+        with; its fingerprint is checked against the header.
+
+    Returns:
+      A pair (tokens, offsets) of read-only int32 and int64 memory-mapped arrays.
+
+    Raises:
+      ValueError: if the corpus is not complete, has an unknown format, or was
+        created with a different vocabulary.
+    """
+    if not gfile.Exists(corpus_path + BINARY_HEADER):
+        raise ValueError('Binary corpus %s not found.' % corpus_path)
+
+    with open(corpus_path + BINARY_HEADER, 'r') as header_file:
+        header = json.load(header_file)
+
+    if header.get('format') != _BINARY_FORMAT or header.get('version') != _BINARY_VERSION:
+        raise ValueError('Unknown binary corpus format in %s.' % corpus_path)
+
+    if vocabulary_path is not None and header['vocabulary'] != file_fingerprint(vocabulary_path):
+        raise ValueError('Binary corpus %s was not created with vocabulary %s.' % (corpus_path, vocabulary_path))
+
+    offsets = numpy.memmap(corpus_path + BINARY_INDEX, dtype=numpy.int64, mode='r',
+                           shape=(header['sentences'] + 1,))
+    if header['tokens'] > 0:
+        tokens = numpy.memmap(corpus_path + BINARY_TOKENS, dtype=numpy.int32, mode='r',
+                              shape=(header['tokens'],))
+    else:
+        # numpy cannot map an empty file
+        tokens = numpy.zeros(0, dtype=numpy.int32)
+
+    return tokens, offsets
+
+
+# name of the manifest kept in data_dir by prepare_nmt_data
+PREPROCESSING_MANIFEST = 'preprocessing_manifest.json'
+
+
+def tokenizer_identity():
+    """A string that changes whenever the code turning sentences into tokens changes:
+    the source of the tokenizer functions and the digit normalization they apply."""
+    md5 = hashlib.md5()
+    parts = [inspect.getsource(f) for f in (basic_tokenizer, sentence_to_token_ids,
+                                            normalize_digits_line, sentences_to_token_ids)]
+    parts += [_DIGIT_RE.pattern, _DIGIT_TABLE]
+    for part in parts:
+        md5.update(part if isinstance(part, bytes) else part.encode('utf-8'))
+    return 'basic_tokenizer-%s' % md5.hexdigest()
+
+
+class PreprocessingManifest(object):
+    """
+    Record of the inputs and parameters every preprocessing output was created from.
+
+    The manifest is a JSON file mapping each output path to its signature: the
+    md5 of its input files and the parameters of the stage that created it.
+    An output is reused only if it exists and its recorded signature matches
+    the current one. File digests are cached together with the size and
+    modification time of the file, so unchanged inputs are not hashed again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.outputs = {}
+        self.files = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    manifest = json.load(f)
+                self.outputs = manifest['outputs']
+                self.files = manifest['files']
+            except (ValueError, KeyError):
+                print('Ignoring corrupted preprocessing manifest %s' % path)
+
+    def fingerprint(self, path):
+        """md5 of a file, recomputed only if its size or modification time changed."""
+        stat = os.stat(path)
+        cached = self.files.get(path)
+        if cached is not None and cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime:
+            return cached['md5']
+        md5 = file_fingerprint(path)
+        self.files[path] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'md5': md5}
+        return md5
+
+    def signature(self, inputs, **params):
+        """Signature of a stage reading the given input files with the given parameters."""
+        return {'inputs': dict([(path, self.fingerprint(path)) for path in inputs]),
+                'params': params}
+
+    def is_current(self, output, signature, exists):
+        """Whether an existing output was created from the same inputs and parameters."""
+        return exists and self.outputs.get(output) == signature
+
+    def record(self, output, signature):
+        """Record the signature of an output that has just been created, and save the manifest."""
+        self.outputs[output] = signature
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'outputs': self.outputs, 'files': self.files}, f, indent=1, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+
+def remove_token_ids(target_path, binary=False):
+    """Remove the token-ids of a data file, if they exist."""
+    # the header marks a complete binary corpus, so it goes first
+    suffixes = (BINARY_HEADER, BINARY_TOKENS, BINARY_INDEX) if binary else ('',)
+    for suffix in suffixes:
+        if gfile.Exists(target_path + suffix):
+            gfile.Remove(target_path + suffix)
 
 
 def prepare_nmt_data(FLAGS):
@@ -172,6 +768,12 @@ def prepare_nmt_data(FLAGS):
         (4) path to the token-ids for target development data-set,
         (5) path to the token-ids for source test data-set,
         (6) path to the token-ids for target test data-set,
+      When FLAGS.binary_corpus is set, the paths are the prefixes of binary
+      corpora (see write_binary_corpus) instead of text files.
+
+    A PreprocessingManifest in data_dir records what every vocabulary and
+    token-ids file was created from; only the outputs whose raw data,
+    vocabulary, parameters or tokenizer changed are created again.
     """
     # setting relevant info:
     data_dir = FLAGS.data_dir
@@ -185,33 +787,68 @@ def prepare_nmt_data(FLAGS):
     src_vocabulary_size = FLAGS.src_vocab_size
     tgt_vocabulary_size = FLAGS.tgt_vocab_size
 
+    # token-ids are saved as memory-mapped binary corpora instead of text files
+    binary = FLAGS.binary_corpus
+
+    # number of processes used to create the vocabularies and the token ids
+    num_workers = FLAGS.preprocess_workers
+
     # Create vocabularies of the appropriate sizes.
     src_vocab_path = (train_data % str(src_vocabulary_size)) + ('.vocab.%s' % source_lang)
     tgt_vocab_path = (train_data % str(tgt_vocabulary_size)) + ('.vocab.%s' % target_lang)
 
-    create_vocabulary(src_vocab_path, train_data % source_lang, src_vocabulary_size)
-    create_vocabulary(tgt_vocab_path, train_data % target_lang, tgt_vocabulary_size)
+    manifest = PreprocessingManifest(data_dir + PREPROCESSING_MANIFEST)
+    tokenizer = tokenizer_identity()
+
+    for vocab_path, data_path, vocabulary_size in [(src_vocab_path, train_data % source_lang, src_vocabulary_size),
+                                                   (tgt_vocab_path, train_data % target_lang, tgt_vocabulary_size)]:
+        signature = manifest.signature([data_path], max_vocabulary_size=vocabulary_size,
+                                       normalize_digits=True, tokenizer=tokenizer)
+        if not manifest.is_current(vocab_path, signature, gfile.Exists(vocab_path)):
+            if gfile.Exists(vocab_path):
+                print('Vocabulary %s is out of date' % vocab_path)
+                gfile.Remove(vocab_path)
+            create_vocabulary(vocab_path, data_path, vocabulary_size, num_workers=num_workers)
+            manifest.record(vocab_path, signature)
 
-    # Create token ids for the training data.
+    # Paths of the token ids for the training, development and test data.
     src_train_ids_path = (train_data % str(src_vocabulary_size)) + ('.ids.%s' % source_lang)
     tgt_train_ids_path = (train_data % str(tgt_vocabulary_size)) + ('.ids.%s' % target_lang)
 
-    data_to_token_ids(train_data % source_lang, src_train_ids_path, src_vocab_path)
-    data_to_token_ids(train_data % target_lang, tgt_train_ids_path, tgt_vocab_path)
-
-    # Create token ids for the development data.
     src_dev_ids_path = (valid_data % str(src_vocabulary_size)) + ('.ids.%s' % source_lang)
     tgt_dev_ids_path = (valid_data % str(tgt_vocabulary_size)) + ('.ids.%s' % target_lang)
 
-    data_to_token_ids(valid_data % source_lang, src_dev_ids_path, src_vocab_path)
-    data_to_token_ids(valid_data % target_lang, tgt_dev_ids_path, tgt_vocab_path)
-
-    # Create token ids for the test data.
     src_test_ids_path = (test_data % str(src_vocabulary_size)) + ('.ids.%s' % source_lang)
     tgt_test_ids_path = (test_data % str(tgt_vocabulary_size)) + ('.ids.%s' % target_lang)
 
-    data_to_token_ids(test_data % source_lang, src_test_ids_path, src_vocab_path)
-    data_to_token_ids(test_data % target_lang, tgt_test_ids_path, tgt_vocab_path)
+    tokenize_jobs = [(train_data % source_lang, src_train_ids_path, src_vocab_path),
+                     (train_data % target_lang, tgt_train_ids_path, tgt_vocab_path),
+                     (valid_data % source_lang, src_dev_ids_path, src_vocab_path),
+                     (valid_data % target_lang, tgt_dev_ids_path, tgt_vocab_path),
+                     (test_data % source_lang, src_test_ids_path, src_vocab_path),
+                     (test_data % target_lang, tgt_test_ids_path, tgt_vocab_path)]
+
+    # The token ids depend on the content of the vocabulary, not on when it was created:
+    # a vocabulary created again from changed data, but with the same tokens, keeps them.
+    stale_jobs = []
+    for data_path, ids_path, vocab_path in tokenize_jobs:
+        signature = manifest.signature([data_path, vocab_path], normalize_digits=True,
+                                       tokenizer=tokenizer, binary=binary)
+        # text and binary token ids share the same path prefix
+        output = ids_path + BINARY_HEADER if binary else ids_path
+        if not manifest.is_current(output, signature, token_ids_exist(ids_path, vocab_path, binary)):
+            remove_token_ids(ids_path, binary)
+            stale_jobs.append(((data_path, ids_path, vocab_path), output, signature))
+
+    # Create token ids; with several workers the six files share one pool and are tokenized concurrently.
+    if num_workers > 1:
+        tokenize_files_parallel([job for job, _, _ in stale_jobs], binary=binary, num_workers=num_workers)
+    else:
+        for (data_path, ids_path, vocab_path), _, _ in stale_jobs:
+            data_to_token_ids(data_path, ids_path, vocab_path, binary=binary)
+
+    for _, output, signature in stale_jobs:
+        manifest.record(output, signature)
 
     return (src_train_ids_path, tgt_train_ids_path,
             src_dev_ids_path, tgt_dev_ids_path,
@@ -260,3 +897,384 @@ def read_nmt_data(source_path, target_path, FLAGS=None, buckets=None, max_size=N
                         break
                 source, target = source_file.readline(), target_file.readline()
     return data_set
+
+
+def _int32_array(values):
+    """View an array.array('i') as a numpy int32 array without copying it."""
+    if len(values) == 0:
+        return numpy.zeros(0, dtype=numpy.int32)
+    return numpy.frombuffer(values, dtype=numpy.int32)
+
+
+def assign_buckets(source_lengths, target_lengths, buckets):
+    """Find the first bucket each pair fits into, following the rule used by read_nmt_data.
+
+    Args:
+      source_lengths: 1D int array with the length of each source sentence.
+      target_lengths: 1D int array with the length of each target sentence (EOS included).
+      buckets: a list of pairs (source size, target size).
+
+    Returns:
+      A 1D int array with the bucket id of each pair, or -1 for pairs that do not fit.
+    """
+    source_sizes = numpy.array([b[0] for b in buckets])
+    target_sizes = numpy.array([b[1] for b in buckets])
+    fits = ((numpy.asarray(source_lengths)[:, None] < source_sizes[None, :]) &
+            (numpy.asarray(target_lengths)[:, None] < target_sizes[None, :]))
+    bucket_ids = fits.argmax(axis=1)
+    bucket_ids[~fits.any(axis=1)] = -1
+    return bucket_ids
+
+
+def make_token_buckets(source, source_lengths, target, target_lengths, buckets):
+    """Split flat source/target token arrays into a list of TokenBucket, one per bucket.
+
+    Args:
+      source: 1D int32 array with all source sentences concatenated.
+      source_lengths: 1D int array with the length of each source sentence.
+      target: 1D int32 array with all target sentences concatenated (without EOS).
+      target_lengths: 1D int array with the length of each target sentence (without EOS).
+      buckets: a list of pairs (source size, target size).
+
+    Returns:
+      data_set: a list of length len(buckets) of TokenBucket; pairs that do not fit
+        into any bucket are dropped.
+    """
+    source_lengths = numpy.asarray(source_lengths, dtype=numpy.int32)
+    target_lengths = numpy.asarray(target_lengths, dtype=numpy.int32)
+    source_offsets = numpy.cumsum(source_lengths, dtype=numpy.int64) - source_lengths
+    target_offsets = numpy.cumsum(target_lengths, dtype=numpy.int64) - target_lengths
+
+    # the EOS symbol appended to the targets counts for the bucket size
+    bucket_ids = assign_buckets(source_lengths, target_lengths + 1, buckets)
+
+    data_set = []
+    for bucket_id in xrange(len(buckets)):
+        idx = numpy.flatnonzero(bucket_ids == bucket_id)
+        data_set.append(TokenBucket(source, source_offsets[idx], source_lengths[idx],
+                                    target, target_offsets[idx], target_lengths[idx]))
+    return data_set
+
+
+def read_nmt_data_compact(source_path, target_path, FLAGS=None, buckets=None, max_size=None):
+    """Read data from source and target files and put into compact buckets.
+
+    Same as read_nmt_data, but the token-ids are stored in contiguous int32 numpy
+    arrays instead of Python lists, which is much smaller in memory and allows
+    batches to be gathered with fancy indexing.
+
+    Args:
+      source_path: path to the files with token-ids for the source language.
+      target_path: path to the file with token-ids for the target language;
+        it must be aligned with the source file.
+      max_size: maximum number of lines to read, all other will be ignored;
+        if 0 or None, data files will be read completely (no limit).
+
+    Returns:
+      data_set: a list of length len(buckets) of TokenBucket.
+    """
+
+    assert FLAGS is not None
+    assert buckets is not None
+
+    source, target = array.array('i'), array.array('i')
+    source_lengths, target_lengths = array.array('i'), array.array('i')
+
+    counter = 0
+    with gfile.GFile(source_path, mode='r') as source_file:
+        with gfile.GFile(target_path, mode='r') as target_file:
+            source_line, target_line = source_file.readline(), target_file.readline()
+
+            while source_line and target_line and (not max_size or counter < max_size):
+                counter += 1
+                if counter % 10000 == 0:
+                    print('  reading data line %d' % counter)
+                    sys.stdout.flush()
+
+                source_ids = [int(x) for x in source_line.split()]
+                target_ids = [int(x) for x in target_line.split()]
+                source.extend(source_ids)
+                target.extend(target_ids)
+                source_lengths.append(len(source_ids))
+                target_lengths.append(len(target_ids))
+                source_line, target_line = source_file.readline(), target_file.readline()
+
+    return make_token_buckets(_int32_array(source), _int32_array(source_lengths),
+                              _int32_array(target), _int32_array(target_lengths), buckets)
+
+
+def read_nmt_data_binary(source_path, target_path, FLAGS=None, buckets=None, max_size=None):
+    """Memory-map binary source and target corpora and put them into compact buckets.
+
+    Same as read_nmt_data_compact, but for corpora written by write_binary_corpus:
+    the token arrays of the returned buckets are the memory-mapped token files, so
+    nothing but the bucket indexes is loaded into memory.
+
+    Args:
+      source_path: path prefix of the binary corpus for the source language.
+      target_path: path prefix of the binary corpus for the target language;
+        it must be aligned with the source corpus.
+      max_size: maximum number of pairs to read, all other will be ignored;
+        if 0 or None, the corpora will be read completely (no limit).
+
+    Returns:
+      data_set: a list of length len(buckets) of TokenBucket.
+
+    Raises:
+      ValueError: if the two corpora do not have the same number of sentences.
+    """
+
+    assert FLAGS is not None
+    assert buckets is not None
+
+    source, source_offsets = open_binary_corpus(source_path)
+    target, target_offsets = open_binary_corpus(target_path)
+
+    if len(source_offsets) != len(target_offsets):
+        raise ValueError('Corpora %s and %s are not aligned.' % (source_path, target_path))
+
+    source_lengths = numpy.diff(source_offsets)
+    target_lengths = numpy.diff(target_offsets)
+    if max_size:
+        source_lengths = source_lengths[:max_size]
+        target_lengths = target_lengths[:max_size]
+
+    print('  read %d pairs from %s' % (len(source_lengths), source_path))
+    sys.stdout.flush()
+
+    return make_token_buckets(source, source_lengths, target, target_lengths, buckets)
+
+
+def token_budget_batch_sizes(buckets, batch_tokens):
+    """Batch size of each bucket so that a batch holds at most batch_tokens padded tokens.
+
+    A pair in bucket (S, T) takes S encoder and T decoder positions, so short
+    buckets get proportionally larger batches; every batch has at least one pair.
+
+    Args:
+      buckets: a list of pairs (source size, target size).
+      batch_tokens: maximum number of source + target positions in a batch.
+
+    Returns:
+      A list with the batch size of each bucket.
+    """
+    return [max(batch_tokens // (source_size + target_size), 1) for source_size, target_size in buckets]
+
+
+def read_sentence_lengths(source_path, target_path, binary=False, max_size=None):
+    """Read the lengths of the aligned sentences of source and target token-id files.
+
+    Args:
+      source_path: path to the token-ids for the source language (or binary corpus prefix).
+      target_path: path to the token-ids for the target language (or binary corpus prefix).
+      binary: Boolean; if true, the paths are binary corpora (see write_binary_corpus).
+      max_size: maximum number of pairs to read, as in read_nmt_data.
+
+    Returns:
+      A pair of 1D int32 arrays: source and target lengths (EOS not included).
+    """
+    lengths = []
+    for path in (source_path, target_path):
+        if binary:
+            _, offsets = open_binary_corpus(path)
+            lengths.append(numpy.diff(offsets).astype(numpy.int32))
+        else:
+            with gfile.GFile(path, mode='r') as ids_file:
+                lengths.append(_int32_array(array.array('i', (len(line.split()) for line in ids_file))))
+
+    # like read_nmt_data, stop at the end of the shortest file
+    n_pairs = min(len(lengths[0]), len(lengths[1]))
+    if max_size:
+        n_pairs = min(n_pairs, max_size)
+    return lengths[0][:n_pairs], lengths[1][:n_pairs]
+
+
+def bucket_padding_stats(source_lengths, target_lengths, buckets):
+    """Padding waste and dropped pairs of a set of buckets, following the rule used by read_nmt_data.
+
+    Every pair kept in bucket (S, T) costs S encoder and T decoder positions;
+    the positions that hold the source tokens, GO, the target tokens and EOS
+    are useful, the others are padding.
+
+    Args:
+      source_lengths: 1D int array with the length of each source sentence.
+      target_lengths: 1D int array with the length of each target sentence (EOS not included).
+      buckets: a list of pairs (source size, target size).
+
+    Returns:
+      A pair of floats: the fraction of padding positions in the kept pairs and
+      the fraction of pairs that do not fit into any bucket.
+    """
+    source_lengths = numpy.asarray(source_lengths, dtype=numpy.int64)
+    target_lengths = numpy.asarray(target_lengths, dtype=numpy.int64) + 1
+    if len(source_lengths) == 0:
+        return 0.0, 0.0
+
+    bucket_ids = assign_buckets(source_lengths, target_lengths, buckets)
+    kept = bucket_ids >= 0
+    bucket_positions = numpy.array([source_size + target_size for source_size, target_size in buckets])
+
+    padded = bucket_positions[bucket_ids[kept]].sum()
+    useful = source_lengths[kept].sum() + (target_lengths[kept] + 1).sum()
+    waste = 1.0 - useful / float(padded) if padded > 0 else 0.0
+    return waste, 1.0 - kept.mean()
+
+
+def _plan_bucket_ranges(source_lengths, target_lengths, n_buckets, quantile):
+    """Optimal buckets when each bucket keeps the given quantile of the targets of its source range.
+
+    Buckets split the source lengths into contiguous ranges; the bucket covering
+    the source lengths [a, b) has source size b and the smallest target size
+    that fits the quantile of the targets (EOS included) of its pairs. Dynamic
+    programming over the range boundaries gives the split with the fewest
+    padded positions for at most n_buckets buckets.
+    """
+    n_pairs = len(source_lengths)
+
+    # longest source kept: the quantile of all source lengths
+    source_histogram = numpy.bincount(source_lengths)
+    max_source = int(numpy.searchsorted(numpy.cumsum(source_histogram), quantile * n_pairs - 1e-9))
+    n_sources = max_source + 1
+
+    keep = source_lengths <= max_source
+    histogram = numpy.zeros((n_sources, target_lengths.max() + 1), dtype=numpy.int64)
+    numpy.add.at(histogram, (source_lengths[keep], target_lengths[keep]), 1)
+    # prefix[j] = target histogram of the pairs with source length < j
+    prefix = numpy.zeros((n_sources + 1, histogram.shape[1]), dtype=numpy.int64)
+    numpy.cumsum(histogram, axis=0, out=prefix[1:])
+
+    # cost[a, b]: padded positions of the bucket covering source lengths [a, b)
+    cost = numpy.full((n_sources + 1, n_sources + 1), numpy.inf)
+    target_size = numpy.zeros((n_sources + 1, n_sources + 1), dtype=numpy.int64)
+    for a in xrange(n_sources):
+        cumulative = numpy.cumsum(prefix[a + 1:] - prefix[a], axis=1)
+        counts = cumulative[:, -1]
+        longest = (cumulative >= numpy.ceil(quantile * counts)[:, None]).argmax(axis=1)
+        kept = cumulative[numpy.arange(len(longest)), longest]
+        source_size = numpy.arange(a + 1, n_sources + 1)
+        cost[a, a + 1:] = numpy.where(counts > 0, kept * (source_size + longest + 1), numpy.inf)
+        target_size[a, a + 1:] = longest + 1
+
+    # best[k, j]: fewest padded positions covering source lengths [0, j) with k buckets
+    n_buckets = min(n_buckets, n_sources)
+    best = numpy.full((n_buckets + 1, n_sources + 1), numpy.inf)
+    best[0, 0] = 0.0
+    previous = numpy.zeros((n_buckets + 1, n_sources + 1), dtype=numpy.int64)
+    for k in xrange(1, n_buckets + 1):
+        total = best[k - 1][:, None] + cost
+        previous[k] = total.argmin(axis=0)
+        best[k] = total.min(axis=0)
+
+    k = int(best[1:, n_sources].argmin()) + 1
+    bounds = [n_sources]
+    for k in xrange(k, 0, -1):
+        bounds.append(previous[k, bounds[-1]])
+    bounds.reverse()
+
+    buckets = []
+    for a, b in zip(bounds[:-1], bounds[1:]):
+        # the last bucket must be the biggest in both sizes
+        size = int(target_size[a, b]) if not buckets else max(int(target_size[a, b]), buckets[-1][1])
+        buckets.append((int(b), size))
+    return buckets
+
+
+def _padded_positions(source_cells, target_cells, cell_counts, buckets):
+    """Positions used by the pairs of a length histogram that fit the buckets, and their number."""
+    bucket_ids = assign_buckets(source_cells, target_cells, buckets)
+    kept = bucket_ids >= 0
+    bucket_positions = numpy.array([source_size + target_size for source_size, target_size in buckets])
+    return (bucket_positions[bucket_ids[kept]] * cell_counts[kept]).sum(), cell_counts[kept].sum()
+
+
+def _refine_buckets(source_cells, target_cells, cell_counts, buckets, min_kept, max_sweeps=20):
+    """Improve buckets by coordinate descent on the exact number of padded positions.
+
+    The planned ranges assume the pairs trimmed from a bucket are dropped, while
+    read_nmt_data puts them into the next bucket they fit; each sweep tries every
+    size of every bucket between the sizes of its neighbours and keeps the best
+    one that still fits at least min_kept pairs.
+    """
+    buckets = [list(bucket) for bucket in buckets]
+    upper = [int(source_cells.max()) + 1, int(target_cells.max()) + 1]
+    best_cost, _ = _padded_positions(source_cells, target_cells, cell_counts, buckets)
+
+    for _ in xrange(max_sweeps):
+        improved = False
+        for i in xrange(len(buckets)):
+            for dim in (0, 1):
+                low = buckets[i - 1][dim] if i > 0 else 1
+                high = buckets[i + 1][dim] if i + 1 < len(buckets) else upper[dim]
+                current = buckets[i][dim]
+                for size in xrange(low, high + 1):
+                    buckets[i][dim] = size
+                    cost, kept = _padded_positions(source_cells, target_cells, cell_counts, buckets)
+                    if kept >= min_kept and cost < best_cost:
+                        best_cost, current, improved = cost, size, True
+                buckets[i][dim] = current
+        if not improved:
+            break
+    return [tuple(bucket) for bucket in buckets]
+
+
+def plan_buckets(source_lengths, target_lengths, n_buckets, coverage=0.99):
+    """Choose bucket sizes from the sentence length histogram of a training set.
+
+    The buckets minimize the number of padded positions (see bucket_padding_stats)
+    while at least a coverage fraction of the pairs fits into some bucket. Sizes
+    are nondecreasing in both languages, so the last bucket is the biggest one.
+
+    Args:
+      source_lengths: 1D int array with the length of each source sentence.
+      target_lengths: 1D int array with the length of each target sentence (EOS not included).
+      n_buckets: maximum number of buckets.
+      coverage: minimum fraction of pairs that must fit into the buckets.
+
+    Returns:
+      A list of pairs (source size, target size), as the buckets of the translate_*.py scripts.
+
+    Raises:
+      ValueError: if there are no sentences or the arguments are out of range.
+    """
+    if len(source_lengths) == 0:
+        raise ValueError('Cannot plan buckets without sentences.')
+    if n_buckets < 1 or not 0.0 < coverage <= 1.0:
+        raise ValueError('Invalid number of buckets (%d) or coverage (%f).' % (n_buckets, coverage))
+
+    source_lengths = numpy.asarray(source_lengths, dtype=numpy.int64)
+    target_lengths = numpy.asarray(target_lengths, dtype=numpy.int64) + 1
+
+    # the refinement works on the (source, target) length histogram instead of the pairs
+    width = target_lengths.max() + 1
+    cells = numpy.bincount(source_lengths * width + target_lengths)
+    nonzero = numpy.flatnonzero(cells)
+    source_cells, target_cells, cell_counts = nonzero // width, nonzero % width, cells[nonzero]
+    min_kept = int(numpy.ceil(coverage * len(source_lengths) - 1e-9))
+
+    # the tails trimmed per bucket can drop more pairs than the target: trim less until it is met
+    quantile = coverage
+    for _ in xrange(8):
+        buckets = _plan_bucket_ranges(source_lengths, target_lengths, n_buckets, quantile)
+        if _padded_positions(source_cells, target_cells, cell_counts, buckets)[1] >= min_kept:
+            break
+        quantile = 1.0 - (1.0 - quantile) / 2.0
+    else:
+        buckets = _plan_bucket_ranges(source_lengths, target_lengths, n_buckets, 1.0)
+
+    return _refine_buckets(source_cells, target_cells, cell_counts, buckets, min_kept)
+
+
+def print_bucket_report(source_lengths, target_lengths, named_buckets):
+    """Print the padding waste and the dropped pairs of several sets of buckets.
+
+    Args:
+      source_lengths: 1D int array with the length of each source sentence.
+      target_lengths: 1D int array with the length of each target sentence (EOS not included).
+      named_buckets: a list of (name, buckets) pairs.
+    """
+    print('Buckets for %d sentence pairs:' % len(source_lengths))
+    for name, buckets in named_buckets:
+        waste, dropped = bucket_padding_stats(source_lengths, target_lengths, buckets)
+        print('  %s: padding %.1f%%, dropped %.2f%%' % (name, 100.0 * waste, 100.0 * dropped))
+        print('    %s' % (buckets,))
+    sys.stdout.flush()
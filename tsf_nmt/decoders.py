@@ -4,31 +4,56 @@ from __future__ import print_function
 import tensorflow as tf
 
 from tensorflow.python.framework import ops
-from tensorflow.python.ops import array_ops, embedding_ops, math_ops, nn_ops
+from tensorflow.python.ops import array_ops, control_flow_ops, math_ops, nn_ops
 from tensorflow.python.ops import variable_scope as vs
 
 import cells
+import data_utils
 from attention import global_attention
 from content_functions import decoder_type_2, vinyals_kaiser, mod_bahdanau
 # from six.moves import xrange
 
 _SEED = 1234
 
+# status of the rows of beam_search_decoder after each step
+BEAM_INACTIVE, BEAM_ALIVE, BEAM_FINISHED = 0, 1, 2
+
+# score of the rows of beam_search_decoder that hold no live hypothesis
+_INACTIVE_SCORE = 1e30
+
 
 # TODO: finish pydocs
 
 
+def _embedding(num_symbols, input_size, input_feeding=False):
+
+    if input_feeding:
+        embedding = vs.get_variable("embedding", [num_symbols, input_size / 2])
+
+    else:
+        embedding = vs.get_variable("embedding", [num_symbols, input_size])
+
+    return embedding
+
+
 def _embed_inputs(decoder_inputs, num_symbols, input_size, input_feeding=False):
 
     with ops.device("/cpu:0"):
 
-        if input_feeding:
-            embedding = vs.get_variable("embedding", [num_symbols, input_size / 2])
+        embedding = _embedding(num_symbols, input_size, input_feeding=input_feeding)
 
-        else:
-            embedding = vs.get_variable("embedding", [num_symbols, input_size])
+        emb_inp = cells.embed_inputs(embedding, decoder_inputs)
+
+    return emb_inp
+
+
+def _embed_sequence(decoder_inputs, num_symbols, input_size, input_feeding=False):
+
+    with ops.device("/cpu:0"):
+
+        embedding = _embedding(num_symbols, input_size, input_feeding=input_feeding)
 
-        emb_inp = [embedding_ops.embedding_lookup(embedding, i) for i in decoder_inputs]
+        emb_inp = cells.embed_sequence(embedding, decoder_inputs)
 
     return emb_inp
 
@@ -37,7 +62,7 @@ def attention_decoder(decoder_inputs, initial_state, attention_states, cell, num
                       attention_f=global_attention, window_size=10, content_function=vinyals_kaiser,
                       decoder_attention_f=decoder_type_2, combine_inp_attn=False, input_feeding=False,
                       dropout=None, initializer=None, decoder_states=None, step_num=None,
-                      dtype=tf.float32, scope=None):
+                      attention_mask=None, dtype=tf.float32, scope=None):
     """
 
     Helper function implementing a RNN decoder with global, local or hybrid attention for the sequence-to-sequence
@@ -87,6 +112,10 @@ def attention_decoder(decoder_inputs, initial_state, attention_states, cell, num
 
     content_function: string
 
+    attention_mask: tensor
+            2D Tensor [batch_size x attn_length] with 1 for the positions of attention_states to attend to
+                and 0 for padding; all the positions are attended to if None.
+
     dtype:
             The dtype to use for the RNN initial state (default: tf.float32).
 
@@ -177,7 +206,8 @@ def attention_decoder(decoder_inputs, initial_state, attention_states, cell, num
 
             ct = attention_f(decoder_hidden_state=dt, hidden_attn=hidden,
                              initializer=initializer, window_size=window_size,
-                             content_function=content_function, dtype=dtype)
+                             content_function=content_function, attention_mask=attention_mask,
+                             dtype=dtype)
 
             #
             with vs.variable_scope("AttnOutputProjection", initializer=initializer):
@@ -196,7 +226,7 @@ def attention_decoder_informed(decoder_inputs, initial_state, attention_states,
                                attention_f=global_attention, window_size=10, content_function=vinyals_kaiser,
                                decoder_attention_f=decoder_type_2, combine_inp_attn=False, input_feeding=False,
                                dropout=None, initializer=None, decoder_states=None, step_num=None,
-                               dtype=tf.float32, scope=None):
+                               attention_mask=None, dtype=tf.float32, scope=None):
     """
 
     Helper function implementing a RNN decoder with global, local or hybrid attention for the sequence-to-sequence
@@ -246,6 +276,10 @@ def attention_decoder_informed(decoder_inputs, initial_state, attention_states,
 
     content_function: string
 
+    attention_mask: tensor
+            2D Tensor [batch_size x attn_length] with 1 for the positions of attention_states to attend to
+                and 0 for padding; all the positions are attended to if None.
+
     dtype:
             The dtype to use for the RNN initial state (default: tf.float32).
 
@@ -334,7 +368,8 @@ def attention_decoder_informed(decoder_inputs, initial_state, attention_states,
 
             ct = attention_f(decoder_hidden_state=dt, hidden_attn=hidden,
                              initializer=initializer, window_size=window_size,
-                             content_function=content_function, dtype=dtype)
+                             content_function=content_function, attention_mask=attention_mask,
+                             dtype=dtype)
 
             #
             with vs.variable_scope("AttnOutputProjection", initializer=initializer):
@@ -362,7 +397,7 @@ def attention_decoder_output(decoder_inputs, initial_state, attention_states, ce
                              attention_f=global_attention, window_size=10, content_function=vinyals_kaiser,
                              decoder_attention_f=decoder_type_2, combine_inp_attn=False, input_feeding=False,
                              dropout=None, initializer=None, decoder_states=None, step_num=None,
-                             dtype=tf.float32, scope=None):
+                             attention_mask=None, dtype=tf.float32, scope=None):
     """
 
     Helper function implementing a RNN decoder with global, local or hybrid attention for the sequence-to-sequence
@@ -409,6 +444,10 @@ def attention_decoder_output(decoder_inputs, initial_state, attention_states, ce
 
     content_function: string
 
+    attention_mask: tensor
+            2D Tensor [batch_size x attn_length] with 1 for the positions of attention_states to attend to
+                and 0 for padding; all the positions are attended to if None.
+
     dtype:
             The dtype to use for the RNN initial state (default: tf.float32).
 
@@ -510,7 +549,8 @@ def attention_decoder_output(decoder_inputs, initial_state, attention_states, ce
 
             ct = attention_f(decoder_hidden_state=dt, hidden_attn=hidden,
                              initializer=initializer, window_size=window_size,
-                             content_function=content_function, dtype=dtype)
+                             content_function=content_function, attention_mask=attention_mask,
+                             dtype=dtype)
 
             with vs.variable_scope("AttnOutputProjection", initializer=initializer):
 
@@ -604,7 +644,7 @@ def attention_decoder_output_informed(decoder_inputs, initial_state, attention_s
                                       attention_f=global_attention, window_size=10, content_function=vinyals_kaiser,
                                       decoder_attention_f=decoder_type_2, combine_inp_attn=False, input_feeding=False,
                                       dropout=None, initializer=None, decoder_states=None, step_num=None,
-                                      dtype=tf.float32, scope=None):
+                                      attention_mask=None, dtype=tf.float32, scope=None):
     """
 
     Helper function implementing a RNN decoder with global, local or hybrid attention for the sequence-to-sequence
@@ -651,6 +691,10 @@ def attention_decoder_output_informed(decoder_inputs, initial_state, attention_s
 
     content_function: string
 
+    attention_mask: tensor
+            2D Tensor [batch_size x attn_length] with 1 for the positions of attention_states to attend to
+                and 0 for padding; all the positions are attended to if None.
+
     dtype:
             The dtype to use for the RNN initial state (default: tf.float32).
 
@@ -751,7 +795,8 @@ def attention_decoder_output_informed(decoder_inputs, initial_state, attention_s
 
             ct = attention_f(decoder_hidden_state=dt, hidden_attn=hidden,
                              initializer=initializer, window_size=window_size,
-                             content_function=content_function, dtype=dtype)
+                             content_function=content_function, attention_mask=attention_mask,
+                             dtype=dtype)
 
             with vs.variable_scope("AttnOutputProjection", initializer=initializer):
 
@@ -814,7 +859,8 @@ def attention_decoder_output_informed(decoder_inputs, initial_state, attention_s
 def attention_decoder_nmt(decoder_inputs, initial_state, attention_states, cell, num_symbols,
                           attention_f=global_attention, window_size=10, content_function=vinyals_kaiser,
                           decoder_attention_f=decoder_type_2, combine_inp_attn=False, input_feeding=False,
-                          dropout=None, initializer=None, dtype=tf.float32, scope=None):
+                          dropout=None, initializer=None, attention_mask=None,
+                          dtype=tf.float32, scope=None):
     """
 
     Helper function implementing a RNN decoder with global, local or hybrid attention for the sequence-to-sequence
@@ -864,6 +910,10 @@ def attention_decoder_nmt(decoder_inputs, initial_state, attention_states, cell,
 
     content_function: string
 
+    attention_mask: tensor
+            2D Tensor [batch_size x attn_length] with 1 for the positions of attention_states to attend to
+                and 0 for padding; all the positions are attended to if None.
+
     dtype:
             The dtype to use for the RNN initial state (default: tf.float32).
 
@@ -943,7 +993,8 @@ def attention_decoder_nmt(decoder_inputs, initial_state, attention_states, cell,
 
             ct = attention_f(decoder_hidden_state=dt, hidden_attn=hidden,
                              initializer=initializer, window_size=window_size,
-                             content_function=content_function, dtype=dtype)
+                             content_function=content_function, attention_mask=attention_mask,
+                             dtype=dtype)
 
             # Run the RNN.
             cell_output, new_state = cell(x, cell_states, context=ct)
@@ -974,3 +1025,393 @@ def attention_decoder_nmt(decoder_inputs, initial_state, attention_states, cell,
             outputs.append(output)
 
     return outputs, cell_states
+
+
+def dynamic_attention_decoder(decoder_inputs, initial_state, attention_states, cell, num_symbols,
+                              attention_f=global_attention, window_size=10, content_function=vinyals_kaiser,
+                              combine_inp_attn=False, input_feeding=False, dropout=None, initializer=None,
+                              dtype=tf.float32, scope=None):
+    """
+
+    Same as attention_decoder, with a while loop over the time steps: the graph holds a single copy of
+        the decoder, whatever the length of the sentences fed. It creates the same variables.
+
+    Parameters
+    ----------
+
+    decoder_inputs: tensor
+            a [time x batch_size] int Tensor; the number of time steps may be unknown.
+
+    attention_states: tensor
+            3D tensor [batch_size x attn_length (time) x attn_size (hidden_layer_size)]; attn_length may
+                be unknown, so only global attention is supported.
+
+    See attention_decoder for the other parameters; the decoder attention (decoder_attention_f) and the
+        'modified_bahdanau' content function are not supported.
+
+    Returns
+    -------
+
+    outputs:
+            A [time x batch_size x output_size] Tensor with the generated outputs.
+
+    states:
+            The final state of the decoder cell.
+
+    """
+    # imported here, so that the decoders without while loop work with older TensorFlow versions
+    from tensorflow.python.ops import tensor_array_ops
+
+    if attention_f is not global_attention:
+        raise ValueError('The dynamic decoder only supports global attention.')
+    if content_function is mod_bahdanau:
+        raise ValueError('The dynamic decoder does not support the modified_bahdanau content function.')
+
+    output_size = cell.output_size
+
+    if dropout is not None:
+
+        for c in cell._cells:
+            c.input_keep_prob = 1.0 - dropout
+
+    if initializer is None:
+        initializer = tf.random_uniform_initializer(minval=-0.1, maxval=0.1, seed=_SEED)
+
+    with vs.variable_scope(scope or "embedding_attention_decoder", initializer=initializer):
+
+        emb_inp = _embed_sequence(decoder_inputs, num_symbols, cell.input_size, input_feeding=input_feeding)
+        emb_size = emb_inp.get_shape()[2].value
+
+        n_steps = array_ops.shape(emb_inp)[0]
+        batch = array_ops.shape(emb_inp)[1]  # Needed for reshaping.
+        attn_size = attention_states.get_shape()[2].value
+
+        # To calculate W1 * h_t we use a 1-by-1 convolution, need to reshape before.
+        hidden = array_ops.expand_dims(attention_states, 2)
+
+        batch_attn_size = array_ops.pack([batch, attn_size])
+
+        # initial attention state
+        ct = array_ops.zeros(batch_attn_size, dtype=dtype)
+        ct.set_shape([None, attn_size])
+
+        inputs_ta = tensor_array_ops.TensorArray(dtype=dtype, size=n_steps).unpack(emb_inp)
+        outputs_ta = tensor_array_ops.TensorArray(dtype=dtype, size=n_steps)
+
+        def step(time, cell_states, ct, outputs_ta):
+
+            inp = inputs_ta.read(time)
+            inp.set_shape([None, emb_size])
+
+            if input_feeding:
+                # if using input_feeding, concatenate previous attention with input to layers
+                inp = array_ops.concat(1, [inp, ct])
+
+            if combine_inp_attn:
+                # Merge input and previous attentions into one vector of the right size.
+                x = cells.linear([inp] + [ct], cell.input_size, True)
+            else:
+                x = inp
+
+            # Run the RNN.
+            cell_output, new_state = cell(x, cell_states)
+
+            ct = attention_f(decoder_hidden_state=cell_output, hidden_attn=hidden,
+                             initializer=initializer, window_size=window_size,
+                             content_function=content_function, dtype=dtype)
+
+            #
+            with vs.variable_scope("AttnOutputProjection", initializer=initializer):
+
+                # if we pass a list of tensors, linear will first concatenate them over axis 1
+                output = cells.linear([ct] + [cell_output], output_size, True)
+
+                output = tf.tanh(output)
+
+            return time + 1, new_state, ct, outputs_ta.write(time, output)
+
+        _, cell_states, _, outputs_ta = control_flow_ops.while_loop(
+            lambda time, cell_states, ct, outputs_ta: time < n_steps, step,
+            [array_ops.constant(0), initial_state, ct, outputs_ta])
+
+    # the packed outputs have no static shape
+    outputs = outputs_ta.pack()
+    outputs.set_shape([None, None, output_size])
+
+    return outputs, cell_states
+
+
+def dynamic_attention_decoder_nmt(decoder_inputs, initial_state, attention_states, cell, num_symbols,
+                                  attention_f=global_attention, window_size=10, content_function=vinyals_kaiser,
+                                  combine_inp_attn=False, input_feeding=False, dropout=None, initializer=None,
+                                  dtype=tf.float32, scope=None):
+    """
+
+    Same as attention_decoder_nmt, with a while loop over the time steps (see dynamic_attention_decoder).
+
+    Parameters
+    ----------
+
+    decoder_inputs: tensor
+            a [time x batch_size] int Tensor; the number of time steps may be unknown.
+
+    attention_states: tensor
+            3D tensor [batch_size x attn_length (time) x attn_size (hidden_layer_size)]; attn_length may
+                be unknown, so only global attention is supported.
+
+    See attention_decoder_nmt for the other parameters.
+
+    Returns
+    -------
+
+    outputs:
+            A [time x batch_size x output_size] Tensor with the generated outputs.
+
+    states:
+            The final state of the decoder cell.
+
+    """
+    from tensorflow.python.ops import tensor_array_ops
+
+    if attention_f is not global_attention:
+        raise ValueError('The dynamic decoder only supports global attention.')
+
+    output_size = cell.output_size
+
+    if dropout is not None:
+
+        cell.input_keep_prob = 1.0 - dropout
+
+    if initializer is None:
+        initializer = tf.random_uniform_initializer(minval=-0.1, maxval=0.1, seed=_SEED)
+
+    with vs.variable_scope(scope or "embedding_attention_decoder", initializer=initializer):
+
+        emb_inp = _embed_sequence(decoder_inputs, num_symbols, cell.input_size, input_feeding=input_feeding)
+        emb_size = emb_inp.get_shape()[2].value
+
+        n_steps = array_ops.shape(emb_inp)[0]
+        batch = array_ops.shape(emb_inp)[1]  # Needed for reshaping.
+        attn_size = attention_states.get_shape()[2].value
+
+        # To calculate W1 * h_t we use a 1-by-1 convolution, need to reshape before.
+        hidden = array_ops.expand_dims(attention_states, 2)
+
+        initial_state_decoder = tf.zeros_like(initial_state)
+        initial_state_decoder.set_shape([None, initial_state.get_shape()[1].value])
+        batch_attn_size = array_ops.pack([batch, attn_size])
+
+        # initial attention state
+        ct = array_ops.zeros(batch_attn_size, dtype=dtype)
+        ct.set_shape([None, attn_size])
+
+        inputs_ta = tensor_array_ops.TensorArray(dtype=dtype, size=n_steps).unpack(emb_inp)
+        outputs_ta = tensor_array_ops.TensorArray(dtype=dtype, size=n_steps)
+
+        def step(time, cell_states, dt, ct, outputs_ta):
+
+            inp = inputs_ta.read(time)
+            inp.set_shape([None, emb_size])
+
+            if input_feeding:
+                # if using input_feeding, concatenate previous attention with input to layers
+                inp = array_ops.concat(1, [inp, ct])
+
+            if combine_inp_attn:
+                # Merge input and previous attentions into one vector of the right size.
+                x = cells.linear([inp] + [ct], cell.input_size, True)
+            else:
+                x = inp
+
+            ct = attention_f(decoder_hidden_state=dt, hidden_attn=hidden,
+                             initializer=initializer, window_size=window_size,
+                             content_function=content_function, dtype=dtype)
+
+            # Run the RNN.
+            cell_output, new_state = cell(x, cell_states, context=ct)
+
+            #
+            with vs.variable_scope("AttnOutputProjection", initializer=initializer):
+
+                with vs.variable_scope("AttnOutputProjection_logit_lstm", initializer=initializer):
+
+                    # if we pass a list of tensors, linear will first concatenate them over axis 1
+                    logit_lstm = cells.linear([cell_output], output_size, True)
+
+                with vs.variable_scope("AttnOutputProjection_logit_ctx", initializer=initializer):
+
+                    # if we pass a list of tensors, linear will first concatenate them over axis 1
+                    logit_ctx = cells.linear([ct], output_size, True)
+
+                with vs.variable_scope("AttnOutputProjection_logit_emb", initializer=initializer):
+
+                    # if we pass a list of tensors, linear will first concatenate them over axis 1
+                    logit_prev = cells.linear([x], output_size, True)
+
+                # if we pass a list of tensors, linear will first concatenate them over axis 1
+                output = tf.tanh(logit_lstm + logit_prev + logit_ctx)
+
+            return time + 1, new_state, cell_output, ct, outputs_ta.write(time, output)
+
+        _, cell_states, _, _, outputs_ta = control_flow_ops.while_loop(
+            lambda time, cell_states, dt, ct, outputs_ta: time < n_steps, step,
+            [array_ops.constant(0), initial_state, initial_state_decoder, ct, outputs_ta])
+
+    # the packed outputs have no static shape
+    outputs = outputs_ta.pack()
+    outputs.set_shape([None, None, output_size])
+
+    return outputs, cell_states
+
+
+def beam_search_decoder(decode_step, initial_state, attention_states, attention_mask, beam_size, max_len,
+                        output_attention_size=None, scope=None):
+    """
+
+    Beam search in a while loop: the decoder steps, the output projection, the pruning of the beams and
+        the end of the hypotheses (EOS) all run in the graph, so the sentences are translated with a
+        single session.run.
+
+    Each sentence has beam_size rows, one per rank in its beam. As in TranslationModel.batch_translation_step,
+        the beam of a sentence narrows by one for each hypothesis that ends, and the search stops when no
+        hypothesis is alive or after max_len steps.
+
+    Parameters
+    ----------
+
+    decode_step: function
+            decode_step(inputs, state, attention_states, attention_mask, decoder_states, step_num) runs one
+                decoder step on a [rows] vector of words and returns the [rows x num_symbols] probabilities of
+                the next words, the new state and the new decoder outputs (None without output attention);
+                it must reuse the variables of the decoder.
+
+    initial_state: tensor
+            2D Tensor [batch_size x state_size], the initial state of the decoder for each sentence.
+
+    attention_states: tensor
+            3D Tensor [batch_size x attn_length x attn_size], the encoder states of each sentence.
+
+    attention_mask: tensor
+            2D Tensor [batch_size x attn_length] with 1 for the positions of attention_states to attend to.
+
+    beam_size: int
+            number of hypotheses of each sentence.
+
+    max_len: int
+            maximum number of steps.
+
+    output_attention_size: int
+            size of the decoder outputs attended to by the output attention (decoder_attention_f); None
+                if the decoder has no output attention.
+
+    Returns
+    -------
+
+    words, parents, scores, status:
+            [steps x (batch_size * beam_size)] Tensors: after each step, the last word of the hypothesis of
+                each row, the row of its parent in the previous step, its score (negative log-probability)
+                and its status (BEAM_INACTIVE, BEAM_ALIVE or BEAM_FINISHED, when the last word is EOS).
+                Row r holds the hypothesis of rank r % beam_size of sentence r // beam_size.
+
+    """
+    from tensorflow.python.ops import tensor_array_ops
+
+    with tf.name_scope(scope or "beam_search_decoder"):
+
+        batch = array_ops.shape(initial_state)[0]
+        n_rows = batch * beam_size
+
+        rows = math_ops.range(n_rows)
+        row_sentences = rows // beam_size
+        # first row of each sentence
+        sentence_rows = array_ops.reshape(math_ops.range(batch) * beam_size, [-1, 1])
+        ranks = array_ops.reshape(math_ops.range(beam_size), [1, -1])
+
+        # each hypothesis attends to the encoding of its sentence
+        attention_states = array_ops.gather(attention_states, row_sentences)
+        attention_mask = array_ops.gather(attention_mask, row_sentences)
+
+        # a single (empty) hypothesis per sentence before the first step
+        state = array_ops.gather(initial_state, row_sentences)
+        words = tf.fill(array_ops.pack([n_rows]), data_utils.GO_ID)
+        hyp_scores = _INACTIVE_SCORE * tf.to_float(tf.not_equal(rows % beam_size, 0))
+        dead = tf.zeros(array_ops.pack([batch]), dtype=tf.int32)
+        # rank of each live hypothesis among the live hypotheses of its sentence
+        live_ranks = tf.zeros(array_ops.pack([n_rows]), dtype=tf.int32)
+        # [beam_size x beam_size] matrix summing the ranks before each one
+        before = tf.constant([[1.0 if i < j else 0.0 for j in xrange(beam_size)] for i in xrange(beam_size)])
+
+        # the decoder outputs of each hypothesis, after an initial zero one (as in batch_translation_step)
+        if output_attention_size is None:
+            history = tf.zeros(array_ops.pack([n_rows, 1, 1, 1]))
+        else:
+            history = tf.zeros(array_ops.pack([n_rows, max_len + 1, 1, output_attention_size]))
+            history.set_shape([None, max_len + 1, 1, output_attention_size])
+
+        words_ta = tensor_array_ops.TensorArray(dtype=tf.int32, size=0, dynamic_size=True)
+        parents_ta = tensor_array_ops.TensorArray(dtype=tf.int32, size=0, dynamic_size=True)
+        scores_ta = tensor_array_ops.TensorArray(dtype=tf.float32, size=0, dynamic_size=True)
+        status_ta = tensor_array_ops.TensorArray(dtype=tf.int32, size=0, dynamic_size=True)
+
+        def step(time, words, state, history, hyp_scores, live_ranks, dead, n_alive,
+                 words_ta, parents_ta, scores_ta, status_ta):
+
+            if output_attention_size is None:
+                decoder_states = None
+            else:
+                decoder_states = array_ops.slice(history, [0, 0, 0, 0], array_ops.pack([-1, time + 1, -1, -1]))
+
+            probabilities, state, decoder_states = decode_step(words, state, attention_states, attention_mask,
+                                                               decoder_states, time + 2)
+
+            if output_attention_size is not None:
+                rest = array_ops.slice(history, array_ops.pack([0, time + 2, 0, 0]), [-1, -1, -1, -1])
+                history = array_ops.concat(1, [decoder_states, rest])
+                history.set_shape([None, max_len + 1, 1, output_attention_size])
+
+            # the beam_size best extensions of the hypotheses of each sentence
+            num_symbols = probabilities.get_shape()[1].value
+            candidates = array_ops.reshape(hyp_scores, [-1, 1]) - math_ops.log(probabilities)
+            candidates = array_ops.reshape(candidates, [-1, beam_size * num_symbols])
+            neg_costs, indices = tf.nn.top_k(-candidates, beam_size)
+            costs = -neg_costs
+
+            parents = array_ops.reshape(indices // num_symbols + sentence_rows, [-1])
+            words = array_ops.reshape(indices % num_symbols, [-1])
+
+            # (a new hypothesis gets the cost of the candidate ranked at the position of its parent
+            # among the live hypotheses, as in batch_translation_step)
+            scores = array_ops.gather(array_ops.reshape(costs, [-1]),
+                                      parents - parents % beam_size + array_ops.gather(live_ranks, parents))
+
+            # the beam of a sentence narrows by one for each finished hypothesis
+            in_beam = math_ops.logical_and(tf.less(ranks, array_ops.reshape(beam_size - dead, [-1, 1])),
+                                           tf.less(costs, 0.5 * _INACTIVE_SCORE))
+            in_beam = array_ops.reshape(in_beam, [-1])
+
+            finished = math_ops.logical_and(in_beam, tf.equal(words, data_utils.EOS_ID))
+            alive = math_ops.logical_and(in_beam, math_ops.logical_not(finished))
+            status = BEAM_ALIVE * tf.to_int32(alive) + BEAM_FINISHED * tf.to_int32(finished)
+
+            dead += math_ops.reduce_sum(array_ops.reshape(tf.to_int32(finished), [-1, beam_size]), [1])
+            hyp_scores = tf.select(alive, scores, tf.ones_like(scores) * _INACTIVE_SCORE)
+            live_ranks = tf.to_int32(array_ops.reshape(
+                math_ops.matmul(array_ops.reshape(tf.to_float(alive), [-1, beam_size]), before), [-1]))
+            n_alive = math_ops.reduce_sum(tf.to_int32(alive))
+
+            state = array_ops.gather(state, parents)
+            if output_attention_size is not None:
+                history = array_ops.gather(history, parents)
+
+            return (time + 1, words, state, history, hyp_scores, live_ranks, dead, n_alive,
+                    words_ta.write(time, words), parents_ta.write(time, parents),
+                    scores_ta.write(time, scores), status_ta.write(time, status))
+
+        loop_vars = [array_ops.constant(0), words, state, history, hyp_scores, live_ranks, dead, batch,
+                     words_ta, parents_ta, scores_ta, status_ta]
+        loop_vars = control_flow_ops.while_loop(
+            lambda time, words, state, history, hyp_scores, live_ranks, dead, n_alive, *tas:
+                math_ops.logical_and(time < max_len, n_alive > 0),
+            step, loop_vars, back_prop=False)
+
+    return [ta.pack() for ta in loop_vars[-4:]]
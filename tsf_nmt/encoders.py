@@ -2,7 +2,6 @@ import pkg_resources
 import tensorflow as tf
 
 from tensorflow.models.rnn import rnn
-from tensorflow.python.ops import embedding_ops
 from tensorflow.python.framework import ops
 
 import cells
@@ -26,7 +25,7 @@ def reverse_encoder(source, src_embedding, encoder_cell, batch_size,
     """
     # get the embeddings
     with ops.device("/cpu:0"):
-        emb_inp = [embedding_ops.embedding_lookup(src_embedding, s) for s in source]
+        emb_inp = cells.embed_inputs(src_embedding, source)
 
     initial_state = encoder_cell.zero_state(batch_size=batch_size, dtype=dtype)
 
@@ -72,7 +71,7 @@ def bidirectional_encoder(source, src_embedding, encoder_cell_fw, encoder_cell_b
     """
     # get the embeddings
     with ops.device("/cpu:0"):
-        emb_inp = [embedding_ops.embedding_lookup(src_embedding, s) for s in source]
+        emb_inp = cells.embed_inputs(src_embedding, source)
 
     if dropout is not None:
 
@@ -92,4 +91,74 @@ def bidirectional_encoder(source, src_embedding, encoder_cell_fw, encoder_cell_b
 
         decoder_initial_state = output_state_bw
 
-    return outputs, decoder_initial_state
\ No newline at end of file
+    return outputs, decoder_initial_state
+
+
+def dynamic_reverse_encoder(source, src_embedding, encoder_cell, batch_size,
+                            dropout=None, dtype=tf.float32):
+    """
+    Same as reverse_encoder, with a while loop over the time steps (see cells.dynamic_rnn).
+
+    Parameters
+    ----------
+    source
+        a [time x batch] int Tensor; the number of time steps may be unknown.
+    src_embedding
+    encoder_cell
+    batch_size
+    dtype
+
+    Returns
+    -------
+    The [time x batch x encoder_cell.output_size] hidden states and the initial state of the decoder.
+    """
+    # get the embeddings
+    with ops.device("/cpu:0"):
+        emb_inp = cells.embed_sequence(src_embedding, source)
+
+    initial_state = encoder_cell.zero_state(batch_size=batch_size, dtype=dtype)
+
+    if dropout is not None:
+
+        for cell in encoder_cell._cells:
+            cell.input_keep_prob = 1.0 - dropout
+
+    hidden_states, decoder_initial_state = cells.dynamic_rnn(encoder_cell, emb_inp,
+                                                             initial_state=initial_state,
+                                                             scope='reverse_encoder')
+
+    return hidden_states, decoder_initial_state
+
+
+def dynamic_bidirectional_encoder(source, src_embedding, encoder_cell_fw, encoder_cell_bw,
+                                  dropout=None, dtype=tf.float32):
+    """
+    Same as bidirectional_encoder, with while loops over the time steps (see cells.dynamic_rnn).
+
+    Parameters
+    ----------
+    source
+        a [time x batch] int Tensor; the number of time steps may be unknown.
+    src_embedding
+    encoder_cell_fw
+    encoder_cell_bw
+    dtype
+
+    Returns
+    -------
+    The [time x batch x 2 * encoder size] hidden states and the initial state of the decoder.
+    """
+    # get the embeddings
+    with ops.device("/cpu:0"):
+        emb_inp = cells.embed_sequence(src_embedding, source)
+
+    if dropout is not None:
+
+        encoder_cell_fw.input_keep_prob = 1.0 - dropout
+        encoder_cell_bw.input_keep_prob = 1.0 - dropout
+
+    outputs, _, decoder_initial_state = cells.dynamic_bidirectional_rnn(
+        encoder_cell_fw, encoder_cell_bw, emb_inp, dtype=dtype, scope='bidirectional_encoder'
+    )
+
+    return outputs, decoder_initial_state
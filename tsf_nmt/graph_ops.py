@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+    Cache of the model graphs: the graph built by nmt_models is exported as a
+    MetaGraph, keyed by a hash of the model arguments, and imported by the next
+    runs instead of being built again in Python.
+
+    The handles that train_step, translation_step and train_nmt use (placeholders,
+    losses, update ops, counters...) are recorded by name in a JSON file next to
+    the MetaGraph, and the model is restored as a TranslationModel holding them.
+"""
+from __future__ import print_function
+import hashlib
+import inspect
+import json
+import os
+import tensorflow as tf
+from tensorflow.python.platform import gfile
+
+import attention
+import cells
+import content_functions
+import data_utils
+import decoders
+import encoders
+import nmt_models
+import optimization_ops
+from nmt_models import TranslationModel
+
+GRAPH_CACHE_DIR = 'graph_cache'
+META_GRAPH_SUFFIX = '.meta'
+HANDLES_SUFFIX = '.json'
+
+# Part of the signature of the cached graphs: to be increased when the format of the
+# cache entries changes, so older entries are not used.
+GRAPH_FORMAT = 2
+
+# Modules whose code builds the graphs; their source is part of the signature too.
+_GRAPH_MODULES = (attention, cells, content_functions, data_utils, decoders, encoders, nmt_models, optimization_ops)
+
+# Graph elements (or lists of graph elements) of a model, restored by name.
+_GRAPH_HANDLES = [
+    'learning_rate', 'learning_rate_decay_op', 'epoch', 'epoch_update_op',
+    'samples_seen', 'samples_seen_update_op', 'samples_seen_reset_op', 'global_step',
+    'current_loss', 'avg_loss', 'avg_loss_update_op',
+    'current_loss_value', 'avg_loss_value', 'samples_seen_value', 'epoch_value', 'sync_counters_op',
+    'best_eval_loss', 'estop_counter', 'estop_counter_update_op', 'estop_counter_reset_op',
+    'dropout_feed', 'step_num', 'summary_op',
+    'encoder_inputs', 'decoder_inputs', 'target_weights',
+    'encoder_batches', 'decoder_batches', 'weight_batches',
+    'losses', 'updates', 'gradient_norms',
+    'ret0', 'ret1', 'ret2', 'logits', 'states', 'decoder_states',
+    'decoder_init_plcholder', 'attn_plcholder', 'attn_mask_plcholder', 'decoder_states_holders',
+    'beam_search',
+]
+
+# Python attributes of a model, restored as they are.
+_VALUE_HANDLES = [
+    'buckets', 'batch_size', 'dropout', 'max_len', 'decoder_size',
+    'source_vocab_size', 'target_vocab_size', 'time_major_inputs', 'dynamic_graph',
+    'inference_lengths', 'beam_size',
+]
+
+
+def _describe(value):
+    """A JSON description of a model argument; functions are described by name."""
+    if callable(value):
+        return '%s.%s' % (value.__module__, value.__name__)
+    if isinstance(value, (list, tuple)):
+        return [_describe(v) for v in value]
+    if isinstance(value, tf.DType):
+        return value.name
+    return value
+
+
+def graph_code_identity():
+    """A string that changes whenever the code building the model graphs changes."""
+    md5 = hashlib.md5()
+    for module in _GRAPH_MODULES:
+        with open(inspect.getsourcefile(module), 'rb') as f:
+            md5.update(f.read())
+    return md5.hexdigest()
+
+
+def model_signature(model_class, model_args):
+    """Hash of everything that determines the graph built by model_class(**model_args).
+
+    Args:
+      model_class: nmt_models.Seq2SeqModel or nmt_models.NMTModel.
+      model_args: the keyword arguments of the constructor.
+    """
+    description = {'model': model_class.__name__,
+                   'args': dict((k, _describe(v)) for k, v in model_args.items()),
+                   'tensorflow': tf.__version__,
+                   'code': graph_code_identity(),
+                   'format': GRAPH_FORMAT}
+    return hashlib.sha1(json.dumps(description, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _element_names(element):
+    if element is None:
+        return None
+    if isinstance(element, (list, tuple)):
+        return [_element_names(e) for e in element]
+    return element.name
+
+
+def _graph_elements(names, graph, variables):
+    if names is None:
+        return None
+    if isinstance(names, list):
+        return [_graph_elements(n, graph, variables) for n in names]
+    if names in variables:
+        # variables are restored as such, so that .assign() and .eval() work as before
+        return variables[names]
+    return graph.as_graph_element(names)
+
+
+def export_model(model, path):
+    """Write the graph of model to path.meta and its handles to path.json.
+
+    The JSON file is written last, so its presence means the cache entry is complete.
+    """
+    handles = {'graph': {}, 'values': {}}
+    for name in _GRAPH_HANDLES:
+        if hasattr(model, name):
+            handles['graph'][name] = _element_names(getattr(model, name))
+    for name in _VALUE_HANDLES:
+        if hasattr(model, name):
+            handles['values'][name] = getattr(model, name)
+    # translation_step only checks whether there is an output attention
+    handles['values']['decoder_attention_f'] = _describe(model.decoder_attention_f)
+
+    tmp_suffix = '.%d.tmp' % os.getpid()
+    tf.train.export_meta_graph(filename=path + META_GRAPH_SUFFIX + tmp_suffix,
+                               saver_def=model.saver.as_saver_def())
+    with open(path + HANDLES_SUFFIX + tmp_suffix, 'w') as f:
+        json.dump(handles, f, indent=1, sort_keys=True)
+    os.rename(path + META_GRAPH_SUFFIX + tmp_suffix, path + META_GRAPH_SUFFIX)
+    os.rename(path + HANDLES_SUFFIX + tmp_suffix, path + HANDLES_SUFFIX)
+
+
+def import_model(path):
+    """Import the graph written by export_model into the default graph.
+
+    Returns:
+      A TranslationModel with the handles of the exported model, on which
+      train_step, get_train_batch and translation_step can be called.
+    """
+    with open(path + HANDLES_SUFFIX) as f:
+        handles = json.load(f)
+
+    saver = tf.train.import_meta_graph(path + META_GRAPH_SUFFIX)
+    graph = tf.get_default_graph()
+    variables = dict((v.name, v) for v in tf.all_variables())
+
+    model = TranslationModel()
+    for name, names in handles['graph'].items():
+        setattr(model, name, _graph_elements(names, graph, variables))
+    for name, value in handles['values'].items():
+        setattr(model, name, value)
+    model.buckets = [tuple(b) for b in model.buckets]
+
+    model.saver = saver
+    model.saver_best = tf.train.Saver(saver_def=saver.as_saver_def())
+    return model
+
+
+def cached_model(model_class, model_args, cache_dir):
+    """Import the model graph from cache_dir, or build it with model_class(**model_args) and cache it.
+
+    Args:
+      model_class: nmt_models.Seq2SeqModel or nmt_models.NMTModel.
+      model_args: the keyword arguments of the constructor.
+      cache_dir: directory of the cached graphs.
+
+    Returns:
+      The model: an instance of model_class if it was built, a TranslationModel
+      with the same handles if it was imported.
+    """
+    path = os.path.join(cache_dir, model_signature(model_class, model_args))
+
+    if gfile.Exists(path + HANDLES_SUFFIX) and gfile.Exists(path + META_GRAPH_SUFFIX):
+        print('Importing model graph from %s' % (path + META_GRAPH_SUFFIX))
+        return import_model(path)
+
+    model = model_class(**model_args)
+
+    if not gfile.Exists(cache_dir):
+        gfile.MakeDirs(cache_dir)
+    print('Caching model graph in %s' % (path + META_GRAPH_SUFFIX))
+    export_model(model, path)
+    return model
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+    Machine-readable training metrics: where the time of a training step goes,
+    token throughput, padding efficiency and number of samples of each bucket,
+    appended as JSON lines to a file of the train directory.
+"""
+from __future__ import print_function
+import json
+import time
+
+METRICS_FILE = 'metrics.jsonl'
+
+# Phases of a training step, in order:
+#   batch: sampling and assembling the batch (or waiting for the prefetcher),
+#   feed: building the feed dictionary,
+#   run: the session.run of the update,
+#   bookkeeping: counters, logging and checkpoints,
+#   validation: the evaluation on the development set.
+PHASES = ('batch', 'feed', 'run', 'bookkeeping', 'validation')
+
+
+class TrainingMetrics(object):
+    """
+    Accumulate per step measurements and write their summary every few steps.
+
+    Each record written by write() describes the steps since the previous one:
+
+        {"step": 2000, "epoch": 1, "time": 1467300000.0, "elapsed": 81.2, "steps": 200, "loss": 3.52,
+         "phases_ms": {"batch": 1.9, "feed": 0.3, "run": 395.0, "bookkeeping": 0.2, "validation": 0.0},
+         "tokens_per_sec": {"source": 1523.4, "target": 1610.8},
+         "padding_efficiency": 0.81,
+         "buckets": [{"bucket": [5, 10], "samples": 960, "padding_efficiency": 0.62}, ...],
+         ... (the extra values given to write())}
+
+    loss is the mean training loss of the steps, phases_ms are milliseconds per
+    step; the padding efficiency is the share of the encoder and decoder
+    positions fed that hold a real token.
+    """
+
+    def __init__(self, path, buckets):
+        """
+        Args:
+          path: the JSON lines file, appended to.
+          buckets: the buckets of the model.
+        """
+        self.path = path
+        self.buckets = buckets
+        self.reset()
+
+    def reset(self):
+        """Forget the steps recorded so far."""
+        self._start_time = time.time()
+        self._steps = 0
+        self._loss = 0.0
+        self._phase_times = [0.0] * len(PHASES)
+        self._samples = [0] * len(self.buckets)
+        self._tokens = [0] * len(self.buckets)
+        self._source_tokens = 0
+        self._target_tokens = 0
+
+    @property
+    def steps(self):
+        """Number of steps recorded since the last reset()."""
+        return self._steps
+
+    def record_step(self, step_loss, bucket_id, batch_size, source_tokens, target_tokens, phase_times):
+        """Account for a training step.
+
+        Args:
+          step_loss: the training loss of the step.
+          bucket_id: the bucket of the batch.
+          batch_size: number of pairs in the batch.
+          source_tokens: number of source tokens in the batch, padding excluded.
+          target_tokens: number of target tokens in the batch, padding excluded.
+          phase_times: the seconds spent in each of PHASES.
+        """
+        self._steps += 1
+        self._loss += step_loss
+        for i, t in enumerate(phase_times):
+            self._phase_times[i] += t
+        self._samples[bucket_id] += batch_size
+        self._tokens[bucket_id] += source_tokens + target_tokens
+        self._source_tokens += source_tokens
+        self._target_tokens += target_tokens
+
+    def _padding_efficiency(self, bucket_ids):
+        tokens = sum(self._tokens[b] for b in bucket_ids)
+        positions = sum(self._samples[b] * sum(self.buckets[b]) for b in bucket_ids)
+        return float(tokens) / positions if positions else None
+
+    def summary(self, **extra):
+        """The record describing the steps recorded since the last reset(), with the extra values."""
+        elapsed = time.time() - self._start_time
+        steps = max(self._steps, 1)
+
+        record = {
+            'time': time.time(),
+            'elapsed': elapsed,
+            'steps': self._steps,
+            'loss': self._loss / steps,
+            'phases_ms': dict((phase, 1000.0 * t / steps) for phase, t in zip(PHASES, self._phase_times)),
+            'tokens_per_sec': {'source': self._source_tokens / elapsed if elapsed else 0.0,
+                               'target': self._target_tokens / elapsed if elapsed else 0.0},
+            'padding_efficiency': self._padding_efficiency(range(len(self.buckets))),
+            'buckets': [{'bucket': list(bucket), 'samples': self._samples[b],
+                         'padding_efficiency': self._padding_efficiency([b])}
+                        for b, bucket in enumerate(self.buckets)],
+        }
+        record.update(extra)
+        return record
+
+    def write(self, **extra):
+        """Append the summary of the recorded steps to the metrics file and reset.
+
+        Args:
+          extra: other values of the record, e.g. step=..., epoch=..., loss=...
+        """
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(self.summary(**extra), sort_keys=True) + '\n')
+        self.reset()
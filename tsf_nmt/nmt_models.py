@@ -7,7 +7,7 @@
     and support to buckets.
 
 """
-import copy
+import itertools
 import random
 import numpy
 import pkg_resources
@@ -23,7 +23,8 @@ import data_utils
 import cells
 import encoders
 import optimization_ops
-from decoders import attention_decoder_nmt
+from decoders import attention_decoder, attention_decoder_nmt, dynamic_attention_decoder, dynamic_attention_decoder_nmt
+from decoders import beam_search_decoder, BEAM_ALIVE, BEAM_FINISHED
 
 # from six.moves import xrange
 
@@ -98,6 +99,164 @@ def model_with_buckets(encoder_inputs, decoder_inputs, targets, weights,
     return outputs, losses
 
 
+def model_with_time_major_buckets(encoder_batches, decoder_batches, weight_batches,
+                                  buckets, seq2seq_f, softmax_loss_function=None,
+                                  per_example_loss=False, name=None):
+    """Create a sequence-to-sequence model with one set of [time x batch] inputs per bucket.
+
+    Same as model_with_buckets, but each bucket is fed with three 2D Tensors instead of
+    one 1D Tensor per time step. The targets (decoder inputs shifted by one, padded with
+    a last row of zeros) and the per time step weights are sliced in-graph.
+
+    Args:
+      encoder_batches: for each bucket, a [encoder_size x batch] int32 Tensor.
+      decoder_batches: for each bucket, a [decoder_size x batch] int32 Tensor.
+      weight_batches: for each bucket, a [decoder_size x batch] float Tensor.
+      buckets: A list of pairs of (input size, output size) for each bucket.
+      seq2seq_f: A sequence-to-sequence model function; it takes the encoder and
+        decoder Tensors of a bucket and returns a pair consisting of outputs and states.
+      softmax_loss_function: Function (inputs-batch, labels-batch) -> loss-batch
+        to be used instead of the standard softmax (the default if this is None).
+      per_example_loss: Boolean. If set, the returned loss will be a batch-sized
+        tensor of losses for each sequence in the batch. If unset, it will be
+        a scalar with the averaged loss from all examples.
+      name: Optional name for this operation, defaults to "model_with_buckets".
+
+    Returns:
+      A tuple of the form (outputs, losses), as model_with_buckets.
+
+    Raises:
+      ValueError: If there is not one set of inputs per bucket.
+    """
+    if not len(encoder_batches) == len(decoder_batches) == len(weight_batches) == len(buckets):
+        raise ValueError("There must be one encoder, decoder and weight batch per bucket (%d)." % len(buckets))
+
+    all_inputs = encoder_batches + decoder_batches + weight_batches
+    losses = []
+    outputs = []
+    with ops.op_scope(all_inputs, name, "model_with_buckets"):
+        for j, bucket in enumerate(buckets):
+            with variable_scope.variable_scope(variable_scope.get_variable_scope(),
+                                               reuse=True if j > 0 else None):
+                decoder = decoder_batches[j]
+
+                # Our targets are decoder inputs shifted by one.
+                targets = array_ops.concat(0, [array_ops.slice(decoder, [1, 0], [-1, -1]),
+                                               array_ops.zeros_like(array_ops.slice(decoder, [0, 0], [1, -1]))])
+                targets = array_ops.unpack(targets, num=bucket[1])
+                weights = array_ops.unpack(weight_batches[j], num=bucket[1])
+
+                bucket_outputs, _ = seq2seq_f(encoder_batches[j], decoder)
+                outputs.append(bucket_outputs)
+
+                if per_example_loss:
+                    losses.append(seq2seq.sequence_loss_by_example(
+                        outputs[-1], targets, weights,
+                        average_across_timesteps=True,
+                        softmax_loss_function=softmax_loss_function))
+                else:
+                    losses.append(seq2seq.sequence_loss(
+                        outputs[-1], targets, weights,
+                        average_across_timesteps=True,
+                        softmax_loss_function=softmax_loss_function))
+
+    return outputs, losses
+
+
+def model_with_dynamic_length(encoder_inputs, decoder_inputs, weights, seq2seq_f,
+                              softmax_loss_function=None, name=None):
+    """Create a single sequence-to-sequence model for batches of any length.
+
+    Instead of one unrolled model per bucket, seq2seq_f builds the model once,
+    with while loops over the time steps, and it serves every bucket. The loss
+    is the one of seq2seq.sequence_loss with average_across_timesteps=True.
+
+    Args:
+      encoder_inputs: a [encoder_size x batch] int32 Tensor; encoder_size may be unknown.
+      decoder_inputs: a [decoder_size x batch] int32 Tensor; decoder_size may be unknown.
+      weights: a [decoder_size x batch] float Tensor, to weight the targets.
+      seq2seq_f: A sequence-to-sequence model function; it takes encoder_inputs and
+        decoder_inputs and returns a pair consisting of the [decoder_size x batch x size]
+        outputs and the final state.
+      softmax_loss_function: Function (inputs-batch, labels-batch) -> loss-batch
+        to be used instead of the standard softmax (the default if this is None).
+      name: Optional name for this operation, defaults to "model_with_dynamic_length".
+
+    Returns:
+      A tuple of the form (outputs, loss): the [decoder_size x batch x size] outputs
+      and the scalar loss averaged across the batch.
+    """
+    with ops.op_scope([encoder_inputs, decoder_inputs, weights], name, "model_with_dynamic_length"):
+
+        # Our targets are decoder inputs shifted by one.
+        targets = array_ops.concat(0, [array_ops.slice(decoder_inputs, [1, 0], [-1, -1]),
+                                       array_ops.zeros_like(array_ops.slice(decoder_inputs, [0, 0], [1, -1]))])
+
+        outputs, _ = seq2seq_f(encoder_inputs, decoder_inputs)
+
+        # the loss of every time step of every sentence at once
+        flat_outputs = array_ops.reshape(outputs, [-1, outputs.get_shape()[2].value])
+        flat_targets = array_ops.reshape(tf.to_int64(targets), [-1])
+        if softmax_loss_function is None:
+            crossent = nn_ops.sparse_softmax_cross_entropy_with_logits(flat_outputs, flat_targets)
+        else:
+            crossent = softmax_loss_function(flat_outputs, flat_targets)
+        crossent = array_ops.reshape(crossent, array_ops.shape(targets))
+
+        # average across the time steps of each sentence, then across the batch
+        log_perps = tf.reduce_sum(crossent * weights, [0]) / (tf.reduce_sum(weights, [0]) + 1e-12)
+        loss = tf.reduce_sum(log_perps) / tf.cast(array_ops.shape(targets)[1], log_perps.dtype)
+
+    return outputs, loss
+
+
+def _lowest(scores, k):
+    """Positions of the k lowest scores, lowest first, as scores.argsort()[:k] without sorting them all."""
+    if k >= len(scores):
+        return scores.argsort()
+    lowest = numpy.argpartition(scores, k - 1)[:k]
+    return lowest[scores[lowest].argsort()]
+
+
+def _backtrack(tokens, backpointers, step, row):
+    """The words of the hypothesis in the given row after the given step (see batch_translation_step)."""
+    hypothesis = []
+    while step >= 0:
+        hypothesis.append(tokens[step, row])
+        row = backpointers[step, row]
+        step -= 1
+    hypothesis.reverse()
+    return hypothesis
+
+
+def _sorted_translations(samples, sample_scores, normalize):
+    """The pair (hypotheses, scores) of each sentence, sorted from the best hypothesis to the worst."""
+    translations = []
+
+    for sample, sample_score in zip(samples, sample_scores):
+
+        # normalize scores according to sequence lengths
+        if normalize:
+            lengths = numpy.array([len(h) for h in sample])
+            sample_score = sample_score / lengths
+
+        # sort the samples by score (it is in log-scale, therefore lower is better)
+        sidx = numpy.argsort(sample_score)
+        sample = numpy.array(sample)[sidx]
+        sample_score = numpy.array(sample_score)[sidx]
+
+        translations.append((sample.tolist(), sample_score.tolist()))
+
+    return translations
+
+
+def inference_lengths(buckets, max_len):
+    """Source lengths of the encoders built for translation: the encoder sizes of the
+    buckets (the lengths the model was trained with) that are shorter than max_len,
+    and max_len itself for the longer sentences."""
+    return sorted(set(bucket[0] for bucket in buckets if bucket[0] < max_len)) + [max_len]
+
+
 class TranslationModel(object):
 
     def __init__(self):
@@ -105,6 +264,11 @@ class TranslationModel(object):
         self.encoder_inputs = []
         self.decoder_inputs = []
         self.target_weights = []
+        self.time_major_inputs = False
+        self.dynamic_graph = False
+        self.encoder_batches = []
+        self.decoder_batches = []
+        self.weight_batches = []
         self.dropout_feed = None
         self.updates = None
         self.gradient_norms = None
@@ -118,96 +282,175 @@ class TranslationModel(object):
         self.step_num = None
         self.decoder_init_plcholder = None
         self.attn_plcholder = None
+        self.attn_mask_plcholder = None
+        self.inference_lengths = []
+        self.beam_size = 0
+        self.beam_search = []
         self.decoder_states_holders = None
         self.decoder_attention_f = None
+        self._batch_buffers = {}
 
     def inference(self, source, target):
         raise NotImplementedError
 
+    def dynamic_inference(self, source, target):
+        raise NotImplementedError
+
+    def project_outputs(self, outputs):
+        """Apply the output projection to [time x batch x size] outputs."""
+        output_size = outputs.get_shape()[2].value
+        logits = tf.nn.xw_plus_b(array_ops.reshape(outputs, [-1, output_size]),
+                                 self.output_projection[0], self.output_projection[1])
+        return array_ops.reshape(logits, array_ops.pack([array_ops.shape(outputs)[0], -1,
+                                                         self.target_vocab_size]))
+
     def encode(self, source, batch_size, translate=False):
         raise NotImplementedError
 
-    def get_train_batch(self, data, bucket_id, batch_size=None):
+    def build_counters_sync_op(self):
+        """Create the op that writes the training counters tracked on the host into their variables.
+
+        train_nmt keeps the loss sum, the average loss, the samples seen and the epoch in
+        Python (see train_ops.TrainingCounters) and runs self.sync_counters_op, feeding
+        the *_value placeholders, only before a checkpoint is saved.
+        """
+        self.current_loss_value = tf.placeholder(tf.float32, shape=[], name="current_loss_value")
+        self.avg_loss_value = tf.placeholder(tf.float32, shape=[], name="avg_loss_value")
+        self.samples_seen_value = tf.placeholder(tf.int32, shape=[], name="samples_seen_value")
+        self.epoch_value = tf.placeholder(tf.int32, shape=[], name="epoch_value")
+        self.sync_counters_op = tf.group(self.current_loss.assign(self.current_loss_value),
+                                         self.avg_loss.assign(self.avg_loss_value),
+                                         self.samples_seen.assign(self.samples_seen_value),
+                                         self.epoch.assign(self.epoch_value))
+
+    def get_batch_buffers(self, bucket_id, batch_size, slot=0):
+        """Return the time-major buffers used to assemble batches for the given bucket.
+
+        The buffers are allocated the first time a (bucket, batch_size, slot) triple is
+        requested and reused by every following call, so building a batch does not
+        allocate memory.
+
+        Args:
+          bucket_id: integer, which bucket the buffers are for.
+          batch_size: integer, number of columns of the buffers.
+          slot: integer; batches built in different slots do not overwrite each other,
+            so several batches can be alive at the same time (see BatchPrefetcher).
+
+        Returns:
+          The triple (encoder, decoder, weights) of [time x batch] numpy matrices.
+        """
+        encoder_size, decoder_size = self.buckets[bucket_id]
+        key = (encoder_size, decoder_size, batch_size, slot)
+        if key not in self._batch_buffers:
+            self._batch_buffers[key] = (numpy.empty((encoder_size, batch_size), dtype=numpy.int32),
+                                        numpy.empty((decoder_size, batch_size), dtype=numpy.int32),
+                                        numpy.empty((decoder_size, batch_size), dtype=numpy.float32))
+        return self._batch_buffers[key]
+
+    def fill_train_batch(self, bucket_id, source, source_lengths, target, target_lengths, slot=0):
+        """Write a batch of flat token-id sequences into the time-major buffers of a bucket.
+
+        Encoder inputs are padded and then reversed, decoder inputs get an extra GO symbol
+        and are padded, and the target weights are 0 for targets that are padding, exactly
+        as the feeding format of train_step(...) expects.
+
+        Args:
+          bucket_id: integer, which bucket the batch belongs to.
+          source: 1D int array with the concatenated source sequences of the batch.
+          source_lengths: 1D int array with the length of each source sequence.
+          target: 1D int array with the concatenated target sequences (EOS included).
+          target_lengths: 1D int array with the length of each target sequence.
+          slot: integer, which set of buffers to write to (see get_batch_buffers).
+
+        Returns:
+          The triple (encoder_inputs, decoder_inputs, target_weights) of [time x batch]
+          matrices. They are views on buffers reused by the next call for the same bucket
+          and slot.
+        """
+        encoder_size, decoder_size = self.buckets[bucket_id]
+        encoder, decoder, weights = self.get_batch_buffers(bucket_id, len(source_lengths), slot)
+
+        # Encoder inputs are padded and then reversed, so the i-th token of a sentence
+        # ends up in the row (encoder_size - 1 - i) of its column.
+        batch_idx, positions = data_utils.token_positions(source_lengths)
+        encoder.fill(data_utils.PAD_ID)
+        encoder[encoder_size - 1 - positions, batch_idx] = source
+
+        # Decoder inputs get an extra "GO" symbol, and are padded then.
+        batch_idx, positions = data_utils.token_positions(target_lengths)
+        decoder.fill(data_utils.PAD_ID)
+        decoder[0] = data_utils.GO_ID
+        decoder[positions + 1, batch_idx] = target
+
+        # We set weight to 0 if the corresponding target is a PAD symbol.
+        # The corresponding target is decoder_input shifted by 1 forward.
+        numpy.not_equal(decoder[1:], data_utils.PAD_ID, out=weights[:-1])
+        weights[-1] = 0.0
+
+        return encoder, decoder, weights
+
+    def get_train_batch(self, data, bucket_id, batch_size=None, slot=0, indices=None):
         """Get a random batch of data from the specified bucket, prepare for step.
         To feed data in step(..) it must be a list of batch-major vectors, while
         data here contains single length-major cases. So the main logic of this
         function is to re-index data cases to be in the proper format for feeding.
         Args:
           data: a tuple of size len(self.buckets) in which each element contains
-            lists of pairs of input and output data that we use to create a batch.
+            lists of pairs of input and output data that we use to create a batch,
+            or a list of data_utils.TokenBucket (see read_nmt_data_compact).
           bucket_id: integer, which bucket to get the batch for.
+          batch_size: integer, number of pairs in the batch (self.batch_size by default).
+          slot: integer, which set of batch buffers to use (see get_batch_buffers).
+          indices: 1D int array with the positions of the pairs of the bucket to use
+            (see prefetch_ops.EpochSampler); if None, batch_size pairs are drawn at random.
         Returns:
           The triple (encoder_inputs, decoder_inputs, target_weights) for
-          the constructed batch that has the proper format to call step(...) later.
+          the constructed batch that has the proper format to call step(...) later,
+          plus the number of target words in the batch. The first three are
+          [time x batch] matrices whose rows are the batch-major vectors; they are
+          reused (overwritten) by the next call for the same bucket, batch size and slot.
         """
-        encoder_size, decoder_size = self.buckets[bucket_id]
-        encoder_inputs, decoder_inputs = [], []
-
-        n_target_words = 0
-        #
-        if batch_size is None:
+        if indices is not None:
+            batch_size = len(indices)
+        elif batch_size is None:
             batch_size = self.batch_size
 
-        # Get a random batch of encoder and decoder inputs from data,
-        # pad them if needed, reverse encoder inputs and add GO to decoder.
-        for _ in xrange(batch_size):
-            # encoder_input, _, decoder_input = random.choice(d)
-            encoder_input, decoder_input = random.choice(data[bucket_id])
+        bucket = data[bucket_id]
 
-            # Encoder inputs are padded and then reversed.
-            encoder_pad = [data_utils.PAD_ID] * (encoder_size - len(encoder_input))
-            encoder_inputs.append(list(reversed(encoder_input + encoder_pad)))
+        if isinstance(bucket, data_utils.TokenBucket):
 
-            n_target_words += len(decoder_input)
+            # compact buckets are sampled directly with fancy indexing
+            if indices is None:
+                indices = numpy.random.randint(0, len(bucket), batch_size)
+            source, source_lengths, target, target_lengths = bucket.gather(indices)
 
-            # Decoder inputs get an extra "GO" symbol, and are padded then.
-            decoder_pad_size = decoder_size - len(decoder_input) - 1
-            decoder_inputs.append([data_utils.GO_ID] + decoder_input +
-                                  [data_utils.PAD_ID] * decoder_pad_size)
+        else:
 
-        # Now we create batch-major vectors from the data selected above.
-        batch_encoder_inputs, batch_decoder_inputs, batch_weights = [], [], []
+            # Get a random batch of encoder and decoder inputs from data.
+            if indices is None:
+                samples = [random.choice(bucket) for _ in xrange(batch_size)]
+            else:
+                samples = [bucket[i] for i in indices]
 
-        # Batch encoder inputs are just re-indexed encoder_inputs.
-        for length_idx in xrange(encoder_size):
-            batch_encoder_inputs.append(
-                numpy.array([encoder_inputs[batch_idx][length_idx]
-                             for batch_idx in xrange(batch_size)], dtype=numpy.int32))
+            source_lengths = numpy.fromiter((len(s[0]) for s in samples), dtype=numpy.int64, count=batch_size)
+            target_lengths = numpy.fromiter((len(s[1]) for s in samples), dtype=numpy.int64, count=batch_size)
+            source = numpy.fromiter(itertools.chain.from_iterable(s[0] for s in samples), dtype=numpy.int32)
+            target = numpy.fromiter(itertools.chain.from_iterable(s[1] for s in samples), dtype=numpy.int32)
 
-        # Batch decoder inputs are re-indexed decoder_inputs, we create weights.
-        for length_idx in xrange(decoder_size):
-            batch_decoder_inputs.append(
-                numpy.array([decoder_inputs[batch_idx][length_idx]
-                             for batch_idx in xrange(batch_size)], dtype=numpy.int32))
-
-            # Create target_weights to be 0 for targets that are padding.
-            # batch_weight = numpy.ones(self.batch_size, dtype=numpy.float32)
-            batch_weight = numpy.ones(batch_size, dtype=numpy.float32)
-            # for batch_idx in xrange(self.batch_size):
-            for batch_idx in xrange(batch_size):
-                # We set weight to 0 if the corresponding target is a PAD symbol.
-                # The corresponding target is decoder_input shifted by 1 forward.
-                if length_idx < decoder_size - 1:
-                    target = decoder_inputs[batch_idx][length_idx + 1]
-                if length_idx == decoder_size - 1 or target == data_utils.PAD_ID:
-                    batch_weight[batch_idx] = 0.0
-            batch_weights.append(batch_weight)
-
-        return batch_encoder_inputs, batch_decoder_inputs, batch_weights, n_target_words
-
-    def train_step(self, session, encoder_inputs, decoder_inputs, target_weights, bucket_id, validation_step=False):
-        """Run a step of the model feeding the given inputs.
+        encoder_inputs, decoder_inputs, target_weights = self.fill_train_batch(
+            bucket_id, source, source_lengths, target, target_lengths, slot)
+
+        return encoder_inputs, decoder_inputs, target_weights, int(target_lengths.sum())
+
+    def get_train_feed(self, encoder_inputs, decoder_inputs, target_weights, bucket_id):
+        """Build the feed dictionary of train_step(...) for a batch, without the dropout rate.
         Args:
-          session: tensorflow session to use.
           encoder_inputs: list of numpy int vectors to feed as encoder inputs.
           decoder_inputs: list of numpy int vectors to feed as decoder inputs.
           target_weights: list of numpy float vectors to feed as target weights.
           bucket_id: which bucket of the model to use.
-          validation_step: whether to do the backward step or only forward.
-          softmax: whether to apply softmax to the output_logits before returning them
         Returns:
-          A triple consisting of gradient norm (or None if we did not do backward),
-          average perplexity, and the outputs.
+          A dictionary mapping placeholder names to the given inputs.
         Raises:
           ValueError: if length of enconder_inputs, decoder_inputs, or
             target_weights disagrees with bucket size for the specified bucket_id.
@@ -224,6 +467,12 @@ class TranslationModel(object):
             raise ValueError("Weights length must be equal to the one in bucket,"
                              " %d != %d." % (len(target_weights), decoder_size))
 
+        # With time-major inputs, each matrix is fed as a whole to the placeholders of the bucket.
+        if self.time_major_inputs:
+            return {self.encoder_batches[bucket_id].name: encoder_inputs,
+                    self.decoder_batches[bucket_id].name: decoder_inputs,
+                    self.weight_batches[bucket_id].name: target_weights}
+
         # Input feed: encoder inputs, decoder inputs, target_weights, as provided.
         input_feed = {}
         for l in xrange(encoder_size):
@@ -236,6 +485,31 @@ class TranslationModel(object):
         last_target = self.decoder_inputs[decoder_size].name
         input_feed[last_target] = numpy.zeros([len(encoder_inputs[0])], dtype=numpy.int32)
 
+        return input_feed
+
+    def train_step(self, session, encoder_inputs, decoder_inputs, target_weights, bucket_id, validation_step=False,
+                   input_feed=None):
+        """Run a step of the model feeding the given inputs.
+        Args:
+          session: tensorflow session to use.
+          encoder_inputs: list of numpy int vectors to feed as encoder inputs.
+          decoder_inputs: list of numpy int vectors to feed as decoder inputs.
+          target_weights: list of numpy float vectors to feed as target weights.
+          bucket_id: which bucket of the model to use.
+          validation_step: whether to do the backward step or only forward.
+          input_feed: the feed dictionary of the inputs, if it was already built
+            with get_train_feed(...); the inputs are not read then.
+          softmax: whether to apply softmax to the output_logits before returning them
+        Returns:
+          A triple consisting of gradient norm (or None if we did not do backward),
+          average perplexity, and the outputs.
+        Raises:
+          ValueError: if length of enconder_inputs, decoder_inputs, or
+            target_weights disagrees with bucket size for the specified bucket_id.
+        """
+        if input_feed is None:
+            input_feed = self.get_train_feed(encoder_inputs, decoder_inputs, target_weights, bucket_id)
+
         # Output feed: depends on whether we do a backward step or not.
         if validation_step:
             input_feed[self.dropout_feed.name] = 0.0
@@ -306,136 +580,290 @@ class TranslationModel(object):
 
         return batch_encoder_inputs, batch_decoder_inputs
 
+    def get_translate_inputs(self, token_ids_batch, length=None):
+        """Prepare a batch of sentences to be translated together by batch_translation_step(...).
+        Args:
+          token_ids_batch: list of token-id lists, one per source sentence.
+          length: number of encoder inputs (self.max_len by default).
+        Returns:
+          The pair (encoder_inputs, decoder_inputs): a [length x batch] matrix whose rows
+          are the batch-major encoder inputs (padded and then reversed, as in
+          get_translate_batch), and the vector of GO symbols of the first decoder step.
+        """
+        if length is None:
+            length = self.max_len
+
+        encoder_inputs = numpy.empty((length, len(token_ids_batch)), dtype=numpy.int32)
+
+        for batch_idx, token_ids in enumerate(token_ids_batch):
+            # Encoder inputs are padded and then reversed.
+            encoder_pad = [data_utils.PAD_ID] * (length - len(token_ids))
+            encoder_inputs[:, batch_idx] = list(reversed(list(token_ids) + encoder_pad))[:length]
+
+        decoder_inputs = numpy.empty(len(token_ids_batch), dtype=numpy.int32)
+        decoder_inputs.fill(data_utils.GO_ID)
+
+        return encoder_inputs, decoder_inputs
+
+    def get_inference_rung(self, n_tokens):
+        """Index of the shortest length of self.inference_lengths that fits n_tokens (the last one if none does)."""
+        return min([j for j, length in enumerate(self.inference_lengths) if length >= n_tokens] or
+                   [len(self.inference_lengths) - 1])
+
+    def get_translate_encoding(self, token_ids_batch):
+        """Choose the encoder of a batch of sentences to be translated together.
+        Args:
+          token_ids_batch: list of token-id lists, one per source sentence.
+        Returns:
+          The index k of the inference length of the longest sentence (see get_inference_rung),
+          the encoder and decoder inputs for that length (see get_translate_inputs), and the
+          [batch x length] attention mask that hides the padding of the shorter sentences.
+        """
+        k = self.get_inference_rung(max(len(token_ids) for token_ids in token_ids_batch))
+
+        encoder_inputs, decoder_inputs = self.get_translate_inputs(token_ids_batch, self.inference_lengths[k])
+
+        # attend to the tokens only (to everything for empty sentences)
+        attention_mask = numpy.not_equal(encoder_inputs.T, data_utils.PAD_ID).astype(numpy.float32)
+        attention_mask[attention_mask.sum(1) == 0] = 1.0
+
+        return k, encoder_inputs, decoder_inputs, attention_mask
+
+    def translate_by_rung(self, token_ids_batch, translate):
+        """Translate the sentences of each inference length separately, so that each one is
+        padded (and translated) exactly as if it was alone.
+        Args:
+          token_ids_batch: list of token-id lists, one per source sentence.
+          translate: function translating a list of token-id lists of the same inference length.
+        Returns:
+          The translations, in the order of token_ids_batch.
+        """
+        rungs = [self.get_inference_rung(len(token_ids)) for token_ids in token_ids_batch]
+        translations = [None] * len(token_ids_batch)
+
+        for k in sorted(set(rungs)):
+            positions = [i for i, rung in enumerate(rungs) if rung == k]
+            for i, translation in zip(positions, translate([token_ids_batch[i] for i in positions])):
+                translations[i] = translation
+
+        return translations
+
     def translation_step(self, session, token_ids, beam_size=5, normalize=True, dump_remaining=True):
+        """Translate a sentence with beam search (see batch_translation_step).
+        Returns:
+          The pair (hypotheses, scores), sorted from the best hypothesis to the worst.
+        """
+        return self.batch_translation_step(session, [token_ids], beam_size=beam_size, normalize=normalize,
+                                           dump_remaining=dump_remaining)[0]
 
-        sample = []
-        sample_score = []
+    def batch_translation_step(self, session, token_ids_batch, beam_size=5, normalize=True, dump_remaining=True):
+        """Translate several sentences with beam search, all of them in the same runs.
 
-        live_hyp = 1
-        dead_hyp = 0
+        The sentences are encoded with one run, and each decoder step advances the live
+        hypotheses of all the sentences with one run; the beam of each sentence is then
+        pruned separately, exactly as if it was translated alone.
 
-        hyp_samples = [[]] * live_hyp
-        hyp_scores = numpy.zeros(live_hyp).astype('float32')
+        The sentences are padded to the shortest length of self.inference_lengths that
+        fits them; sentences of different lengths of it are translated separately (see
+        translate_by_rung), since the padding goes through the encoder.
 
-        # Get a 1-element batch to feed the sentence to the model
-        encoder_inputs, decoder_inputs = self.get_translate_batch([(token_ids, [])])
-        decoder_inputs = decoder_inputs[-1]
+        If the graph holds a beam search of beam_size hypotheses (see graph_translation_step),
+        the whole search runs in the graph instead.
+
+        Args:
+          session: tensorflow session to use.
+          token_ids_batch: list of token-id lists, one per source sentence.
+          beam_size: number of hypotheses of each sentence.
+          normalize: whether to divide the scores by the length of the hypotheses.
+          dump_remaining: whether to return the hypotheses that are still alive
+            (without EOS) after max_len steps.
+        Returns:
+          A list with the pair (hypotheses, scores) of each sentence, the hypotheses sorted
+          by score (negative log-probability, lower is better).
+        """
+        if len(set(self.get_inference_rung(len(token_ids)) for token_ids in token_ids_batch)) > 1:
+            return self.translate_by_rung(token_ids_batch, lambda batch: self.batch_translation_step(
+                session, batch, beam_size=beam_size, normalize=normalize, dump_remaining=dump_remaining))
 
-        # here we encode the input sentence
+        if self.beam_search and beam_size == self.beam_size:
+            return self.graph_translation_step(session, token_ids_batch, normalize=normalize,
+                                               dump_remaining=dump_remaining)
+
+        n_sentences = len(token_ids_batch)
+
+        # finished hypotheses of each sentence, and their scores
+        samples = [[] for _ in xrange(n_sentences)]
+        sample_scores = [[] for _ in xrange(n_sentences)]
+        dead_hyp = [0] * n_sentences
+
+        # live hypotheses of each sentence; their decoder rows are consecutive, in sentence order
+        live_hyp = [1] * n_sentences
+        hyp_scores = [numpy.zeros(1).astype('float32') for _ in xrange(n_sentences)]
+        row_sentences = numpy.arange(n_sentences)
+
+        # last word and parent row (in the rows of the previous step) of the live hypotheses
+        # after each step: the hypotheses are read back from them when they are returned
+        tokens = numpy.empty((self.max_len, n_sentences * beam_size), dtype=numpy.int64)
+        backpointers = numpy.empty((self.max_len, n_sentences * beam_size), dtype=numpy.int64)
+        last_step = -1
+
+        k, encoder_inputs, decoder_inputs, attention_mask = self.get_translate_encoding(token_ids_batch)
+
+        # here we encode the input sentences
         encoder_input_feed = {}
-        for l in xrange(self.max_len):
+        for l in xrange(self.inference_lengths[k]):
             encoder_input_feed[self.encoder_inputs[l].name] = encoder_inputs[l]
 
-        # we select the last element of ret0 to keep as it is a list of hidden_states
-        encoder_output_feed = [self.ret0[-1], self.ret1, self.ret2]
+        encoder_output_feed = [self.ret1[k], self.ret2[k]]
 
-        # get the return of encoding step: hidden_states, decoder_initial_states, attention_states
+        # get the return of encoding step: decoder_initial_states, attention_states
         ret = session.run(encoder_output_feed, encoder_input_feed)
 
         # here we get info to the decode step
-        attention_states = ret[2]
-        shape = ret[1][0].shape
-        # decoder_init = numpy.tile(ret[1][0].reshape(1, shape[0]), (12, 1))
-        decoder_init = ret[1][0].reshape(1, shape[0])
-        decoder_states = numpy.zeros((1, 1, 1, self.decoder_size))
+        attention_states = ret[1]
+        decoder_init = ret[0]
+        decoder_states = numpy.zeros((n_sentences, 1, 1, self.decoder_size))
+
+        # the decoder outputs are fed back only with output attention (NMTModel has none,
+        # and the decoders without it return None)
+        output_attention = bool(self.decoder_states) and self.decoder_states[k] is not None
 
         # we must retrieve the last state to feed the decoder run
-        decoder_output_feed = [self.logits, self.states, self.decoder_states]
+        decoder_output_feed = [self.logits[k], self.states[k]]
+        if output_attention:
+            decoder_output_feed.append(self.decoder_states[k])
 
         for ii in xrange(self.max_len):
 
             session.run(self.step_num.assign(ii + 2))
 
-            # we must feed decoder_initial_state and attention_states to run one decode step
+            # we must feed decoder_initial_state and attention_states to run one decode step;
+            # each hypothesis attends to the encoding of its sentence
             decoder_input_feed = {self.decoder_inputs[0].name: decoder_inputs,
                                   self.decoder_init_plcholder.name: decoder_init,
-                                  self.attn_plcholder.name: attention_states}
-            # print ii
-            if self.decoder_attention_f:
-                # if ii == 1:
-                #     decoder_states = numpy.tile(decoder_states, (12, 1, 1, 1))
+                                  self.attn_plcholder[k].name: attention_states[row_sentences],
+                                  self.attn_mask_plcholder[k].name: attention_mask[row_sentences]}
+            if output_attention:
                 decoder_input_feed[self.decoder_states_holders.name] = decoder_states
 
-                # print "Step %d - States shape %s - Input shape %s" % (ii, decoder_states.shape, decoder_inputs.shape)
-
             ret = session.run(decoder_output_feed, decoder_input_feed)
 
-            next_p = ret[0]
+            next_log_p = numpy.log(ret[0])
             next_state = ret[1]
-            decoder_states = ret[2]
-
-            cand_scores = hyp_scores[:, None] - numpy.log(next_p)
-            cand_flat = cand_scores.flatten()
-            ranks_flat = cand_flat.argsort()[:(beam_size - dead_hyp)]
-
-            voc_size = next_p.shape[1]
-            trans_indices = ranks_flat / voc_size
-            word_indices = ranks_flat % voc_size
-            costs = cand_flat[ranks_flat]
-
-            new_hyp_samples = []
-            new_hyp_scores = numpy.zeros(beam_size - dead_hyp).astype('float32')
-            new_hyp_states = []
-            new_dec_states = []
-
-            for idx, [ti, wi] in enumerate(zip(trans_indices, word_indices)):
-                new_hyp_samples.append(hyp_samples[ti] + [wi])
-                new_hyp_scores[idx] = copy.copy(costs[ti])
-                new_hyp_states.append(copy.copy(next_state[ti]))
-                new_dec_states.append(copy.copy(decoder_states[ti]))
-
-            # check the finished samples
-            new_live_k = 0
-            hyp_samples = []
-            hyp_scores = []
-            hyp_states = []
-            dec_states = []
-
-            for idx in xrange(len(new_hyp_samples)):
-                if new_hyp_samples[idx][-1] == data_utils.EOS_ID:
-                    sample.append(new_hyp_samples[idx])
-                    sample_score.append(new_hyp_scores[idx])
-                    dead_hyp += 1
-                else:
-                    new_live_k += 1
-                    hyp_samples.append(new_hyp_samples[idx])
-                    hyp_scores.append(new_hyp_scores[idx])
-                    hyp_states.append(new_hyp_states[idx])
-                    dec_states.append(new_dec_states[idx])
 
-            dec_states = [d.reshape(1, d.shape[0], d.shape[1], d.shape[2]) for d in dec_states]
-            dec_states = numpy.concatenate(dec_states, axis=0)
+            voc_size = next_log_p.shape[1]
 
-            hyp_scores = numpy.array(hyp_scores)
-            live_hyp = new_live_k
+            # rows of the hypotheses kept alive, and their last word
+            parent_rows = []
+            next_words = []
 
-            if new_live_k < 1:
-                break
-            if dead_hyp >= beam_size:
+            row = 0
+            for s in xrange(n_sentences):
+
+                if live_hyp[s] == 0:
+                    continue
+
+                cand_flat = (hyp_scores[s][:, None] - next_log_p[row:row + live_hyp[s]]).ravel()
+                ranks_flat = _lowest(cand_flat, beam_size - dead_hyp[s])
+
+                trans_indices = ranks_flat // voc_size
+                word_indices = ranks_flat % voc_size
+                costs = cand_flat[ranks_flat]
+
+                # (a new hypothesis gets the cost of the candidate ranked at the position of its parent)
+                new_hyp_scores = costs[trans_indices]
+
+                # check the finished samples
+                finished = word_indices == data_utils.EOS_ID
+                for ti, score in zip(trans_indices[finished], new_hyp_scores[finished]):
+                    samples[s].append(_backtrack(tokens, backpointers, ii - 1, row + ti) + [data_utils.EOS_ID])
+                    sample_scores[s].append(score)
+                dead_hyp[s] += numpy.count_nonzero(finished)
+
+                alive = numpy.logical_not(finished)
+                parent_rows.append(row + trans_indices[alive])
+                next_words.append(word_indices[alive])
+
+                row += live_hyp[s]
+
+                hyp_scores[s] = new_hyp_scores[alive]
+                live_hyp[s] = len(hyp_scores[s])
+
+            parent_rows = numpy.concatenate(parent_rows)
+            if len(parent_rows) == 0:
                 break
 
-            decoder_inputs = numpy.array([w[-1] for w in hyp_samples])
-            decoder_init = numpy.array(hyp_states)
-            decoder_states = dec_states
+            decoder_inputs = numpy.concatenate(next_words)
+            decoder_init = next_state[parent_rows]
+            if output_attention:
+                decoder_states = ret[2][parent_rows]
+            row_sentences = numpy.repeat(numpy.arange(n_sentences), live_hyp)
+
+            tokens[ii, :len(parent_rows)] = decoder_inputs
+            backpointers[ii, :len(parent_rows)] = parent_rows
+            last_step = ii
 
         # dump every remaining one
         if dump_remaining:
-            if live_hyp > 0:
-                for idx in xrange(live_hyp):
-                    sample.append(hyp_samples[idx])
-                    sample_score.append(hyp_scores[idx])
+            # first row of the live hypotheses of each sentence
+            first_rows = numpy.cumsum([0] + live_hyp)
+            for s in xrange(n_sentences):
+                for r in xrange(first_rows[s], first_rows[s + 1]):
+                    samples[s].append(_backtrack(tokens, backpointers, last_step, r))
+                sample_scores[s] += list(hyp_scores[s])
 
-        # normalize scores according to sequence lengths
-        if normalize:
-            lengths = numpy.array([len(s) for s in sample])
-            sample_score = sample_score / lengths
+        return _sorted_translations(samples, sample_scores, normalize)
 
-        # sort the samples by score (it is in log-scale, therefore lower is better)
-        sidx = numpy.argsort(sample_score)
-        sample = numpy.array(sample)[sidx]
-        sample_score = numpy.array(sample_score)[sidx]
+    def graph_translation_step(self, session, token_ids_batch, normalize=True, dump_remaining=True):
+        """Translate several sentences with the beam search of the graph, in a single run.
+
+        The encoder, all the decoder steps and the pruning of the beams run in the graph
+        (see decoders.beam_search_decoder), with beams of self.beam_size hypotheses; the
+        hypotheses are then read back from the words and parent rows of each step. The
+        search is the same as in batch_translation_step.
 
-        return sample.tolist(), sample_score.tolist()
+        Args:
+          session: tensorflow session to use.
+          token_ids_batch: list of token-id lists, one per source sentence.
+          normalize: whether to divide the scores by the length of the hypotheses.
+          dump_remaining: whether to return the hypotheses that are still alive
+            (without EOS) after max_len steps.
+        Returns:
+          A list with the pair (hypotheses, scores) of each sentence, the hypotheses sorted
+          by score (negative log-probability, lower is better).
+        """
+        if len(set(self.get_inference_rung(len(token_ids)) for token_ids in token_ids_batch)) > 1:
+            return self.translate_by_rung(token_ids_batch, lambda batch: self.graph_translation_step(
+                session, batch, normalize=normalize, dump_remaining=dump_remaining))
+
+        n_sentences = len(token_ids_batch)
+
+        k, encoder_inputs, _, attention_mask = self.get_translate_encoding(token_ids_batch)
+
+        input_feed = {self.attn_mask_plcholder[k].name: attention_mask}
+        for l in xrange(self.inference_lengths[k]):
+            input_feed[self.encoder_inputs[l].name] = encoder_inputs[l]
+
+        # [steps x (n_sentences * beam_size)] matrices; row r belongs to sentence r // beam_size
+        words, parents, scores, status = session.run(self.beam_search[k], input_feed)
+        n_steps = len(words)
+
+        samples = [[] for _ in xrange(n_sentences)]
+        sample_scores = [[] for _ in xrange(n_sentences)]
+
+        for ii in xrange(n_steps):
+            for r in numpy.flatnonzero(status[ii] == BEAM_FINISHED):
+                samples[r // self.beam_size].append(_backtrack(words, parents, ii - 1, parents[ii, r]) +
+                                                    [data_utils.EOS_ID])
+                sample_scores[r // self.beam_size].append(scores[ii, r])
+
+        # dump every remaining one
+        if dump_remaining:
+            for r in numpy.flatnonzero(status[-1] == BEAM_ALIVE):
+                samples[r // self.beam_size].append(_backtrack(words, parents, n_steps - 1, r))
+                sample_scores[r // self.beam_size].append(scores[-1, r])
+
+        return _sorted_translations(samples, sample_scores, normalize)
 
 
 class Seq2SeqModel(TranslationModel):
@@ -483,6 +911,9 @@ class Seq2SeqModel(TranslationModel):
                  early_stop_patience=0,
                  save_best_model=True,
                  log_tensorboard=False,
+                 time_major_inputs=False,
+                 dynamic_graph=False,
+                 graph_beam_size=0,
                  dtype=tf.float32):
         """Create the model.
         Args:
@@ -491,6 +922,13 @@ class Seq2SeqModel(TranslationModel):
         super(Seq2SeqModel, self).__init__()
         assert decoder is not None
 
+        if dynamic_graph and not forward_only:
+            if decoder is not attention_decoder:
+                raise ValueError('The dynamic graph only supports the attention decoder without '
+                                 'output attention nor informed decoder.')
+            if log_tensorboard:
+                raise ValueError('The dynamic graph does not support the tensorboard summaries.')
+
         if cpu_only:
             device = "/cpu:0"
         else:
@@ -537,6 +975,9 @@ class Seq2SeqModel(TranslationModel):
             self.avg_loss = tf.Variable(0.0, trainable=False)
             self.avg_loss_update_op = self.avg_loss.assign(tf.div(self.current_loss, self.global_step))
 
+            # training counters kept on the host are written back with a single run
+            self.build_counters_sync_op()
+
             if early_stop_patience > 0 or save_best_model:
                 self.best_eval_loss = tf.Variable(numpy.inf, trainable=False)
                 self.estop_counter = tf.Variable(0, trainable=False)
@@ -618,12 +1059,38 @@ class Seq2SeqModel(TranslationModel):
             self.decoder_inputs = []
             self.target_weights = []
 
-            for i in xrange(buckets[-1][0]):  # Last bucket is the biggest one.
-                self.encoder_inputs.append(tf.placeholder(tf.int32, shape=[None], name="encoder{0}".format(i)))
+            # Training can feed each bucket with three [time x batch] matrices instead;
+            # with a dynamic graph, all the buckets share the same matrices (and model).
+            self.dynamic_graph = dynamic_graph and not forward_only
+            self.time_major_inputs = (time_major_inputs or dynamic_graph) and not forward_only
+
+            if self.dynamic_graph:
 
-            for i in xrange(buckets[-1][1] + 1):
-                self.decoder_inputs.append(tf.placeholder(tf.int32, shape=[None, ], name="decoder{0}".format(i)))
-                self.target_weights.append(tf.placeholder(tf.float32, shape=[None], name="weight{0}".format(i)))
+                self.encoder_batches = [tf.placeholder(tf.int32, shape=[None, None], name="encoder_batch")]
+                self.decoder_batches = [tf.placeholder(tf.int32, shape=[None, None], name="decoder_batch")]
+                self.weight_batches = [tf.placeholder(tf.float32, shape=[None, None], name="weight_batch")]
+                self.encoder_batches *= len(buckets)
+                self.decoder_batches *= len(buckets)
+                self.weight_batches *= len(buckets)
+
+            elif self.time_major_inputs:
+
+                for b, (source_size, target_size) in enumerate(buckets):
+                    self.encoder_batches.append(tf.placeholder(tf.int32, shape=[source_size, None],
+                                                               name="encoder_batch{0}".format(b)))
+                    self.decoder_batches.append(tf.placeholder(tf.int32, shape=[target_size, None],
+                                                               name="decoder_batch{0}".format(b)))
+                    self.weight_batches.append(tf.placeholder(tf.float32, shape=[target_size, None],
+                                                              name="weight_batch{0}".format(b)))
+
+            else:
+
+                for i in xrange(buckets[-1][0]):  # Last bucket is the biggest one.
+                    self.encoder_inputs.append(tf.placeholder(tf.int32, shape=[None], name="encoder{0}".format(i)))
+
+                for i in xrange(buckets[-1][1] + 1):
+                    self.decoder_inputs.append(tf.placeholder(tf.int32, shape=[None, ], name="decoder{0}".format(i)))
+                    self.target_weights.append(tf.placeholder(tf.float32, shape=[None], name="weight{0}".format(i)))
 
             # Our targets are decoder inputs shifted by one.
             targets = [self.decoder_inputs[i + 1]
@@ -641,9 +1108,6 @@ class Seq2SeqModel(TranslationModel):
 
                 b_size = array_ops.shape(self.encoder_inputs[0])[0]
 
-                # context, decoder_initial_state, attention_states, input_length
-                self.ret0, self.ret1, self.ret2 = self.encode(self.encoder_inputs, b_size)
-
                 if use_lstm:
 
                     self.decoder_init_plcholder = tf.placeholder(tf.float32,
@@ -656,30 +1120,84 @@ class Seq2SeqModel(TranslationModel):
                                                              shape=[None, (target_proj_size) * num_layers_decoder],
                                                              name="decoder_init")
 
-                # shape of this placeholder: the first None indicate the batch size and the second the input length
-                self.attn_plcholder = tf.placeholder(tf.float32,
-                                                     shape=[None, self.ret2.get_shape()[1], target_proj_size],
-                                                     name="attention_states")
-
                 # decoder_states = None
                 if self.decoder_attention_f is not None:
                     self.decoder_states_holders = tf.placeholder(tf.float32, shape=[None, None, 1, decoder_size],
                                                                  name="decoder_state")
                 decoder_states = self.decoder_states_holders
 
-                self.logits, self.states, self.decoder_states = decoder(
-                    decoder_inputs=[self.decoder_inputs[0]], initial_state=self.decoder_init_plcholder,
-                    attention_states=self.attn_plcholder, cell=self.decoder_cell,
-                    num_symbols=target_vocab_size, attention_f=attention_f,
-                    window_size=window_size, content_function=content_function,
-                    decoder_attention_f=decoder_attention_f, combine_inp_attn=combine_inp_attn,
-                    input_feeding=input_feeding, dropout=self.dropout_feed, initializer=None,
-                    decoder_states=decoder_states, step_num=self.step_num, dtype=dtype
-                )
-
-                # If we use output projection, we need to project outputs for decoding.
-                self.logits = tf.nn.xw_plus_b(self.logits[-1], self.output_projection[0], self.output_projection[1])
-                self.logits = nn_ops.softmax(self.logits)
+                # One encoder and one decoder step per source length of the ladder: a batch is encoded
+                # over the shortest length that fits its longest sentence (see batch_translation_step),
+                # and the attention is masked on the padding of the shorter ones.
+                self.inference_lengths = inference_lengths(buckets, self.max_len)
+                self.beam_size = graph_beam_size
+                self.ret0, self.ret1, self.ret2 = [], [], []
+                self.attn_plcholder, self.attn_mask_plcholder = [], []
+                self.logits, self.states, self.decoder_states = [], [], []
+
+                for j, length in enumerate(self.inference_lengths):
+                    with variable_scope.variable_scope(variable_scope.get_variable_scope(),
+                                                       reuse=True if j > 0 else None):
+
+                        # context, decoder_initial_state, attention_states, input_length
+                        ret0, ret1, ret2 = self.encode(self.encoder_inputs[:length], b_size)
+
+                        # shape of this placeholder: the first None indicate the batch size
+                        attn_plcholder = tf.placeholder(tf.float32, shape=[None, length, target_proj_size],
+                                                        name="attention_states_%d" % length)
+                        attn_mask_plcholder = tf.placeholder(tf.float32, shape=[None, length],
+                                                             name="attention_mask_%d" % length)
+
+                        def decode_step(inputs, state, attention_states, attention_mask, decoder_states, step_num):
+                            outputs, state, decoder_states = decoder(
+                                decoder_inputs=[inputs], initial_state=state,
+                                attention_states=attention_states, cell=self.decoder_cell,
+                                num_symbols=target_vocab_size, attention_f=attention_f,
+                                window_size=window_size, content_function=content_function,
+                                decoder_attention_f=decoder_attention_f, combine_inp_attn=combine_inp_attn,
+                                input_feeding=input_feeding, dropout=self.dropout_feed, initializer=None,
+                                decoder_states=decoder_states, step_num=step_num,
+                                attention_mask=attention_mask, dtype=dtype
+                            )
+
+                            # If we use output projection, we need to project outputs for decoding.
+                            logits = tf.nn.xw_plus_b(outputs[-1], self.output_projection[0], self.output_projection[1])
+                            return nn_ops.softmax(logits), state, decoder_states
+
+                        logits, states, step_decoder_states = decode_step(
+                            self.decoder_inputs[0], self.decoder_init_plcholder, attn_plcholder,
+                            attn_mask_plcholder, decoder_states, self.step_num)
+
+                        # the whole beam search of a batch of sentences in one run (see graph_translation_step)
+                        if graph_beam_size > 0:
+                            variable_scope.get_variable_scope().reuse_variables()
+                            self.beam_search.append(beam_search_decoder(
+                                decode_step, ret1, ret2, attn_mask_plcholder, graph_beam_size, self.max_len,
+                                output_attention_size=decoder_size if self.decoder_attention_f else None))
+
+                    self.ret0.append(ret0)
+                    self.ret1.append(ret1)
+                    self.ret2.append(ret2)
+                    self.attn_plcholder.append(attn_plcholder)
+                    self.attn_mask_plcholder.append(attn_mask_plcholder)
+                    self.logits.append(logits)
+                    self.states.append(states)
+                    self.decoder_states.append(step_decoder_states)
+
+            elif self.dynamic_graph:
+
+                self.outputs, loss = model_with_dynamic_length(
+                    encoder_inputs=self.encoder_batches[0], decoder_inputs=self.decoder_batches[0],
+                    weights=self.weight_batches[0], seq2seq_f=self.dynamic_inference,
+                    softmax_loss_function=loss_function)
+                self.losses = [loss] * len(buckets)
+
+            elif self.time_major_inputs:
+
+                self.outputs, self.losses = model_with_time_major_buckets(
+                    encoder_batches=self.encoder_batches, decoder_batches=self.decoder_batches,
+                    weight_batches=self.weight_batches, buckets=buckets,
+                    seq2seq_f=lambda x, y: seq2seq_f(x, y), softmax_loss_function=loss_function)
 
             else:
 
@@ -707,7 +1225,8 @@ class Seq2SeqModel(TranslationModel):
                 self.gradients = []
                 # opt = tf.train.GradientDescentOptimizer(self.learning_rate)
                 opt = optimization_ops.get_optimizer(optimizer, learning_rate)
-                for b in xrange(len(buckets)):
+                # a dynamic graph has a single loss, shared by all the buckets
+                for b in xrange(1 if self.dynamic_graph else len(buckets)):
                     grads = tf.gradients(self.losses[b], params)
                     self.gradients.append(grads)
                     clipped_gradients, norm = tf.clip_by_global_norm(grads,
@@ -715,6 +1234,10 @@ class Seq2SeqModel(TranslationModel):
                     self.gradient_norms.append(norm)
                     self.updates.append(opt.apply_gradients(
                             zip(clipped_gradients, params), global_step=self.global_step))
+                if self.dynamic_graph:
+                    self.gradients *= len(buckets)
+                    self.gradient_norms *= len(buckets)
+                    self.updates *= len(buckets)
 
             self.saver = tf.train.Saver(tf.all_variables())
             self.saver_best = tf.train.Saver(tf.all_variables())
@@ -755,7 +1278,11 @@ class Seq2SeqModel(TranslationModel):
         -------
 
         """
-        b_size = array_ops.shape(source[0])[0]
+        if isinstance(source, list):
+            b_size = array_ops.shape(source[0])[0]
+        else:
+            # a [time x batch] matrix (time-major inputs)
+            b_size = array_ops.shape(source)[1]
 
         # encode source
         context, decoder_initial_state, attention_states = self.encode(source, b_size)
@@ -796,6 +1323,45 @@ class Seq2SeqModel(TranslationModel):
 
         return context, decoder_initial_state, attention_states
 
+    def dynamic_inference(self, source, target):
+        """Same as inference, with while loops over the time steps of source and target.
+
+        Parameters
+        ----------
+        source: Tensor
+            a [time x batch] Tensor corresponding to the source sentences
+        target: Tensor
+            a [time x batch] Tensor corresponding to the target sentences
+
+        Returns
+        -------
+        The [time x batch x size] outputs (logits, unless the loss is a sampled softmax)
+            and the final state of the decoder.
+        """
+        b_size = array_ops.shape(source)[1]
+
+        # encode source
+        with tf.name_scope('reverse_encoder'):
+            context, decoder_initial_state = encoders.dynamic_reverse_encoder(
+                    source, self.src_embedding, self.encoder_cell,
+                    b_size, dropout=self.dropout_feed, dtype=self.dtype)
+            attention_states = array_ops.transpose(context, [1, 0, 2])
+
+        # decode target
+        outputs, state = dynamic_attention_decoder(
+            decoder_inputs=target, initial_state=decoder_initial_state,
+            attention_states=attention_states, cell=self.decoder_cell,
+            num_symbols=self.target_vocab_size, attention_f=self.attention_f,
+            window_size=self.window_size, content_function=self.content_function,
+            combine_inp_attn=self.combine_inp_attn, input_feeding=self.input_feeding,
+            dropout=self.dropout_feed, initializer=None, dtype=self.dtype
+        )
+
+        if self.sampled_softmax is False:
+            outputs = self.project_outputs(outputs)
+
+        return outputs, state
+
 
 class NMTModel(TranslationModel):
 
@@ -825,6 +1391,9 @@ class NMTModel(TranslationModel):
                  cpu_only=False,
                  early_stop_patience=0,
                  save_best_model=True,
+                 time_major_inputs=False,
+                 dynamic_graph=False,
+                 graph_beam_size=0,
                  dtype=tf.float32):
         super(NMTModel, self).__init__()
 
@@ -872,6 +1441,9 @@ class NMTModel(TranslationModel):
             self.avg_loss = tf.Variable(0.0, trainable=False)
             self.avg_loss_update_op = self.avg_loss.assign(tf.div(self.current_loss, self.global_step))
 
+            # training counters kept on the host are written back with a single run
+            self.build_counters_sync_op()
+
             if early_stop_patience > 0 or save_best_model:
                 self.best_eval_loss = tf.Variable(numpy.inf, trainable=False)
                 self.estop_counter = tf.Variable(0, trainable=False)
@@ -951,12 +1523,38 @@ class NMTModel(TranslationModel):
             self.decoder_inputs = []
             self.target_weights = []
 
-            for i in xrange(buckets[-1][0]):  # Last bucket is the biggest one.
-                self.encoder_inputs.append(tf.placeholder(tf.int32, shape=[None], name="encoder{0}".format(i)))
+            # Training can feed each bucket with three [time x batch] matrices instead;
+            # with a dynamic graph, all the buckets share the same matrices (and model).
+            self.dynamic_graph = dynamic_graph and not forward_only
+            self.time_major_inputs = (time_major_inputs or dynamic_graph) and not forward_only
+
+            if self.dynamic_graph:
 
-            for i in xrange(buckets[-1][1] + 1):
-                self.decoder_inputs.append(tf.placeholder(tf.int32, shape=[None, ], name="decoder{0}".format(i)))
-                self.target_weights.append(tf.placeholder(tf.float32, shape=[None], name="weight{0}".format(i)))
+                self.encoder_batches = [tf.placeholder(tf.int32, shape=[None, None], name="encoder_batch")]
+                self.decoder_batches = [tf.placeholder(tf.int32, shape=[None, None], name="decoder_batch")]
+                self.weight_batches = [tf.placeholder(tf.float32, shape=[None, None], name="weight_batch")]
+                self.encoder_batches *= len(buckets)
+                self.decoder_batches *= len(buckets)
+                self.weight_batches *= len(buckets)
+
+            elif self.time_major_inputs:
+
+                for b, (source_size, target_size) in enumerate(buckets):
+                    self.encoder_batches.append(tf.placeholder(tf.int32, shape=[source_size, None],
+                                                               name="encoder_batch{0}".format(b)))
+                    self.decoder_batches.append(tf.placeholder(tf.int32, shape=[target_size, None],
+                                                               name="decoder_batch{0}".format(b)))
+                    self.weight_batches.append(tf.placeholder(tf.float32, shape=[target_size, None],
+                                                              name="weight_batch{0}".format(b)))
+
+            else:
+
+                for i in xrange(buckets[-1][0]):  # Last bucket is the biggest one.
+                    self.encoder_inputs.append(tf.placeholder(tf.int32, shape=[None], name="encoder{0}".format(i)))
+
+                for i in xrange(buckets[-1][1] + 1):
+                    self.decoder_inputs.append(tf.placeholder(tf.int32, shape=[None, ], name="decoder{0}".format(i)))
+                    self.target_weights.append(tf.placeholder(tf.float32, shape=[None], name="weight{0}".format(i)))
 
             # Our targets are decoder inputs shifted by one.
             targets = [self.decoder_inputs[i + 1]
@@ -974,37 +1572,84 @@ class NMTModel(TranslationModel):
 
                 b_size = array_ops.shape(self.encoder_inputs[0])[0]
 
-                # context, decoder_initial_state, attention_states, input_length
-                self.ret0, self.ret1, self.ret2 = self.encode(self.encoder_inputs, b_size)
-
                 self.decoder_init_plcholder = tf.placeholder(tf.float32,
                                                              shape=[None, (target_proj_size) * 2],
                                                              name="decoder_init")
 
-                # shape of this placeholder: the first None indicate the batch size and the second the input length
-                self.attn_plcholder = tf.placeholder(tf.float32,
-                                                     shape=[None, self.ret2.get_shape()[1], target_proj_size],
-                                                     name="attention_states")
-
                 # decoder_states = None
                 if self.decoder_attention_f is not None:
                     self.decoder_states_holders = tf.placeholder(tf.float32, shape=[None, None, 1, decoder_size],
                                                                  name="decoder_state")
                 decoder_states = self.decoder_states_holders
 
-                self.logits, self.states = attention_decoder_nmt(
-                    decoder_inputs=[self.decoder_inputs[0]], initial_state=self.decoder_init_plcholder,
-                    attention_states=self.attn_plcholder, cell=self.decoder_cell,
-                    num_symbols=target_vocab_size, attention_f=attention_f,
-                    window_size=window_size, content_function=content_function,
-                    decoder_attention_f=decoder_attention_f, combine_inp_attn=combine_inp_attn,
-                    input_feeding=input_feeding, dropout=self.dropout_feed, initializer=None,
-                    dtype=dtype
-                )
-
-                # If we use output projection, we need to project outputs for decoding.
-                self.logits = tf.nn.xw_plus_b(self.logits[-1], self.output_projection[0], self.output_projection[1])
-                self.logits = nn_ops.softmax(self.logits)
+                # One encoder and one decoder step per source length of the ladder: a batch is encoded
+                # over the shortest length that fits its longest sentence (see batch_translation_step),
+                # and the attention is masked on the padding of the shorter ones.
+                self.inference_lengths = inference_lengths(buckets, self.max_len)
+                self.beam_size = graph_beam_size
+                self.ret0, self.ret1, self.ret2 = [], [], []
+                self.attn_plcholder, self.attn_mask_plcholder = [], []
+                self.logits, self.states = [], []
+
+                for j, length in enumerate(self.inference_lengths):
+                    with variable_scope.variable_scope(variable_scope.get_variable_scope(),
+                                                       reuse=True if j > 0 else None):
+
+                        # context, decoder_initial_state, attention_states, input_length
+                        ret0, ret1, ret2 = self.encode(self.encoder_inputs[:length], b_size)
+
+                        # shape of this placeholder: the first None indicate the batch size
+                        attn_plcholder = tf.placeholder(tf.float32, shape=[None, length, target_proj_size],
+                                                        name="attention_states_%d" % length)
+                        attn_mask_plcholder = tf.placeholder(tf.float32, shape=[None, length],
+                                                             name="attention_mask_%d" % length)
+
+                        def decode_step(inputs, state, attention_states, attention_mask, decoder_states, step_num):
+                            outputs, state = attention_decoder_nmt(
+                                decoder_inputs=[inputs], initial_state=state,
+                                attention_states=attention_states, cell=self.decoder_cell,
+                                num_symbols=target_vocab_size, attention_f=attention_f,
+                                window_size=window_size, content_function=content_function,
+                                decoder_attention_f=decoder_attention_f, combine_inp_attn=combine_inp_attn,
+                                input_feeding=input_feeding, dropout=self.dropout_feed, initializer=None,
+                                attention_mask=attention_mask, dtype=dtype
+                            )
+
+                            # If we use output projection, we need to project outputs for decoding.
+                            logits = tf.nn.xw_plus_b(outputs[-1], self.output_projection[0], self.output_projection[1])
+                            return nn_ops.softmax(logits), state, None
+
+                        logits, states, _ = decode_step(self.decoder_inputs[0], self.decoder_init_plcholder,
+                                                        attn_plcholder, attn_mask_plcholder, None, None)
+
+                        # the whole beam search of a batch of sentences in one run (see graph_translation_step)
+                        if graph_beam_size > 0:
+                            variable_scope.get_variable_scope().reuse_variables()
+                            self.beam_search.append(beam_search_decoder(
+                                decode_step, ret1, ret2, attn_mask_plcholder, graph_beam_size, self.max_len))
+
+                    self.ret0.append(ret0)
+                    self.ret1.append(ret1)
+                    self.ret2.append(ret2)
+                    self.attn_plcholder.append(attn_plcholder)
+                    self.attn_mask_plcholder.append(attn_mask_plcholder)
+                    self.logits.append(logits)
+                    self.states.append(states)
+
+            elif self.dynamic_graph:
+
+                self.outputs, loss = model_with_dynamic_length(
+                    encoder_inputs=self.encoder_batches[0], decoder_inputs=self.decoder_batches[0],
+                    weights=self.weight_batches[0], seq2seq_f=self.dynamic_inference,
+                    softmax_loss_function=loss_function)
+                self.losses = [loss] * len(buckets)
+
+            elif self.time_major_inputs:
+
+                self.outputs, self.losses = model_with_time_major_buckets(
+                    encoder_batches=self.encoder_batches, decoder_batches=self.decoder_batches,
+                    weight_batches=self.weight_batches, buckets=buckets,
+                    seq2seq_f=lambda x, y: seq2seq_f(x, y), softmax_loss_function=loss_function)
 
             else:
 
@@ -1031,13 +1676,17 @@ class NMTModel(TranslationModel):
                 self.updates = []
                 # opt = tf.train.GradientDescentOptimizer(self.learning_rate)
                 opt = optimization_ops.get_optimizer(optimizer, learning_rate)
-                for b in xrange(len(buckets)):
+                # a dynamic graph has a single loss, shared by all the buckets
+                for b in xrange(1 if self.dynamic_graph else len(buckets)):
                     gradients = tf.gradients(self.losses[b], params)
                     clipped_gradients, norm = tf.clip_by_global_norm(gradients,
                                                                      max_gradient_norm)
                     self.gradient_norms.append(norm)
                     self.updates.append(opt.apply_gradients(
                         zip(clipped_gradients, params), global_step=self.global_step))
+                if self.dynamic_graph:
+                    self.gradient_norms *= len(buckets)
+                    self.updates *= len(buckets)
 
             self.saver = tf.train.Saver(tf.all_variables())
             self.saver_best = tf.train.Saver(tf.all_variables())
@@ -1061,7 +1710,11 @@ class NMTModel(TranslationModel):
         -------
 
         """
-        b_size = array_ops.shape(source[0])[0]
+        if isinstance(source, list):
+            b_size = array_ops.shape(source[0])[0]
+        else:
+            # a [time x batch] matrix (time-major inputs)
+            b_size = array_ops.shape(source)[1]
 
         # encode source
         context, decoder_initial_state, attention_states = self.encode(source, b_size)
@@ -1100,4 +1753,41 @@ class NMTModel(TranslationModel):
                 ]
             attention_states = tf.concat(1, top_states)
 
-        return context, decoder_initial_state, attention_states
\ No newline at end of file
+        return context, decoder_initial_state, attention_states
+
+    def dynamic_inference(self, source, target):
+        """Same as inference, with while loops over the time steps of source and target.
+
+        Parameters
+        ----------
+        source: Tensor
+            a [time x batch] Tensor corresponding to the source sentences
+        target: Tensor
+            a [time x batch] Tensor corresponding to the target sentences
+
+        Returns
+        -------
+        The [time x batch x size] outputs (logits, unless the loss is a sampled softmax)
+            and the final state of the decoder.
+        """
+        # encode source
+        with tf.name_scope('reverse_encoder'):
+            context, decoder_initial_state = encoders.dynamic_bidirectional_encoder(
+                source, self.src_embedding, self.encoder_cell_fw, self.encoder_cell_bw,
+                dropout=self.dropout_feed, dtype=self.dtype)
+            attention_states = array_ops.transpose(context, [1, 0, 2])
+
+        # decode target
+        outputs, state = dynamic_attention_decoder_nmt(
+            decoder_inputs=target, initial_state=decoder_initial_state,
+            attention_states=attention_states, cell=self.decoder_cell,
+            num_symbols=self.target_vocab_size, attention_f=self.attention_f,
+            window_size=self.window_size, content_function=self.content_function,
+            combine_inp_attn=self.combine_inp_attn, input_feeding=self.input_feeding,
+            dropout=self.dropout_feed, initializer=None, dtype=self.dtype
+        )
+
+        if self.sampled_softmax is False:
+            outputs = self.project_outputs(outputs)
+
+        return outputs, state
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+    Order of the training batches (random or epoch-exact sampling) and their
+    background production, so the TensorFlow runtime does not idle while Python
+    samples and assembles the next batch.
+"""
+from __future__ import print_function
+import sys
+import threading
+import time
+import traceback
+import numpy
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+def choose_bucket(buckets_scale):
+    """Choose a bucket according to data distribution, as train_nmt does.
+
+    We pick a random number in [0, 1] and use the corresponding interval in buckets_scale.
+    """
+    random_number_01 = numpy.random.random_sample()
+    return min([i for i in xrange(len(buckets_scale)) if buckets_scale[i] > random_number_01])
+
+
+class RandomSampler(object):
+    """
+    Sample batches with replacement, as train_nmt always did: a bucket is chosen
+    from buckets_scale and get_train_batch draws batch_size random pairs from it.
+    """
+
+    def __init__(self, buckets_scale, batch_sizes):
+        self.buckets_scale = buckets_scale
+        self.batch_sizes = batch_sizes
+
+    def next_batch(self):
+        """Return (bucket_id, batch_size, indices) of the next batch; indices is None here."""
+        bucket_id = choose_bucket(self.buckets_scale)
+        return bucket_id, self.batch_sizes[bucket_id], None
+
+
+class EpochSampler(object):
+    """
+    Visit every pair of the training set exactly once per epoch.
+
+    Each epoch draws one permutation per bucket, cuts it into batches (the last
+    batch of a bucket may be smaller) and shuffles the batches of all buckets
+    together, so buckets are interleaved in proportion to their number of
+    batches. Batches are slices of the permutations: no pair is copied until
+    get_train_batch gathers it.
+
+    The permutations of an epoch only depend on the seed and the epoch number,
+    so training restored from a checkpoint can resume the same epoch by
+    skipping the samples already seen.
+    """
+
+    def __init__(self, bucket_sizes, batch_sizes, epoch=0, samples_seen=0, seed=1234):
+        """
+        Args:
+          bucket_sizes: number of pairs in each bucket.
+          batch_sizes: the batch size of each bucket.
+          epoch: the epoch to start from.
+          samples_seen: number of pairs of that epoch already trained on.
+          seed: base seed of the permutations.
+
+        Raises:
+          ValueError: if all buckets are empty.
+        """
+        if sum(bucket_sizes) == 0:
+            raise ValueError('Cannot iterate over empty buckets.')
+        self.bucket_sizes = bucket_sizes
+        self.batch_sizes = batch_sizes
+        self.seed = seed
+        self.epoch = epoch
+        self._start_epoch()
+
+        # skip the batches trained on before the checkpoint
+        while samples_seen > 0:
+            samples_seen -= self.next_batch()[1]
+
+    def _start_epoch(self):
+        rng = numpy.random.RandomState((self.seed + self.epoch) % (2 ** 32))
+        self._batches = []
+        for bucket_id, (bucket_size, batch_size) in enumerate(zip(self.bucket_sizes, self.batch_sizes)):
+            permutation = rng.permutation(bucket_size)
+            for start in xrange(0, bucket_size, batch_size):
+                self._batches.append((bucket_id, permutation[start:start + batch_size]))
+        self._order = rng.permutation(len(self._batches))
+        self._position = 0
+
+    def next_batch(self):
+        """Return (bucket_id, batch_size, indices) of the next batch, starting a new epoch if needed."""
+        if self._position == len(self._order):
+            self.epoch += 1
+            self._start_epoch()
+        bucket_id, indices = self._batches[self._order[self._position]]
+        self._position += 1
+        return bucket_id, len(indices), indices
+
+
+class BatchPrefetcher(object):
+    """
+    Produce training batches in a background thread and keep them in a bounded queue.
+
+    Each item of the queue is a ready batch: its bucket, the time-major inputs
+    returned by TranslationModel.get_train_batch, the number of target words
+    and the feed dictionary built by TranslationModel.get_train_feed, to be
+    passed to train_step(..., input_feed=feed). Batches follow the order given
+    by the sampler (RandomSampler or EpochSampler), exactly as in train_nmt.
+
+    The batches are assembled in capacity + 2 buffer slots used in turn: the
+    batches in the queue, the one being trained on and the one being built
+    never share memory. Slot 0 is left to the synchronous get_train_batch calls
+    of the main thread (e.g. the validation batches).
+
+    The time the consumer spends blocked in get() is accumulated in wait_time,
+    so it can be compared with the step time: if it is not close to zero, the
+    producer is the bottleneck.
+    """
+
+    def __init__(self, model, data, sampler, capacity=4):
+        """
+        Args:
+          model: a TranslationModel, used to assemble the batches.
+          data: the training set, as returned by the read_nmt_data* functions.
+          sampler: a RandomSampler or EpochSampler, the order of the batches;
+            it must not be used by anyone else while the prefetcher runs.
+          capacity: maximum number of ready batches in the queue.
+        """
+        self.model = model
+        self.data = data
+        self.sampler = sampler
+        self.capacity = capacity
+
+        self._queue = queue.Queue(maxsize=capacity)
+        self._stop = threading.Event()
+        self._thread = None
+        self._error = None
+
+        self.wait_time = 0.0
+        self.n_batches = 0
+        self.n_stalls = 0
+
+    def start(self):
+        """Start the producer thread."""
+        self._thread = threading.Thread(target=self._produce, name='BatchPrefetcher')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def _produce(self):
+        n_slots = self.capacity + 2
+        step = 0
+        try:
+            while not self._stop.is_set():
+                bucket_id, batch_size, indices = self.sampler.next_batch()
+                slot = 1 + step % n_slots
+                encoder_inputs, decoder_inputs, target_weights, n_words = self.model.get_train_batch(
+                    self.data, bucket_id, batch_size=batch_size, slot=slot, indices=indices)
+                input_feed = self.model.get_train_feed(encoder_inputs, decoder_inputs, target_weights, bucket_id)
+                batch = (bucket_id, encoder_inputs, decoder_inputs, target_weights, n_words, input_feed)
+
+                # wake up now and then to notice stop() even if nobody consumes
+                while not self._stop.is_set():
+                    try:
+                        self._queue.put(batch, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                step += 1
+        except Exception:
+            self._error = sys.exc_info()
+            self._queue.put(None)
+
+    def get(self):
+        """Return the next batch, waiting for it if the queue is empty.
+
+        Returns:
+          The tuple (bucket_id, encoder_inputs, decoder_inputs, target_weights,
+          n_words, input_feed).
+
+        Raises:
+          RuntimeError: if the producer thread failed; the original error is printed.
+        """
+        start_time = time.time()
+        if self._queue.empty():
+            self.n_stalls += 1
+        batch = self._queue.get()
+        self.wait_time += time.time() - start_time
+        self.n_batches += 1
+
+        if batch is None:
+            traceback.print_exception(*self._error)
+            raise RuntimeError('The batch producer failed.')
+        return batch
+
+    def reset_stats(self):
+        """Reset the wait time instrumentation."""
+        self.wait_time = 0.0
+        self.n_batches = 0
+        self.n_stalls = 0
+
+    def stats(self, elapsed=None):
+        """Describe the time spent waiting for batches since the last reset_stats().
+
+        Args:
+          elapsed: if given, the wall time of the same period, to report the waiting share.
+        """
+        avg_wait = 1000.0 * self.wait_time / max(self.n_batches, 1)
+        msg = 'input queue: %.2f ms/batch waiting, %d of %d batches not ready' % (avg_wait, self.n_stalls,
+                                                                                 self.n_batches)
+        if elapsed:
+            msg += ' (%.1f%% of the time blocked)' % (100.0 * self.wait_time / elapsed)
+        return msg
+
+    def stop(self):
+        """Stop the producer thread; the batches left in the queue are discarded."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
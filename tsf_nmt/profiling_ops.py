@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+"""
+    Op-level traces of chosen training steps and decode calls: the runs are
+    made with full tracing, written as Chrome-trace timelines (chrome://tracing)
+    and summarized by the module of this package that created each op.
+
+    Host-side profiles of windows of steps: the Python stacks of all the
+    threads are sampled, and written as collapsed stacks (the input of
+    flamegraph.pl and speedscope) with a summary of the top functions.
+"""
+from __future__ import print_function
+import collections
+import os
+import re
+import sys
+import threading
+import tensorflow as tf
+from tensorflow.core.framework import step_stats_pb2
+from tensorflow.python.client import timeline
+from tensorflow.python.platform import gfile
+
+TRACE_DIR = 'traces'
+TRACE_SUFFIX = '.ctf.json'
+SUMMARY_SUFFIX = '.summary.txt'
+COLLAPSED_SUFFIX = '.collapsed'
+TOP_SUFFIX = '.top.txt'
+
+# Ops are attributed to the innermost of these modules in the stack that created them...
+_MODULES = {
+    'attention.py': 'attention',
+    'cells.py': 'cells',
+    'content_functions.py': 'content_functions',
+    'decoders.py': 'decoders',
+    'encoders.py': 'encoders',
+}
+
+# ... unless a loss function comes first.
+_LOSS_FUNCTIONS = frozenset([
+    'sequence_loss', 'sequence_loss_by_example', 'sampled_softmax_loss', 'sampled_loss',
+    'model_with_dynamic_length',
+])
+
+OTHER = 'other'
+
+# gradients/<forward op>_grad/<op>, gradients_1/... for the following tf.gradients calls
+_GRADIENT_OP = re.compile(r'^gradients(?:_\d+)?/(.+)_grad/[^/]+$')
+
+
+def parse_steps(spec):
+    """The set of numbers of a specification like '100,200,500-510' (empty for '')."""
+    steps = set()
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-', 1)
+            steps.update(range(int(first), int(last) + 1))
+        else:
+            steps.add(int(part))
+    return steps
+
+
+class TracingSession(object):
+    """
+    Stand-in for a tf.Session that runs with full tracing and keeps the
+    metadata of every run, so that a call making several runs (e.g.
+    translation_step) is traced as a whole.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.graph = session.graph
+        self.run_metadata = []
+
+    def run(self, fetches, feed_dict=None, options=None, run_metadata=None):
+        if options is None:
+            options = tf.RunOptions()
+        options.trace_level = tf.RunOptions.FULL_TRACE
+        if run_metadata is None:
+            run_metadata = tf.RunMetadata()
+        outputs = self.session.run(fetches, feed_dict=feed_dict, options=options, run_metadata=run_metadata)
+        self.run_metadata.append(run_metadata)
+        return outputs
+
+    def step_stats(self):
+        """The node stats of all the runs, merged per device."""
+        devices = collections.OrderedDict()
+        for metadata in self.run_metadata:
+            for dev_stats in metadata.step_stats.dev_stats:
+                if dev_stats.device not in devices:
+                    devices[dev_stats.device] = step_stats_pb2.DeviceStepStats(device=dev_stats.device)
+                devices[dev_stats.device].node_stats.extend(dev_stats.node_stats)
+        step_stats = step_stats_pb2.StepStats()
+        step_stats.dev_stats.extend(devices.values())
+        return step_stats
+
+
+def write_chrome_trace(step_stats, graph, path):
+    """Write the timeline of step_stats in the Chrome trace format."""
+    trace = timeline.Timeline(step_stats, graph=graph)
+    with open(path, 'w') as f:
+        f.write(trace.generate_chrome_trace_format())
+
+
+class OpAttribution(object):
+    """
+    Map the ops of a graph to the module that created them, from their
+    traceback; gradient ops are mapped to the module of their forward op.
+
+    Ops of a graph imported from a MetaGraph (see graph_ops) have no creation
+    stack, they are all attributed to 'other'.
+    """
+
+    def __init__(self, graph):
+        self.graph = graph
+        self._modules = {}
+
+    def _forward_module(self, op_name):
+        try:
+            op = self.graph.get_operation_by_name(op_name)
+        except (KeyError, ValueError):
+            return OTHER
+        for filename, _, function, _ in reversed(op.traceback):
+            if function in _LOSS_FUNCTIONS:
+                return 'loss'
+            module = _MODULES.get(os.path.basename(filename))
+            if module is not None:
+                return module
+        return OTHER
+
+    def module(self, op_name):
+        """The pair (module, backward) of an op: backward tells whether it is a gradient op."""
+        if op_name not in self._modules:
+            match = _GRADIENT_OP.match(op_name)
+            if match:
+                self._modules[op_name] = (self._forward_module(match.group(1)), True)
+            else:
+                self._modules[op_name] = (self._forward_module(op_name), False)
+        return self._modules[op_name]
+
+
+def summarize_op_times(step_stats, attribution, top_ops=10):
+    """Aggregate the op times of step_stats.
+
+    Args:
+      step_stats: a StepStats proto (e.g. TracingSession.step_stats()).
+      attribution: the OpAttribution of the graph that ran.
+      top_ops: number of most expensive ops reported.
+
+    Returns:
+      A dictionary with the microseconds spent per module (forward and backward),
+      per device, and the top_ops most expensive ops as (microseconds, op name, module).
+    """
+    modules = collections.defaultdict(lambda: [0, 0])
+    devices = collections.defaultdict(int)
+    ops = collections.defaultdict(int)
+
+    for dev_stats in step_stats.dev_stats:
+        for node_stats in dev_stats.node_stats:
+            micros = node_stats.all_end_rel_micros
+            module, backward = attribution.module(node_stats.node_name)
+            modules[module][1 if backward else 0] += micros
+            devices[dev_stats.device] += micros
+            ops[node_stats.node_name] += micros
+
+    top = sorted(((micros, name) for name, micros in ops.items()), reverse=True)[:top_ops]
+    return {'modules': dict(modules),
+            'devices': dict(devices),
+            'top_ops': [(micros, name, attribution.module(name)[0]) for micros, name in top],
+            'total': sum(devices.values())}
+
+
+def format_op_summary(summary):
+    """Format the result of summarize_op_times as a table."""
+    total = max(summary['total'], 1)
+    lines = ['%-20s %12s %12s %12s %7s' % ('module', 'forward ms', 'backward ms', 'total ms', 'share')]
+    for module, (forward, backward) in sorted(summary['modules'].items(), key=lambda m: -sum(m[1])):
+        lines.append('%-20s %12.2f %12.2f %12.2f %6.1f%%' % (module, forward / 1000.0, backward / 1000.0,
+                                                              (forward + backward) / 1000.0,
+                                                              100.0 * (forward + backward) / total))
+    lines.append('')
+    for device, micros in sorted(summary['devices'].items()):
+        lines.append('%-50s %12.2f ms %6.1f%%' % (device, micros / 1000.0, 100.0 * micros / total))
+    lines.append('')
+    lines.append('most expensive ops:')
+    for micros, name, module in summary['top_ops']:
+        lines.append('  %10.2f ms  %-18s %s' % (micros / 1000.0, module, name))
+    return '\n'.join(lines)
+
+
+class StepTracer(object):
+    """
+    Trace the runs of chosen steps:
+
+        session = tracer.session(sess, step)
+        model.train_step(session=session, ...)
+        tracer.write(session, 'train-step-%d' % step)
+
+    session() returns the session itself for the steps that are not traced,
+    on which write() does nothing.
+    """
+
+    def __init__(self, steps, trace_dir):
+        """
+        Args:
+          steps: the numbers of the steps to trace.
+          trace_dir: directory of the traces and of their summaries.
+        """
+        self.steps = set(steps)
+        self.trace_dir = trace_dir
+        self._attributions = {}
+
+    def session(self, session, step):
+        """A tracing stand-in for session if step is traced, session otherwise."""
+        if step in self.steps:
+            return TracingSession(session)
+        return session
+
+    def write(self, session, name):
+        """Write the trace of the runs made with session, and print and write their summary."""
+        if not isinstance(session, TracingSession) or not session.run_metadata:
+            return
+        if not gfile.Exists(self.trace_dir):
+            gfile.MakeDirs(self.trace_dir)
+
+        step_stats = session.step_stats()
+        path = os.path.join(self.trace_dir, name)
+        write_chrome_trace(step_stats, session.graph, path + TRACE_SUFFIX)
+
+        if session.graph not in self._attributions:
+            self._attributions[session.graph] = OpAttribution(session.graph)
+        report = format_op_summary(summarize_op_times(step_stats, self._attributions[session.graph]))
+        with open(path + SUMMARY_SUFFIX, 'w') as f:
+            f.write(report + '\n')
+        print('Trace of %s written to %s\n%s' % (name, path + TRACE_SUFFIX, report))
+
+
+def create_tracer(FLAGS):
+    """The StepTracer of FLAGS.trace_steps (None if no step is traced), writing to
+    FLAGS.trace_dir, or to the traces directory of FLAGS.train_dir by default."""
+    steps = parse_steps(FLAGS.trace_steps)
+    if not steps:
+        return None
+    return StepTracer(steps, FLAGS.trace_dir or os.path.join(FLAGS.train_dir, TRACE_DIR))
+
+
+class SamplingProfiler(object):
+    """
+    Statistical profiler of the Python code: a daemon thread takes the stacks
+    of the other threads every interval seconds with sys._current_frames() and
+    counts them. Nothing is done in the profiled threads, so the overhead is
+    the sampling thread taking the GIL about 200 times per second.
+    """
+
+    def __init__(self, interval=0.005):
+        """
+        Args:
+          interval: seconds between two samples.
+        """
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        own_id = threading.current_thread().ident
+        while not self._stop.wait(self.interval):
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+                                                 code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, 'thread-%d' % thread_id))
+                self.stacks[tuple(reversed(stack))] += 1
+            self.samples += 1
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, name='SamplingProfiler')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write_collapsed(self, path):
+        """Write the stacks as 'thread;outermost;...;innermost count' lines."""
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write('%s %d\n' % (';'.join(stack), count))
+
+    def top_functions(self, n=20):
+        """The n functions with the most samples of each thread.
+
+        Returns:
+          A dictionary from thread name to a list of (self samples, total samples, function)
+          ordered by self samples: self samples are spent in the function itself, total
+          samples in the function or in the functions it calls.
+        """
+        own = collections.defaultdict(collections.Counter)
+        total = collections.defaultdict(collections.Counter)
+        for stack, count in self.stacks.items():
+            thread, frames = stack[0], stack[1:]
+            if not frames:
+                continue
+            own[thread][frames[-1]] += count
+            for function in set(frames):
+                total[thread][function] += count
+        top = {}
+        for thread in total:
+            ranked = sorted(total[thread], key=lambda f: (own[thread][f], total[thread][f]), reverse=True)
+            top[thread] = [(own[thread][f], total[thread][f], f) for f in ranked[:n]]
+        return top
+
+    def format_top_functions(self, n=20):
+        """Format the result of top_functions as one table per thread."""
+        lines = ['%d samples, one every %.1f ms' % (self.samples, 1000.0 * self.interval)]
+        for thread, functions in sorted(self.top_functions(n).items()):
+            lines.append('')
+            lines.append('thread %s' % thread)
+            lines.append('  %7s %7s  %s' % ('self %', 'total %', 'function'))
+            for own, total, function in functions:
+                lines.append('  %6.1f%% %6.1f%%  %s' % (100.0 * own / max(self.samples, 1),
+                                                      100.0 * total / max(self.samples, 1), function))
+        return '\n'.join(lines)
+
+
+class WindowProfiler(object):
+    """
+    Profile the steps of a window with a SamplingProfiler:
+
+        profiler.step(n)   # before the work of each step (or sentence) n
+        ...
+        profiler.finish()  # at the end of the loop
+
+    Profiling starts at the first step of the window and stops at the first
+    step after it; each contiguous range of steps gives a profile, written to
+    <out_dir>/<name>-<first>-<last>.collapsed and .top.txt.
+    """
+
+    def __init__(self, steps, out_dir, name, interval=0.005, top=20):
+        """
+        Args:
+          steps: the numbers of the steps to profile.
+          out_dir: directory of the profiles.
+          name: prefix of the profile files, e.g. 'train-steps'.
+          interval: seconds between two samples.
+          top: number of functions of the summary of each thread.
+        """
+        self.steps = set(steps)
+        self.out_dir = out_dir
+        self.name = name
+        self.interval = interval
+        self.top = top
+        self._profiler = None
+        self._first = self._last = None
+
+    def step(self, n):
+        """Start or stop profiling according to the number n of the step about to start."""
+        if self._profiler is not None and n not in self.steps:
+            self.finish()
+        if n in self.steps:
+            if self._profiler is None:
+                self._profiler = SamplingProfiler(self.interval).start()
+                self._first = n
+            self._last = n
+
+    def finish(self):
+        """Stop profiling, if a window is being profiled, and write its profile."""
+        if self._profiler is None:
+            return
+        self._profiler.stop()
+        if not gfile.Exists(self.out_dir):
+            gfile.MakeDirs(self.out_dir)
+        path = os.path.join(self.out_dir, '%s-%d-%d' % (self.name, self._first, self._last))
+        self._profiler.write_collapsed(path + COLLAPSED_SUFFIX)
+        report = self._profiler.format_top_functions(self.top)
+        with open(path + TOP_SUFFIX, 'w') as f:
+            f.write(report + '\n')
+        print('Profile of %s %d-%d written to %s\n%s' % (self.name, self._first, self._last,
+                                                          path + COLLAPSED_SUFFIX, report))
+        self._profiler = None
+
+
+def create_profiler(FLAGS, name):
+    """The WindowProfiler of FLAGS.profile_steps (None if no step is profiled), writing to
+    FLAGS.trace_dir, or to the traces directory of FLAGS.train_dir by default."""
+    steps = parse_steps(FLAGS.profile_steps)
+    if not steps:
+        return None
+    return WindowProfiler(steps, FLAGS.trace_dir or os.path.join(FLAGS.train_dir, TRACE_DIR), name)
@@ -8,10 +8,69 @@ import tensorflow as tf
 import time
 import sys
 import build_ops
+import checkpoint_ops
+import metrics_ops
+import prefetch_ops
+import profiling_ops
 from data_utils import read_nmt_data
 # from six.moves import xrange
 
 
+class TrainingCounters(object):
+    """
+    Host copy of the training counters of a model: global step, loss sum,
+    samples seen in the current epoch and epoch.
+
+    They are read in a single session.run when training starts and then
+    updated in Python after each step, instead of being read and assigned with
+    a few extra round trips to the runtime per step. The global step mirrors
+    the one incremented by the update op; the others are written back to the
+    model variables with sync(), which must be called before saving a
+    checkpoint.
+    """
+
+    def __init__(self, session, model):
+        self.model = model
+        global_step, current_loss, samples_seen, epoch = session.run(
+            [model.global_step, model.current_loss, model.samples_seen, model.epoch])
+        self.global_step = int(global_step)
+        self.current_loss = float(current_loss)
+        self.samples_seen = int(samples_seen)
+        self.epoch = int(epoch)
+
+    def add_step(self, step_loss, n_samples):
+        """Account for a training step on n_samples pairs with loss step_loss."""
+        self.global_step += 1
+        self.current_loss += step_loss
+        self.samples_seen += n_samples
+
+    def next_epoch(self):
+        """Start a new epoch."""
+        self.epoch += 1
+        self.samples_seen = 0
+
+    @property
+    def avg_loss(self):
+        return self.current_loss / max(self.global_step, 1)
+
+    def sync(self, session):
+        """Write the counters back into the model variables."""
+        model = self.model
+        session.run(model.sync_counters_op, feed_dict={model.current_loss_value: self.current_loss,
+                                                       model.avg_loss_value: self.avg_loss,
+                                                       model.samples_seen_value: self.samples_seen,
+                                                       model.epoch_value: self.epoch})
+
+
+def eval_batch_sizes(dev_size, batch_size):
+    """Sizes of the batches that evaluate a development bucket of dev_size pairs: full batches,
+    then a partial one for the rest (a bucket can hold less than a batch with --batch_tokens)."""
+    sizes = [batch_size] * (dev_size // batch_size)
+    if dev_size % batch_size:
+        sizes.append(dev_size % batch_size)
+    return sizes
+
+
 def train_nmt(FLAGS=None, buckets=None, save_before_training=False):
     """Train a source->target translation model using some bilingual data."""
 
@@ -22,6 +81,17 @@ def train_nmt(FLAGS=None, buckets=None, save_before_training=False):
     print('Preparing data in %s' % FLAGS.data_dir)
     src_train, tgt_train, src_dev, tgt_dev, _, _ = data_utils.prepare_nmt_data(FLAGS)
 
+    if FLAGS.auto_buckets > 0:
+        # Replace the buckets by the ones that waste the least padding on this training set.
+        source_lengths, target_lengths = data_utils.read_sentence_lengths(src_train, tgt_train,
+                                                                          binary=FLAGS.binary_corpus,
+                                                                          max_size=FLAGS.max_train_data_size)
+        planned_buckets = data_utils.plan_buckets(source_lengths, target_lengths, FLAGS.auto_buckets,
+                                                  coverage=FLAGS.bucket_coverage)
+        data_utils.print_bucket_report(source_lengths, target_lengths,
+                                       [('current', buckets), ('planned', planned_buckets)])
+        buckets = planned_buckets
+
     # summary_op = tf.merge_all_summaries()
 
     with tf.Session(config=tf.ConfigProto(allow_soft_placement=True, log_device_placement=False)) as sess:
@@ -45,19 +115,37 @@ def train_nmt(FLAGS=None, buckets=None, save_before_training=False):
 
         # Read data into buckets and compute their sizes.
         print('Reading development and training data (limit: %d).' % FLAGS.max_train_data_size)
-        dev_set = read_nmt_data(src_dev, tgt_dev, FLAGS=FLAGS, buckets=buckets)
-        train_set = read_nmt_data(src_train, tgt_train, max_size=FLAGS.max_train_data_size, FLAGS=FLAGS,
-                                  buckets=buckets)
+        if FLAGS.binary_corpus:
+            read_data = data_utils.read_nmt_data_binary
+        elif FLAGS.compact_data:
+            read_data = data_utils.read_nmt_data_compact
+        else:
+            read_data = read_nmt_data
+        dev_set = read_data(src_dev, tgt_dev, FLAGS=FLAGS, buckets=buckets)
+        train_set = read_data(src_train, tgt_train, max_size=FLAGS.max_train_data_size, FLAGS=FLAGS,
+                              buckets=buckets)
         train_bucket_sizes = [len(train_set[b]) for b in xrange(len(buckets))]
         train_total_size = float(sum(train_bucket_sizes))
 
-        print("Total number of steps per epoch: %d" % (train_total_size / FLAGS.batch_size))
+        # Sentences per batch in each bucket: fixed, or filling a token budget.
+        if FLAGS.batch_tokens > 0:
+            bucket_batch_sizes = data_utils.token_budget_batch_sizes(buckets, FLAGS.batch_tokens)
+            print('Batch size per bucket: %s' % bucket_batch_sizes)
+        else:
+            bucket_batch_sizes = [FLAGS.batch_size] * len(buckets)
+
+        # Number of batches it takes to see each bucket once.
+        train_bucket_steps = [train_bucket_sizes[b] / float(bucket_batch_sizes[b]) for b in xrange(len(buckets))]
+        train_total_steps = sum(train_bucket_steps)
+
+        print("Total number of steps per epoch: %d" % train_total_steps)
 
         # A bucket scale is a list of increasing numbers from 0 to 1 that we'll use
         # to select a bucket. Length of [scale[i], scale[i+1]] is proportional to
-        # the size if i-th training bucket, as used later.
-        train_buckets_scale = [sum(train_bucket_sizes[:i + 1]) / train_total_size
-                               for i in xrange(len(train_bucket_sizes))]
+        # the number of batches in the i-th training bucket (its size, when all the
+        # batches have the same size), so sentences are sampled uniformly.
+        train_buckets_scale = [sum(train_bucket_steps[:i + 1]) / train_total_steps
+                               for i in xrange(len(train_bucket_steps))]
 
         # This is the training loop.
         step_time = 0.0
@@ -68,260 +156,362 @@ def train_nmt(FLAGS=None, buckets=None, save_before_training=False):
         if FLAGS.log_tensorboard:
             summary_writer = tf.train.SummaryWriter(FLAGS.train_dir, sess.graph_def)
 
-        print("Optimization started...")
-        while model.epoch.eval() < FLAGS.max_epochs:
+        # Counters of the training loop, kept on the host between checkpoints.
+        counters = TrainingCounters(sess, model)
 
-            saved = False
+        # Checkpoints are written by the savers of the model, or in background.
+        checkpoint_writer = None
+        if FLAGS.async_checkpoint:
+            checkpoint_writer = checkpoint_ops.AsyncCheckpointWriter(max_checkpoints=FLAGS.max_checkpoints)
 
-            start_time = time.time()
+        # Batches built in background, see below.
+        prefetcher = None
 
-            # Choose a bucket according to data distribution. We pick a random number
-            # in [0, 1] and use the corresponding interval in train_buckets_scale.
-            random_number_01 = numpy.random.random_sample()
-            bucket_id = min([i for i in xrange(len(train_buckets_scale))
-                             if train_buckets_scale[i] > random_number_01])
+        # the checkpoints queued and the prefetcher are always closed, even if training fails
+        try:
 
-            # Get a batch and make a step.
-            encoder_inputs, decoder_inputs, target_weights, n_words = model.get_train_batch(
-                train_set, bucket_id
-            )
+            def save_checkpoint(saver, checkpoint_path):
+                counters.sync(sess)
+                if checkpoint_writer is not None:
+                    checkpoint_writer.save(sess, checkpoint_path, global_step=model.global_step)
+                else:
+                    saver.save(sess, checkpoint_path, global_step=model.global_step)
 
-            n_target_words += n_words
+            # Step-time breakdown, throughput and padding, written every metrics_interval steps.
+            metrics = None
+            if FLAGS.metrics_interval > 0:
+                metrics = metrics_ops.TrainingMetrics(os.path.join(FLAGS.train_dir, metrics_ops.METRICS_FILE),
+                                                      buckets)
 
-            # session, encoder_inputs, decoder_inputs, target_weights, bucket_id
-            # note: step loss is averaged across the batch
-            gradient_norm, step_loss, _ = model.train_step(session=sess, encoder_inputs=encoder_inputs,
-                                                           decoder_inputs=decoder_inputs,
-                                                           target_weights=target_weights,
-                                                           bucket_id=bucket_id,
-                                                           validation_step=False)
+            # Op-level traces of the steps in FLAGS.trace_steps.
+            tracer = profiling_ops.create_tracer(FLAGS)
 
-            current_step = model.global_step.eval()
+            # Profile of the Python code of the steps in FLAGS.profile_steps.
+            profiler = profiling_ops.create_profiler(FLAGS, 'train-steps')
 
-            if summary_writer is not None:
-                summary_str = sess.run(model.summary_op)
-                summary_writer.add_summary(summary_str, current_step)
+            # Order of the training batches: random, or each pair exactly once per epoch.
+            if FLAGS.epoch_shuffle:
+                sampler = prefetch_ops.EpochSampler(train_bucket_sizes, bucket_batch_sizes, epoch=counters.epoch,
+                                                    samples_seen=counters.samples_seen)
+            else:
+                sampler = prefetch_ops.RandomSampler(train_buckets_scale, bucket_batch_sizes)
 
-            # step_loss = numpy.nan
+            # Build the training batches in a background thread, if requested.
+            if FLAGS.prefetch_batches > 0:
+                prefetcher = prefetch_ops.BatchPrefetcher(model, train_set, sampler,
+                                                          capacity=FLAGS.prefetch_batches).start()
 
-            if numpy.isnan(step_loss) or numpy.isinf(step_loss):
+            print("Optimization started...")
+            while counters.epoch < FLAGS.max_epochs:
 
-                numpy.set_printoptions(linewidth=200)
+                if profiler is not None:
+                    profiler.step(counters.global_step + 1)
 
-                print('\nNaN detected\n')
-                nan_detected = True
+                saved = False
 
-                print("\nStep loss:")
-                print(step_loss)
+                start_time = time.time()
 
-                print("\nEncoder inputs: ")
-                print(encoder_inputs)
+                if prefetcher is not None:
 
-                print("\nDecoder inputs: ")
-                print(decoder_inputs)
+                    # Take the next batch (and its feed dictionary) built in background.
+                    bucket_id, encoder_inputs, decoder_inputs, target_weights, n_words, input_feed = prefetcher.get()
+                    batch_time = feed_time = time.time()
 
-                print("\nTarget weights inputs: ")
-                print(target_weights)
+                else:
 
-                print("\nGradient norm: ")
-                print(gradient_norm)
+                    # Choose a bucket (and the pairs, when iterating over epochs) with the sampler.
+                    bucket_id, batch_size, indices = sampler.next_batch()
 
-                break
+                    # Get a batch and make a step.
+                    encoder_inputs, decoder_inputs, target_weights, n_words = model.get_train_batch(
+                        train_set, bucket_id, batch_size=batch_size, indices=indices
+                    )
+                    batch_time = time.time()
+                    input_feed = model.get_train_feed(encoder_inputs, decoder_inputs, target_weights, bucket_id)
+                    feed_time = time.time()
 
-            currloss = model.current_loss.eval()
-            sess.run(model.current_loss.assign(currloss + step_loss))
+                n_target_words += n_words
+                n_samples = len(encoder_inputs[0])
+                if metrics is not None:
+                    # counted now: the batch buffers are reused by the validation
+                    n_source_words = numpy.count_nonzero(encoder_inputs != data_utils.PAD_ID)
 
-            # increase the number of seen samples
-            sess.run(model.samples_seen_update_op)
+                run_session = sess if tracer is None else tracer.session(sess, counters.global_step + 1)
 
-            if current_step % FLAGS.steps_verbosity == 0:
+                # session, encoder_inputs, decoder_inputs, target_weights, bucket_id
+                # note: step loss is averaged across the batch
+                gradient_norm, step_loss, _ = model.train_step(session=run_session, encoder_inputs=encoder_inputs,
+                                                               decoder_inputs=decoder_inputs,
+                                                               target_weights=target_weights,
+                                                               bucket_id=bucket_id,
+                                                               validation_step=False,
+                                                               input_feed=input_feed)
+                run_time = time.time()
 
-                closs = model.current_loss.eval()
-                gstep = model.global_step.eval()
-                avgloss = closs / gstep
-                sess.run(model.avg_loss.assign(avgloss))
+                counters.add_step(step_loss, n_samples)
+                current_step = counters.global_step
 
-                target_words_speed = n_target_words / words_time
+                if tracer is not None:
+                    tracer.write(run_session, 'train-step-%d' % current_step)
 
-                loss = model.avg_loss.eval()
-                ppx = math.exp(loss) if loss < 300 else float('inf')
+                if summary_writer is not None:
+                    summary_str = sess.run(model.summary_op)
+                    summary_writer.add_summary(summary_str, current_step)
 
-                if ppx > 1000.0:
-                    print(
-                    'epoch %d gl.step %d lr.rate %.4f steps-time %.2f avg.loss %.8f avg.ppx > %.8f - avg. %.2f K target words/sec' %
-                    (model.epoch.eval(), model.global_step.eval(), model.learning_rate.eval(),
-                     step_time, loss, 1000.0, (target_words_speed / 1000.0)))
-                else:
-                    print(
-                    'epoch %d gl.step %d lr.rate %.4f steps-time %.2f avg.loss %.8f avg.ppx %.8f - avg. %.2f K target words/sec' %
-                    (model.epoch.eval(), model.global_step.eval(), model.learning_rate.eval(),
-                     step_time, loss, ppx, (target_words_speed / 1000.0)))
-
-                n_target_words = 0
-                step_time = 0.0
-                words_time = 0.0
-
-            # Once in a while, we save checkpoint, print statistics, and run evals.
-            if current_step % FLAGS.steps_per_checkpoint == 0:
-                # Save checkpoint
-                checkpoint_path = os.path.join(FLAGS.train_dir, FLAGS.model_name)
-                model.saver.save(sess, checkpoint_path, global_step=model.global_step)
-                saved = True
+                # step_loss = numpy.nan
 
-                # update epoch number
-            if model.samples_seen.eval() >= train_total_size:
-                sess.run(model.epoch_update_op)
-                ep = model.epoch.eval()
-                print("Epoch %d finished..." % (ep - 1))
+                if numpy.isnan(step_loss) or numpy.isinf(step_loss):
 
-                # Save checkpoint
-                checkpoint_path = os.path.join(FLAGS.train_dir, FLAGS.model_name)
-                model.saver.save(sess, checkpoint_path, global_step=model.global_step)
-
-                if ep >= FLAGS.max_epochs:
-                    if not saved:
-                        # Save checkpoint
-                        checkpoint_path = os.path.join(FLAGS.train_dir, FLAGS.model_name)
-                        model.saver.save(sess, checkpoint_path, global_step=model.global_step)
-                    finished = True
-                    break
+                    numpy.set_printoptions(linewidth=200)
 
-                print("Epoch %d started..." % ep)
-                sess.run(model.samples_seen_reset_op)
+                    print('\nNaN detected\n')
+                    nan_detected = True
 
-                if FLAGS.start_decay > 0:
+                    print("\nStep loss:")
+                    print(step_loss)
 
-                    if FLAGS.stop_decay > 0:
+                    print("\nEncoder inputs: ")
+                    print(encoder_inputs)
 
-                        if FLAGS.start_decay <= model.epoch.eval() <= FLAGS.stop_decay:
-                            sess.run(model.learning_rate_decay_op)
+                    print("\nDecoder inputs: ")
+                    print(decoder_inputs)
 
+                    print("\nTarget weights inputs: ")
+                    print(target_weights)
+
+                    print("\nGradient norm: ")
+                    print(gradient_norm)
+
+                    break
+
+                if current_step % FLAGS.steps_verbosity == 0:
+
+                    target_words_speed = n_target_words / words_time
+
+                    loss = counters.avg_loss
+                    ppx = math.exp(loss) if loss < 300 else float('inf')
+
+                    if ppx > 1000.0:
+                        print(
+                        'epoch %d gl.step %d lr.rate %.4f steps-time %.2f avg.loss %.8f avg.ppx > %.8f - avg. %.2f K target words/sec' %
+                        (counters.epoch, current_step, model.learning_rate.eval(),
+                         step_time, loss, 1000.0, (target_words_speed / 1000.0)))
                     else:
+                        print(
+                        'epoch %d gl.step %d lr.rate %.4f steps-time %.2f avg.loss %.8f avg.ppx %.8f - avg. %.2f K target words/sec' %
+                        (counters.epoch, current_step, model.learning_rate.eval(),
+                         step_time, loss, ppx, (target_words_speed / 1000.0)))
 
-                        if FLAGS.start_decay <= model.epoch.eval():
-                            sess.run(model.learning_rate_decay_op)
+                    if prefetcher is not None:
+                        print('  %s' % prefetcher.stats(elapsed=words_time))
+                        prefetcher.reset_stats()
 
-            if current_step % FLAGS.steps_per_validation == 0:
+                    n_target_words = 0
+                    step_time = 0.0
+                    words_time = 0.0
 
-                total_eval_loss = 0.0
-                total_ppx = 0.0
+                # Once in a while, we save checkpoint, print statistics, and run evals.
+                if current_step % FLAGS.steps_per_checkpoint == 0:
+                    # Save checkpoint
+                    checkpoint_path = os.path.join(FLAGS.train_dir, FLAGS.model_name)
+                    save_checkpoint(model.saver, checkpoint_path)
+                    saved = True
 
-                print('\n')
+                    # update epoch number
+                if counters.samples_seen >= train_total_size:
+                    counters.next_epoch()
+                    ep = counters.epoch
+                    print("Epoch %d finished..." % (ep - 1))
 
-                # Run evals on development set and print their perplexity.
-                for bucket_id in xrange(len(buckets)):
+                    # Save checkpoint
+                    checkpoint_path = os.path.join(FLAGS.train_dir, FLAGS.model_name)
+                    save_checkpoint(model.saver, checkpoint_path)
 
-                    n_steps = len(dev_set[bucket_id]) / model.batch_size
+                    if ep >= FLAGS.max_epochs:
+                        if not saved:
+                            # Save checkpoint
+                            checkpoint_path = os.path.join(FLAGS.train_dir, FLAGS.model_name)
+                            save_checkpoint(model.saver, checkpoint_path)
+                        finished = True
+                        break
 
-                    bucket_loss = 0.0
+                    print("Epoch %d started..." % ep)
 
-                    for _ in xrange(n_steps):
-                        encoder_inputs, decoder_inputs, target_weights, _ = model.get_train_batch(dev_set,
-                                                                                                  bucket_id)
+                    if FLAGS.start_decay > 0:
 
-                        _, eval_loss, _ = model.train_step(session=sess, encoder_inputs=encoder_inputs,
-                                                           decoder_inputs=decoder_inputs, target_weights=target_weights,
-                                                           bucket_id=bucket_id, validation_step=True)
+                        if FLAGS.stop_decay > 0:
 
-                        bucket_loss += eval_loss
+                            if FLAGS.start_decay <= ep <= FLAGS.stop_decay:
+                                sess.run(model.learning_rate_decay_op)
 
-                    bucket_avg_loss = bucket_loss / n_steps
-                    total_eval_loss += bucket_avg_loss
+                        else:
 
-                    eval_ppx = math.exp(bucket_avg_loss) if eval_loss < 300 else float('inf')
-                    total_ppx += eval_ppx
-                    print('  eval: bucket %d perplexity %.4f' % (bucket_id, eval_ppx))
+                            if FLAGS.start_decay <= ep:
+                                sess.run(model.learning_rate_decay_op)
 
-                avg_eval_loss = total_eval_loss / len(buckets)
-                avg_ppx = math.exp(avg_eval_loss) if avg_eval_loss < 300 else float('inf')
+                bookkeeping_time = time.time()
 
-                if avg_ppx > 1000.0:
-                    print('\n  eval: averaged perplexity > 1000.0')
-                else:
-                    print('\n  eval: averaged perplexity %.8f' % avg_ppx)
-                print('  eval: averaged loss %.8f\n' % avg_eval_loss)
+                if current_step % FLAGS.steps_per_validation == 0:
 
-                sys.stdout.flush()
+                    total_eval_loss = 0.0
+                    total_ppx = 0.0
+                    n_eval_buckets = 0
+
+                    print('\n')
+
+                    # Run evals on development set and print their perplexity.
+                    for bucket_id in xrange(len(buckets)):
 
-                estop = FLAGS.early_stop_patience
+                        batch_sizes = eval_batch_sizes(len(dev_set[bucket_id]), bucket_batch_sizes[bucket_id])
 
-                # check early stop - if early stop patience is greater than 0, test it
-                if estop > 0:
+                        # an empty bucket is left out of the average
+                        if not batch_sizes:
+                            print('  eval: empty bucket %d' % bucket_id)
+                            continue
 
-                    if avg_eval_loss < model.best_eval_loss.eval():
-                        sess.run(model.best_eval_loss.assign(avg_eval_loss))
-                        sess.run(model.estop_counter_reset_op)
-                        # Save checkpoint
-                        print('Saving the best model so far...')
-                        best_model_path = os.path.join(FLAGS.best_models_dir, FLAGS.model_name + '-best')
-                        model.saver_best.save(sess, best_model_path, global_step=model.global_step)
+                        bucket_loss = 0.0
 
+                        for eval_batch_size in batch_sizes:
+                            encoder_inputs, decoder_inputs, target_weights, _ = model.get_train_batch(
+                                dev_set, bucket_id, batch_size=eval_batch_size)
+
+                            _, eval_loss, _ = model.train_step(session=sess, encoder_inputs=encoder_inputs,
+                                                               decoder_inputs=decoder_inputs, target_weights=target_weights,
+                                                               bucket_id=bucket_id, validation_step=True)
+
+                            bucket_loss += eval_loss
+
+                        bucket_avg_loss = bucket_loss / len(batch_sizes)
+                        total_eval_loss += bucket_avg_loss
+                        n_eval_buckets += 1
+
+                        eval_ppx = math.exp(bucket_avg_loss) if eval_loss < 300 else float('inf')
+                        total_ppx += eval_ppx
+                        print('  eval: bucket %d perplexity %.4f' % (bucket_id, eval_ppx))
+
+                    avg_eval_loss = total_eval_loss / max(n_eval_buckets, 1)
+                    avg_ppx = math.exp(avg_eval_loss) if avg_eval_loss < 300 else float('inf')
+
+                    if avg_ppx > 1000.0:
+                        print('\n  eval: averaged perplexity > 1000.0')
                     else:
+                        print('\n  eval: averaged perplexity %.8f' % avg_ppx)
+                    print('  eval: averaged loss %.8f\n' % avg_eval_loss)
 
-                        # if FLAGS.early_stop_after_epoch is equal to 0, it will monitor from the beginning
-                        if model.epoch.eval() >= FLAGS.early_stop_after_epoch:
+                    sys.stdout.flush()
 
-                            sess.run(model.estop_counter_update_op)
+                    estop = FLAGS.early_stop_patience
 
-                            if model.estop_counter.eval() >= estop:
-                                print('\nEARLY STOP!\n')
-                                finished = True
-                                break
+                    # check early stop - if early stop patience is greater than 0, test it
+                    if estop > 0:
 
-                    print('\n   best valid. loss: %.8f' % model.best_eval_loss.eval())
-                    print('early stop patience: %d - max %d\n' % (int(model.estop_counter.eval()), estop))
+                        if avg_eval_loss < model.best_eval_loss.eval():
+                            sess.run(model.best_eval_loss.assign(avg_eval_loss))
+                            sess.run(model.estop_counter_reset_op)
+                            # Save checkpoint
+                            print('Saving the best model so far...')
+                            best_model_path = os.path.join(FLAGS.best_models_dir, FLAGS.model_name + '-best')
+                            save_checkpoint(model.saver_best, best_model_path)
 
-            step_time += (time.time() - start_time) / FLAGS.steps_verbosity
-            words_time += (time.time() - start_time)
+                        else:
 
-        print("\nTraining finished!!\n")
+                            # if FLAGS.early_stop_after_epoch is equal to 0, it will monitor from the beginning
+                            if counters.epoch >= FLAGS.early_stop_after_epoch:
 
-        if not nan_detected:
+                                sess.run(model.estop_counter_update_op)
 
-            # # Save checkpoint
-            checkpoint_path = os.path.join(FLAGS.train_dir, FLAGS.model_name)
-            model.saver.save(sess, checkpoint_path, global_step=model.global_step)
+                                if model.estop_counter.eval() >= estop:
+                                    print('\nEARLY STOP!\n')
+                                    finished = True
+                                    break
+
+                        print('\n   best valid. loss: %.8f' % model.best_eval_loss.eval())
+                        print('early stop patience: %d - max %d\n' % (int(model.estop_counter.eval()), estop))
+
+                step_time += (time.time() - start_time) / FLAGS.steps_verbosity
+                words_time += (time.time() - start_time)
+
+                if metrics is not None:
+                    end_time = time.time()
+                    metrics.record_step(step_loss, bucket_id, n_samples, n_source_words, n_words,
+                                        [batch_time - start_time, feed_time - batch_time, run_time - feed_time,
+                                         bookkeeping_time - run_time, end_time - bookkeeping_time])
+                    if current_step % FLAGS.metrics_interval == 0:
+                        metrics.write(step=current_step, epoch=counters.epoch, avg_loss=counters.avg_loss)
 
-            print("Final validation:")
+            if profiler is not None:
+                profiler.finish()
 
-            total_eval_loss = 0.0
-            total_ppx = 0.0
+            if prefetcher is not None:
+                prefetcher.stop()
 
-            print('\n')
+            if metrics is not None and metrics.steps > 0:
+                metrics.write(step=counters.global_step, epoch=counters.epoch, avg_loss=counters.avg_loss)
 
-            # Run evals on development set and print their perplexity.
-            for bucket_id in xrange(len(buckets)):
+            print("\nTraining finished!!\n")
 
-                n_steps = len(dev_set[bucket_id]) / model.batch_size
+            if not nan_detected:
 
-                bucket_loss = 0.0
+                # # Save checkpoint
+                checkpoint_path = os.path.join(FLAGS.train_dir, FLAGS.model_name)
+                save_checkpoint(model.saver, checkpoint_path)
 
-                for _ in xrange(n_steps):
-                    encoder_inputs, decoder_inputs, target_weights, _ = model.get_train_batch(dev_set,
-                                                                                              bucket_id)
+                print("Final validation:")
 
-                    _, eval_loss, _ = model.train_step(session=sess, encoder_inputs=encoder_inputs,
-                                                       decoder_inputs=decoder_inputs, target_weights=target_weights,
-                                                       bucket_id=bucket_id)
+                total_eval_loss = 0.0
+                total_ppx = 0.0
+                n_eval_buckets = 0
 
-                    bucket_loss += eval_loss
+                print('\n')
 
-                bucket_avg_loss = bucket_loss / n_steps
-                total_eval_loss += bucket_avg_loss
+                # Run evals on development set and print their perplexity.
+                for bucket_id in xrange(len(buckets)):
 
-                eval_ppx = math.exp(bucket_avg_loss) if eval_loss < 300 else float('inf')
-                total_ppx += eval_ppx
-                print('  eval: bucket %d perplexity %.4f' % (bucket_id, eval_ppx))
+                    batch_sizes = eval_batch_sizes(len(dev_set[bucket_id]), bucket_batch_sizes[bucket_id])
 
-            avg_eval_loss = total_eval_loss / len(buckets)
-            avg_ppx = math.exp(avg_eval_loss) if avg_eval_loss < 300 else float('inf')
+                    # an empty bucket is left out of the average
+                    if not batch_sizes:
+                        print('  eval: empty bucket %d' % bucket_id)
+                        continue
 
-            if avg_ppx > 1000.0:
-                print('\n  eval: averaged perplexity > 1000.0')
-            else:
-                print('\n  eval: averaged perplexity %.8f' % avg_ppx)
-            print('  eval: averaged loss %.8f\n' % avg_eval_loss)
+                    bucket_loss = 0.0
+
+                    for eval_batch_size in batch_sizes:
+                        encoder_inputs, decoder_inputs, target_weights, _ = model.get_train_batch(
+                            dev_set, bucket_id, batch_size=eval_batch_size)
+
+                        _, eval_loss, _ = model.train_step(session=sess, encoder_inputs=encoder_inputs,
+                                                           decoder_inputs=decoder_inputs, target_weights=target_weights,
+                                                           bucket_id=bucket_id)
+
+                        bucket_loss += eval_loss
+
+                    bucket_avg_loss = bucket_loss / len(batch_sizes)
+                    total_eval_loss += bucket_avg_loss
+                    n_eval_buckets += 1
+
+                    eval_ppx = math.exp(bucket_avg_loss) if eval_loss < 300 else float('inf')
+                    total_ppx += eval_ppx
+                    print('  eval: bucket %d perplexity %.4f' % (bucket_id, eval_ppx))
+
+                avg_eval_loss = total_eval_loss / max(n_eval_buckets, 1)
+                avg_ppx = math.exp(avg_eval_loss) if avg_eval_loss < 300 else float('inf')
+
+                if avg_ppx > 1000.0:
+                    print('\n  eval: averaged perplexity > 1000.0')
+                else:
+                    print('\n  eval: averaged perplexity %.8f' % avg_ppx)
+                print('  eval: averaged loss %.8f\n' % avg_eval_loss)
+
+                print('\n   best valid. loss during training: %.8f' % model.best_eval_loss.eval())
+
+                sys.stdout.flush()
+
+        finally:
 
-            print('\n   best valid. loss during training: %.8f' % model.best_eval_loss.eval())
+            if prefetcher is not None:
+                prefetcher.stop()
 
-            sys.stdout.flush()
+            if checkpoint_writer is not None:
+                # wait for the last checkpoints to be written
+                checkpoint_writer.close()
@@ -52,11 +52,25 @@ flags.DEFINE_string('optimizer', 'adam', 'Name of the optimizer to use (adagrad,
 
 flags.DEFINE_float('max_gradient_norm', 5.0, 'Clip gradients to this norm.')
 flags.DEFINE_integer('batch_size', 32, 'Batch size to use during training.')
+flags.DEFINE_integer('batch_tokens', 0, 'If > 0, fill each training batch with up to this many source + target tokens (padding included) instead of batch_size sentences.')
+flags.DEFINE_integer('prefetch_batches', 0, 'If > 0, build up to this many training batches ahead in a background thread.')
+flags.DEFINE_boolean('epoch_shuffle', False, 'Whether to visit every training pair exactly once per epoch, in a shuffled order, instead of sampling with replacement.')
+flags.DEFINE_boolean('time_major_inputs', False, 'Whether to feed each training bucket with [time x batch] matrices instead of one placeholder per time step.')
+flags.DEFINE_boolean('dynamic_graph', False, 'Whether to train a single model with while loops over the time steps, shared by all the buckets, instead of one unrolled model per bucket (global attention only).')
+flags.DEFINE_boolean('graph_cache', False, 'Whether to import the model graph cached in train_dir by a previous run with the same model flags, instead of building it.')
 flags.DEFINE_integer('beam_size', 12, 'Max size of the beam used for decoding.')
+flags.DEFINE_integer('decode_batch_size', 64, 'Number of sentences of similar length translated together when decoding a file.')
+flags.DEFINE_integer('decode_chunk_size', 10000, 'Number of lines read, sorted by length and batched at once when decoding a file.')
+flags.DEFINE_boolean('graph_beam_search', False, 'Whether to build the beam search in the graph and translate each batch of sentences with a single run.')
 flags.DEFINE_integer('num_samples_loss', 512, 'Number of samples to use in sampled softmax. Set to 0 to use regular loss.')
 flags.DEFINE_integer('max_len', 120, 'Max size of the beam used for decoding.')
 flags.DEFINE_integer('max_epochs', 20,  'Max number of epochs to use during training. The actual value will be (max_epochs-1) as it is 0-based.')
 flags.DEFINE_integer('max_train_data_size', 0, 'Limit on the size of training data (0: no limit).')
+flags.DEFINE_boolean('compact_data', False, 'Whether to keep the training data in compact numpy buckets instead of Python lists.')
+flags.DEFINE_boolean('binary_corpus', False, 'Whether to save the token-ids as memory-mapped binary corpora instead of text files.')
+flags.DEFINE_integer('preprocess_workers', 1, 'Number of processes used to create the vocabularies and the token-ids.')
+flags.DEFINE_integer('auto_buckets', 0, 'If > 0, replace the buckets by this many buckets planned from the training data lengths.')
+flags.DEFINE_float('bucket_coverage', 0.99, 'Minimum fraction of training pairs that must fit into the planned buckets.')
 flags.DEFINE_boolean('cpu_only', False, 'Whether or not to use GPU only.')
 
 # flags related to model architecture
@@ -93,8 +107,14 @@ flags.DEFINE_string('target_lang', 'pt', 'Target language extension.')
 
 # verbosity and checkpoints
 flags.DEFINE_integer('steps_per_checkpoint', 500, 'How many training steps to do per checkpoint.')
+flags.DEFINE_boolean('async_checkpoint', False, 'Whether to write the checkpoints in a background thread while training continues.')
+flags.DEFINE_integer('max_checkpoints', 5, 'Number of checkpoints kept in each directory by the background checkpoint writer.')
 flags.DEFINE_integer('steps_per_validation', 1000, 'How many training steps to do between each validation.')
 flags.DEFINE_integer('steps_verbosity', 10, 'How many training steps to do between each information print.')
+flags.DEFINE_integer('metrics_interval', 0, 'Append the step-time breakdown, throughput and padding of the last steps to metrics.jsonl in the train dir every this many steps (0 disables).')
+flags.DEFINE_string('trace_steps', '', 'Training steps (or decoded sentences, or batches when decoding a file) whose runs are traced, e.g. "100,200-202"; a Chrome-trace timeline and a summary of the op times per module are written for each.')
+flags.DEFINE_string('trace_dir', '', 'Directory of the traces (default: traces in the train dir).')
+flags.DEFINE_string('profile_steps', '', 'Training steps (or decoded sentences, or batches when decoding a file) whose Python code is profiled by sampling, e.g. "1000-1100"; collapsed stacks and the top functions are written to the trace dir.')
 flags.DEFINE_boolean('log_tensorboard', False, 'Whether or not to use Tensorboard to log info about training. Default to False.')
 
 # pacience flags (learning_rate decay and early stop)
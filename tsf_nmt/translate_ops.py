@@ -8,10 +8,55 @@ import time
 from tensorflow.python.platform import gfile
 
 import data_utils
+import profiling_ops
 from build_ops import create_seq2seq_model
 
 
+def _read_chunks(source, chunk_size):
+    """Yield the lines of source in lists of (at most) chunk_size lines."""
+    chunk = []
+    line = source.readline()
+    while line:
+        chunk.append(line)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+        line = source.readline()
+    if chunk:
+        yield chunk
+
+
+def length_sorted_batches(all_token_ids, batch_size, inference_rung=None):
+    """Split sentences into batches of similar source lengths, to waste the least padding.
+
+    Args:
+      all_token_ids: list of token-id lists.
+      batch_size: maximum number of sentences of a batch.
+      inference_rung: function giving the encoder length used for a number of tokens
+        (TranslationModel.get_inference_rung); a batch never mixes sentences of
+        different encoder lengths, which would be translated separately.
+
+    Returns:
+      A list of lists of positions in all_token_ids, one per batch.
+    """
+    def rung(i):
+        return inference_rung(len(all_token_ids[i])) if inference_rung is not None else 0
+
+    batches = []
+    for i in sorted(xrange(len(all_token_ids)), key=lambda i: len(all_token_ids[i])):
+        if not batches or len(batches[-1]) == batch_size or rung(batches[-1][-1]) != rung(i):
+            batches.append([])
+        batches[-1].append(i)
+    return batches
+
+
 def decode_from_file(files, model_path=None, use_best=False, get_ids=True, FLAGS=None, buckets=None):
+    """Translate each file into file.trans, line by line.
+
+    The files are read by chunks of FLAGS.decode_chunk_size lines; the sentences of
+    a chunk are sorted by length and translated by batches of FLAGS.decode_batch_size
+    (see TranslationModel.batch_translation_step), then written in their original order.
+    """
 
     assert FLAGS is not None
     assert buckets is not None
@@ -23,6 +68,13 @@ def decode_from_file(files, model_path=None, use_best=False, get_ids=True, FLAGS
                                      use_best=use_best, FLAGS=FLAGS, buckets=buckets,
                                      translate=True)
 
+        # Op-level traces of the batches in FLAGS.trace_steps.
+        tracer = profiling_ops.create_tracer(FLAGS)
+
+        # Profile of the Python code of the batches in FLAGS.profile_steps
+        # (reading and tokenizing a chunk counts in its first batch).
+        profiler = profiling_ops.create_profiler(FLAGS, 'decode-batches')
+
         # Load vocabularies.
         source_vocab_file = FLAGS.data_dir + \
                             (FLAGS.train_data % str(FLAGS.src_vocab_size)) + \
@@ -37,52 +89,82 @@ def decode_from_file(files, model_path=None, use_best=False, get_ids=True, FLAGS
 
         start_total_time = time.time()
         total_sentence_count = 0
+        batch_count = 0
 
         for file_path in files:
 
             print("Translating file %s\n" % file_path)
 
             sentence_count = 0
+            source_token_count = 0
+            target_token_count = 0
 
             # Decode from file.
             with gfile.GFile(file_path, mode='r') as source:
                 with gfile.GFile(file_path + '.trans', mode='w') as destiny:
-                    sentence = source.readline()
 
                     start_time = time.time()
-                    while sentence:
 
-                        sentence_count += 1
-                        print("Translating sentence %d ", sentence_count)
+                    for sentences in _read_chunks(source, FLAGS.decode_chunk_size):
+
+                        if profiler is not None:
+                            profiler.step(batch_count + 1)
 
                         if get_ids:
 
-                            # Get token-ids for the input sentence.
-                            token_ids = data_utils.sentence_to_token_ids(sentence, src_vocab)
+                            # Get token-ids for all the input sentences of the chunk at once.
+                            all_token_ids = data_utils.sentences_to_token_ids(sentences, src_vocab)
 
                         else:
 
-                            # if sentence is already converted, just split the ids
-                            token_ids = [int(ss) for ss in sentence.strip().split()]
+                            # if sentences are already converted, just split the ids
+                            all_token_ids = [[int(ss) for ss in sentence.strip().split()] for sentence in sentences]
+
+                        translations = [None] * len(all_token_ids)
+
+                        for batch in length_sorted_batches(all_token_ids, FLAGS.decode_batch_size,
+                                                           model.get_inference_rung):
+
+                            batch_count += 1
+
+                            if profiler is not None:
+                                profiler.step(batch_count)
+
+                            run_session = sess if tracer is None else tracer.session(sess, batch_count)
 
-                        # Get output logits for the sentence.
-                        output_hypotheses, output_scores = model.translation_step(sess,
-                                                                                  token_ids,
-                                                                                  FLAGS.beam_size,
-                                                                                  normalize=True,
-                                                                                  dump_remaining=True)
+                            # Get the hypotheses of the sentences of the batch.
+                            batch_translations = model.batch_translation_step(run_session,
+                                                                              [all_token_ids[i] for i in batch],
+                                                                              FLAGS.beam_size,
+                                                                              normalize=True,
+                                                                              dump_remaining=True)
 
-                        outputs = output_hypotheses[0]
+                            if tracer is not None:
+                                tracer.write(run_session, 'decode-batch-%d' % batch_count)
 
-                        # Print out sentence corresponding to outputs.
-                        destiny.write(" ".join([rev_tgt_vocab[output] for output in outputs]))
-                        destiny.write("\n")
-                        sentence = source.readline()
+                            for i, (output_hypotheses, output_scores) in zip(batch, batch_translations):
+                                translations[i] = output_hypotheses[0]
+
+                        for token_ids, outputs in zip(all_token_ids, translations):
+
+                            # Print out sentence corresponding to outputs.
+                            destiny.write(" ".join([rev_tgt_vocab[output] for output in outputs]))
+                            destiny.write("\n")
+
+                            source_token_count += len(token_ids)
+                            target_token_count += len(outputs)
+
+                        sentence_count += len(all_token_ids)
+                        print("Translated %d sentences" % sentence_count)
+
+                    if profiler is not None:
+                        profiler.finish()
 
                     end_time = time.time() - start_time
 
                     print("\nDone file %s" % file_path)
-                    print("Avg. %.3f sentences/sec" % (sentence_count / end_time))
+                    print("Avg. %.3f sentences/sec - %.1f source tokens/sec - %.1f target tokens/sec" %
+                          (sentence_count / end_time, source_token_count / end_time, target_token_count / end_time))
 
             total_sentence_count += sentence_count
 
@@ -103,6 +185,13 @@ def decode_from_stdin(show_all_n_best=False, FLAGS=None, buckets=None):
         # Create model and load parameters.
         model = create_seq2seq_model(sess, True, FLAGS, buckets, translate=True)
 
+        # Op-level traces of the sentences in FLAGS.trace_steps.
+        tracer = profiling_ops.create_tracer(FLAGS)
+        sentence_count = 0
+
+        # Profile of the Python code of the sentences in FLAGS.profile_steps.
+        profiler = profiling_ops.create_profiler(FLAGS, 'decode-sentences')
+
         # Load vocabularies.
         source_vocab_file = FLAGS.data_dir + \
                             (FLAGS.train_data % str(FLAGS.src_vocab_size)) + \
@@ -121,11 +210,20 @@ def decode_from_stdin(show_all_n_best=False, FLAGS=None, buckets=None):
         sentence = sys.stdin.readline()
         while sentence:
 
+            sentence_count += 1
+            if profiler is not None:
+                profiler.step(sentence_count)
+
             # Get token-ids for the input sentence.
             token_ids = data_utils.sentence_to_token_ids(sentence, src_vocab)
 
+            run_session = sess if tracer is None else tracer.session(sess, sentence_count)
+
             # Get output logits for the sentence.
-            output_hypotheses, output_scores = model.translation_step(sess, token_ids, beam_size=FLAGS.beam_size, dump_remaining=False)
+            output_hypotheses, output_scores = model.translation_step(run_session, token_ids, beam_size=FLAGS.beam_size, dump_remaining=False)
+
+            if tracer is not None:
+                tracer.write(run_session, 'decode-sentence-%d' % sentence_count)
 
             outputs = []
 
@@ -152,3 +250,6 @@ def decode_from_stdin(show_all_n_best=False, FLAGS=None, buckets=None):
             print("> ", end="")
             sys.stdout.flush()
             sentence = sys.stdin.readline()
+
+        if profiler is not None:
+            profiler.finish()